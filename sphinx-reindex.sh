@@ -14,15 +14,64 @@ if [ ! -f /data/input/data.tsv -a ! -f /data/input/data.tsv.gz ]; then
     ln /data/input/planet-v2.0.4-100k_geonames.tsv.gz /data/input/data.tsv.gz
 fi
 
+# Embedded backend indexes the input data in the web workers, without indexer and searchd
+if [ "$WEBSEARCH_BACKEND" = "embedded" ]; then
+    touch /tmp/osmnames-sphinxsearch-data.timestamp
+    echo "Embedded backend, indexer and searchd are not started"
+    echo "Finished: "`date "+%Y%m%d %H%M%S"`
+    echo "========"
+    exit 0
+fi
+
 # Index files, only if not exists, or forced by the script
 if [ ! -f /data/index/ind_name_prefix_0.spa -o "$1" = "force" ]; then
     mkdir -p /data/index/
     set +e
+    # Deltas of the same input data are indexed again, dropped if the input changed
+    python /usr/local/src/websearch/delta.py rebase
+    # Plan local index threads and memory for the hardware and input data
+    python /etc/sphinxsearch/sphinx.conf --plan
+    SHARDS=`python -c "import json; print(json.load(open('/data/index/plan.json'))['index_threads'])"`
+    # Split the input data into shards read by the sources of the local indexes,
+    # with the docstore of the wide string attributes for the reduced schema
+    DOCSTORE=""
+    if [ "$WEBSEARCH_DOCSTORE" = "1" ]; then
+        DOCSTORE="--docstore /data/index/docstore.bin"
+    fi
+    echo "Sharding started: "`date "+%Y%m%d %H%M%S"`
+    python /usr/local/src/websearch/datainput.py --shards $SHARDS $DOCSTORE || echo "Sharding failed, sources read the input data with the full schema"
+    echo "Sharding finished: "`date "+%Y%m%d %H%M%S"`
     echo "Reindex started: "`date "+%Y%m%d %H%M%S"`
-    /usr/bin/indexer -c /etc/sphinxsearch/sphinx.conf --rotate --all
+    # Parallel indexers of the local indexes, rotated once all are built
+    python /usr/local/src/websearch/indexjobs.py
+    rc=$?
     echo "Reindex finished: "`date "+%Y%m%d %H%M%S"`
-    rc=$? && [ $rc -eq 1 ] && exit $rc
+    [ $rc -eq 1 ] && exit $rc
     set -e
+    # Distinct attribute values for validation of filters
+    python /usr/local/src/websearch/attributes.py /data/index/attributes.json
+    # Spatial index for the grid reverse geo-coding engine
+    if [ "$WEBSEARCH_REVERSE_ENGINE" = "grid" ]; then
+        echo "Spatial index started: "`date "+%Y%m%d %H%M%S"`
+        python /usr/local/src/websearch/spatialindex.py /data/index/reverse.grid
+        echo "Spatial index finished: "`date "+%Y%m%d %H%M%S"`
+    fi
+    # Prefix trie for short autocomplete queries
+    if [ "$WEBSEARCH_PREFIX_TRIE" = "1" ]; then
+        echo "Prefix trie started: "`date "+%Y%m%d %H%M%S"`
+        python /usr/local/src/websearch/prefixtrie.py /data/index/prefix.trie
+        echo "Prefix trie finished: "`date "+%Y%m%d %H%M%S"`
+    fi
+    # Warm up rotated indexes with the most frequent queries of the query log
+    if [ -n "`pidof searchd`" -a "${WEBSEARCH_WARMUP:-0}" -gt 0 ]; then
+        for i in `seq 60`; do
+            ls /data/index/*.new.sp? > /dev/null 2>&1 || break
+            sleep 5
+        done
+        echo "Warmup started: "`date "+%Y%m%d %H%M%S"`
+        python /usr/local/src/websearch/warmup.py --top $WEBSEARCH_WARMUP --time 300 || echo "Warmup failed"
+        echo "Warmup finished: "`date "+%Y%m%d %H%M%S"`
+    fi
     touch /tmp/osmnames-sphinxsearch-data.timestamp
 fi
 
@@ -0,0 +1,693 @@
+"""
+Micro-benchmarks for the web layer hot paths
+
+Searches are replayed on the searchd result sets recorded in
+tests/fixtures/searchd_results.json, so no running searchd is needed.
+Each benchmark reports ops/sec and the objects and bytes retained by its
+result (allocations of the web layer, deterministic between runs).
+
+Run from within the docker container (docker exec -it <container> bash)
+or from the repository with the web dependencies installed:
+
+    python tests/bench.py                     # run all benchmarks
+    python tests/bench.py --filter merge      # run benchmarks matching 'merge'
+    python tests/bench.py --save              # save the baseline
+    python tests/bench.py --compare           # fail on regression against the baseline
+    python tests/bench.py --record            # record fixtures from running searchd
+
+The saved baseline is machine specific for ops/sec, save it again on the
+machine used for the comparison.
+"""
+from json import dump, load
+from time import time
+from timeit import Timer
+import argparse
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+sys.path.insert(0, '/usr/local/src/websearch')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web'))
+
+import datainput
+import spatialindex
+import websearch
+from match import Match, MatchColumns
+
+try:
+    import natsort
+except ImportError:
+    natsort = None
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SEARCHD_FIXTURE = os.path.join(FIXTURES_DIR, 'searchd_results.json')
+BASELINE = os.path.join(FIXTURES_DIR, 'bench_baseline.json')
+DEFAULT_THRESHOLD = 0.25
+
+MIN_TIME = 0.5
+FILTER = None
+RESULTS = {}
+BENCHMARKS = []
+
+
+def benchmark(func):
+    """Register the group of benchmarks."""
+    BENCHMARKS.append(func)
+    return func
+
+
+def retained(obj, shared=()):
+    """
+    Number and size in bytes of objects reachable from obj.
+
+    Objects reachable from shared (inputs of the benchmark) and columns
+    shared by matches are not counted.
+    """
+    seen = set()
+    stack = list(shared)
+    counting = False
+    objects = 0
+    size = 0
+    while True:
+        if not stack:
+            if counting:
+                break
+            counting = True
+            stack = [obj]
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, MatchColumns):
+            continue
+        seen.add(id(o))
+        if counting:
+            objects += 1
+            size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif isinstance(o, Match):
+            stack.append(o.row)
+    return objects, size
+
+
+def bench(name, func, measure=None, shared=()):
+    """
+    Run func repeatedly for at least MIN_TIME seconds, print and record
+    ops/sec and allocations retained by its result.
+    """
+    if FILTER and FILTER not in name:
+        return None
+    result = func()
+    objects, size = retained(measure(result) if measure else result, shared)
+
+    timer = Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= MIN_TIME:
+            break
+        number *= 2
+    ops = number / elapsed
+    print("{:<48} {:>12.1f} ops/sec {:>8} objects {:>10} bytes".format(
+        name, ops, objects, size))
+    RESULTS[name] = {'ops': ops, 'objects': objects, 'bytes': size}
+    return ops
+
+
+def speedup(ops, legacy_ops):
+    if ops and legacy_ops:
+        print("{:<48} {:>12.1f} x".format('speedup', ops / legacy_ops))
+
+
+# -----------------------------------------------------------------------------
+# Recorded searchd result sets
+RE_FROM = re.compile(r"\bFROM\s+(\w+)", re.I)
+
+
+def utf8(value):
+    """Strings as utf-8, same as the values read by MySQLdb."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [utf8(v) for v in value]
+    return value
+
+
+def load_fixture(filename=SEARCHD_FIXTURE):
+    """
+    Load the recorded fixture.
+
+    Return dict with searches, attributes and results
+    (dict[ (index, query) ] = recorded result set).
+    """
+    with open(filename, 'rb') as f:
+        fixture = load(f)
+    results = {}
+    for entry in fixture['results']:
+        entry = dict(entry, columns=tuple(utf8(entry['columns'])),
+                     rows=[utf8(row) for row in entry['rows']])
+        results[(utf8(entry['index']), utf8(entry['query']))] = entry
+    searches = []
+    for search in fixture['searches']:
+        searches.append(dict(search, query=utf8(search['query'])))
+    return {
+        'searches': searches,
+        'attributes': dict((utf8(attr), frozenset(utf8(values)))
+                           for attr, values in fixture['attributes'].items()),
+        'results': results,
+    }
+
+
+def split_statements(sql, args):
+    """Yield (statement, its arguments) of the multi-statement query."""
+    args = list(args)
+    for statement in sql.split(';\n'):
+        n = statement.count('%s')
+        yield statement, args[:n]
+        args = args[n:]
+
+
+class FixtureCursor(object):
+    """Cursor replaying the recorded result sets, rows are new tuples as read by MySQLdb."""
+
+    def __init__(self, results):
+        self.results = results
+        self.sets = []
+        self.description = None
+        self.rows = []
+        self.total_found = 0
+
+    def execute(self, sql, args=()):
+        self.sets = []
+        for statement, statement_args in split_statements(sql, args):
+            if statement.startswith('SHOW META'):
+                self.sets.append(((('Variable_name', ), ('Value', )),
+                                  [('total_found', str(self.total_found))]))
+                continue
+            index = RE_FROM.search(statement).group(1)
+            query, start, count = statement_args[-3:]
+            entry = self.results.get((index, query))
+            if entry is None:
+                self.total_found = 0
+                self.sets.append(((('weight', ), ('id', )), []))
+                continue
+            self.total_found = entry['total_found']
+            self.sets.append((tuple((col, ) for col in entry['columns']),
+                              [tuple(row) for row in entry['rows'][start:start + count]]))
+        self.nextset()
+
+    def nextset(self):
+        if not self.sets:
+            return None
+        self.description, self.rows = self.sets.pop(0)
+        return True
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+
+class FixtureConnection(object):
+
+    def __init__(self, results):
+        self.results = results
+
+    def cursor(self):
+        return FixtureCursor(self.results)
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def install_fixture(fixture):
+    """Replay the fixture instead of searchd, without cache and prefix trie."""
+    websearch.DB_POOL.connect = lambda: FixtureConnection(fixture['results'])
+    websearch.CHECK_ATTR_FILTER = []
+    websearch.ATTR_VALUES = fixture['attributes']
+    websearch.WEBSEARCH_CASCADE_MODE = 'sequential'
+    websearch.WEBSEARCH_PREFIX_TRIE = 0
+    websearch.WEBSEARCH_CACHE_SIZE = 0
+
+
+# -----------------------------------------------------------------------------
+# Recording of the fixture from running searchd
+class RecordingCursor(object):
+    """Cursor of searchd recording the result sets of the search queries."""
+
+    def __init__(self, cursor, results):
+        self.cursor = cursor
+        self.results = results
+        self.last = None
+
+    def execute(self, sql, args=()):
+        self.cursor.execute(sql, args)
+        self.description = self.cursor.description
+        self.rows = self.cursor.fetchall()
+        if sql.startswith('SHOW META'):
+            if self.last is not None:
+                self.last['total_found'] = int(self.rows[0][1]) if self.rows else 0
+            return
+        if 'MATCH(' not in sql:
+            self.last = None
+            return
+        query = args[-3]
+        self.last = {
+            'index': RE_FROM.search(sql).group(1),
+            'query': query,
+            'total_found': len(self.rows),
+            'columns': [name[0] for name in self.description],
+            'rows': [list(row) for row in self.rows],
+        }
+        self.results[(self.last['index'], query)] = self.last
+
+    def nextset(self):
+        return self.cursor.nextset()
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        self.cursor.close()
+
+
+def record(filename=SEARCHD_FIXTURE):
+    """Record the result sets of the fixture searches from searchd."""
+    with open(filename, 'rb') as f:
+        fixture = load(f)
+    results = {}
+    connect = websearch.DB_POOL.connect
+
+    class RecordingConnection(object):
+        def __init__(self):
+            self.db = connect()
+
+        def cursor(self):
+            return RecordingCursor(self.db.cursor(), results)
+
+        def ping(self):
+            self.db.ping()
+
+        def close(self):
+            self.db.close()
+
+    websearch.DB_POOL.clear()
+    websearch.DB_POOL.connect = RecordingConnection
+    websearch.WEBSEARCH_CASCADE_MODE = 'sequential'
+    websearch.WEBSEARCH_PREFIX_TRIE = 0
+    for search in fixture['searches']:
+        websearch.process_search(utf8(search['query']), {}, search['autocomplete'],
+                                 0, search['count'])
+    fixture['results'] = [results[key] for key in sorted(results)]
+    fixture['attributes'] = dict((attr, sorted(values)) for attr, values in
+                                 websearch.get_attr_values().items())
+    with open(filename, 'wb') as f:
+        dump(fixture, f, indent=1, sort_keys=True)
+    print('Recorded {} result sets of {} searches'.format(
+        len(results), len(fixture['searches'])))
+
+
+# -----------------------------------------------------------------------------
+# Query modifiers and the cascade
+@benchmark
+def bench_modifiers(fixture):
+    queries = [search['query'] for search in fixture['searches']]
+    for modify in (websearch.modify_query_autocomplete,
+                   websearch.modify_query_orig,
+                   websearch.modify_query_remhouse,
+                   websearch.modify_query_splitor,
+                   websearch.modify_query_postcode):
+        bench('{}[{}]'.format(modify.__name__, len(queries)),
+              lambda: [modify(query) for query in queries], shared=[queries])
+
+
+# Cascade of the autocomplete search, steps 1. - 3. of process_search
+CASCADE_MODIFIERS = [
+    ('ind_postcodes_infix', websearch.modify_query_postcode, 'postcode = 1000'),
+    ('ind_name_exact', websearch.modify_query_autocomplete, 'name = 1000, alternative_names = 990'),
+    ('ind_name_prefix', websearch.modify_query_autocomplete, 'name = 900, alternative_names = 890'),
+    ('ind_name_exact', websearch.modify_query_orig, 'name = 800, alternative_names = 790'),
+    ('ind_name_prefix', websearch.modify_query_orig, 'name = 700, alternative_names = 690'),
+    ('ind_names_prefix', websearch.modify_query_autocomplete,
+     'name = 300, alternative_names = 290, display_name = 70'),
+    ('ind_names_prefix', websearch.modify_query_orig,
+     'name = 200, alternative_names = 190, display_name = 60'),
+]
+
+
+@benchmark
+def bench_cascade(fixture):
+    for search in fixture['searches']:
+        query = search['query']
+        count = search['count']
+        name = '{}[{}]'.format('process_query_modifiers', query)
+        bench(name, lambda: websearch.process_query_modifiers(
+            query, CASCADE_MODIFIERS, {}, {}, {}, 0, count))
+        name = '{}[{}{}]'.format('process_search', query,
+                                 ',autocomplete' if search['autocomplete'] else '')
+        bench(name, lambda: websearch.process_search(
+            query, {}, search['autocomplete'], 0, count))
+
+
+# -----------------------------------------------------------------------------
+# Merge of the results
+def legacy_mergeResultObject(result_old, result_new):
+    """Previous implementation of mergeResultObject (natsort over weights)."""
+    weight_matches = {}
+    unique_id = 0
+    unique_ids_list = []
+
+    for matches in [result_old['matches'], result_new['matches'], ]:
+        for row in matches:
+            if row['id'] in unique_ids_list:
+                result_old['total_found'] -= 1
+                continue
+            unique_ids_list.append(row['id'])
+            weight = str(row['weight'])
+            if weight in weight_matches:
+                weight += '_{}'.format(unique_id)
+                unique_id += 1
+            weight_matches[weight] = row
+
+    sorted_matches = natsort.natsorted(weight_matches.items(), reverse=True)
+    matches = []
+    i = 0
+    for row in sorted_matches:
+        matches.append(row[1])
+        i += 1
+        if 'count' in result_old and i >= result_old['count']:
+            break
+
+    result = result_old.copy()
+    result['matches'] = matches
+    result['total_found'] += result_new['total_found']
+    return result
+
+
+def make_result(count, first_id, rnd):
+    """Result object with count matches, integer weights with ties."""
+    matches = []
+    for i in range(count):
+        matches.append(Match.from_attrs(
+            first_id + i, float(rnd.randint(1, count // 2 + 1) * 1000), {}))
+    return {
+        'matches': matches,
+        'total_found': count * 3,
+        'count': count,
+        'start_index': 0,
+        'message': None,
+    }
+
+
+@benchmark
+def bench_merge(fixture):
+    rnd = random.Random(42)
+    for count in (20, 100, 200):
+        # half of the new matches are duplicates of the old ones
+        result_old = make_result(count, 0, rnd)
+        result_new = make_result(count, count // 2, rnd)
+
+        merged = websearch.mergeResultObject(result_old, result_new)
+        weights = [row.weight for row in merged['matches']]
+        assert weights == sorted(weights, reverse=True)
+        assert len(merged['matches']) == count
+
+        ops = bench('mergeResultObject[{}]'.format(count),
+                    lambda: websearch.mergeResultObject(result_old, result_new),
+                    shared=[result_old, result_new])
+        if natsort is None:
+            continue
+
+        # Previous implementation works with dict matches
+        dict_old = dict(result_old, matches=[m.to_dict() for m in result_old['matches']])
+        dict_new = dict(result_new, matches=[m.to_dict() for m in result_new['matches']])
+        legacy = legacy_mergeResultObject(dict(dict_old), dict_new)
+        assert legacy['total_found'] == merged['total_found']
+        assert (sorted(row['weight'] for row in legacy['matches']) ==
+                sorted(weights))
+        legacy_ops = bench('legacy_mergeResultObject[{}]'.format(count),
+                           lambda: legacy_mergeResultObject(dict(dict_old), dict_new),
+                           shared=[dict_old, dict_new])
+        speedup(ops, legacy_ops)
+
+
+# -----------------------------------------------------------------------------
+# Matches read from the cursor
+COLUMNS = ['weight', 'id', 'name', 'alternative_names', 'osm_type', 'osm_id',
+           'class', 'type', 'lon', 'lat', 'place_rank', 'importance', 'street',
+           'city', 'county', 'state', 'country', 'country_code', 'display_name',
+           'west', 'south', 'east', 'north', 'wikidata', 'wikipedia',
+           'housenumbers']
+
+
+class FakeCursor(object):
+    """Result set of searchd with rows of all columns."""
+
+    def __init__(self, count):
+        self.description = tuple((col, ) for col in COLUMNS)
+        self.rows = []
+        for i in range(count):
+            row = []
+            for col in COLUMNS:
+                if col in ('weight', 'id'):
+                    row.append(1000 + i)
+                elif col in ('lon', 'lat', 'place_rank', 'importance',
+                             'west', 'south', 'east', 'north'):
+                    row.append(float(i))
+                else:
+                    row.append('{} {}'.format(col, i))
+            self.rows.append(tuple(row))
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+def legacy_get_cursor_matches(cursor):
+    """Previous implementation of get_cursor_matches (dict per row)."""
+    desc = cursor.description
+    matches = []
+    for row in cursor:
+        match = {
+            'weight': 0,
+            'attrs': {},
+            'id': 0,
+        }
+        for (name, value) in zip(desc, row):
+            col = name[0]
+            if col == 'id':
+                match['id'] = value
+            elif col == 'weight':
+                match['weight'] = value
+            else:
+                match['attrs'][col] = value
+        matches.append(match)
+    return matches
+
+
+@benchmark
+def bench_matches(fixture):
+    for count in (20, 100):
+        cursor = FakeCursor(count)
+        matches = websearch.get_cursor_matches(cursor)
+        legacy = legacy_get_cursor_matches(cursor)
+        assert [(m.id, m.weight, m.attrs()) for m in matches] == \
+            [(m['id'], m['weight'], m['attrs']) for m in legacy]
+
+        ops = bench('get_cursor_matches[{}]'.format(count),
+                    lambda: websearch.get_cursor_matches(cursor), shared=[cursor.rows])
+        legacy_ops = bench('legacy_get_cursor_matches[{}]'.format(count),
+                           lambda: legacy_get_cursor_matches(cursor), shared=[cursor.rows])
+        speedup(ops, legacy_ops)
+
+
+# -----------------------------------------------------------------------------
+# JSON of the results and the response
+def fixture_results(fixture):
+    """Results of the fixture searches, as (name, result)."""
+    for search in fixture['searches']:
+        rc, result = websearch.process_search(
+            search['query'], {}, search['autocomplete'], 0, search['count'])
+        if rc and result['matches']:
+            yield search['query'], result
+
+
+@benchmark
+def bench_json(fixture):
+    with websearch.app.test_request_context('/'):
+        for name, result in fixture_results(fixture):
+            bench('prepareResultJson[{}]'.format(name),
+                  lambda: websearch.prepareResultJson(result), shared=[result])
+
+            response = websearch.prepareResultJson(result)
+            # prepareNameSuffix modifies the rows, benchmark works on copies
+            rows = response['results']
+            bench('prepareNameSuffix[{}]'.format(name),
+                  lambda: websearch.prepareNameSuffix([dict(row) for row in rows]),
+                  shared=[rows])
+            no_city = [dict(row, city='') for row in rows]
+            bench('parseDisplayName[{}]'.format(name),
+                  lambda: [websearch.parseDisplayName(dict(row)) for row in no_city],
+                  shared=[no_city])
+
+            data = {'query': name, 'route': '/', 'format': 'json', 'result': response}
+            bench('formatResponse[{}]'.format(name),
+                  lambda: websearch.formatResponse(data),
+                  measure=lambda resp: resp[0].get_data())
+
+
+# -----------------------------------------------------------------------------
+# Nearest place of the spatial grid index
+GRID_CITY = (2.35, 48.85)
+GRID_POINTS = [
+    ('city', GRID_CITY[0] + 0.01, GRID_CITY[1] + 0.01, None),
+    ('city,class', GRID_CITY[0] + 0.01, GRID_CITY[1] + 0.01, ['place']),
+    ('ocean', -140.0, -45.0, None),
+]
+
+
+def make_grid(filename, rnd):
+    """
+    Grid index of the synthetic fixture: places spread over the continents
+    with a dense city of 50000 rows, no rows in the South Pacific.
+    """
+    input_file = filename + '.tsv'
+    with open(input_file, 'wb') as f:
+        f.write('\t'.join(datainput.COLUMNS) + '\n')
+
+        def write(lon, lat, cl):
+            cols = [''] * len(datainput.COLUMNS)
+            cols[datainput.COLUMN_INDEX['lon']] = repr(lon)
+            cols[datainput.COLUMN_INDEX['lat']] = repr(lat)
+            cols[datainput.COLUMN_INDEX['class']] = cl
+            f.write('\t'.join(cols) + '\n')
+        for i in range(20000):
+            write(rnd.uniform(-120.0, 150.0), rnd.uniform(-40.0, 70.0),
+                  rnd.choice(['place', 'highway', 'boundary']))
+        for i in range(50000):
+            write(rnd.gauss(GRID_CITY[0], 0.05), rnd.gauss(GRID_CITY[1], 0.05), 'highway')
+    spatialindex.build(input_file, filename)
+    os.remove(input_file)
+    return spatialindex.GridIndex(filename)
+
+
+def legacy_nearest(grid, lon, lat, classes=None):
+    """Previous implementation of GridIndex.nearest (doubling boxes of cells)."""
+    codes = None
+    if classes:
+        codes = set(grid.classes[cl] for cl in classes if cl in grid.classes)
+    delta = 0.0004
+    while delta < 360.0:
+        delta *= 2
+        best = None
+        cx_min = spatialindex.grid_cell(max(lon - delta, -180.0), 180.0, grid.cell_size, grid.n_lon)
+        cx_max = spatialindex.grid_cell(min(lon + delta, 180.0), 180.0, grid.cell_size, grid.n_lon)
+        cy_min = spatialindex.grid_cell(lat - delta, 90.0, grid.cell_size, grid.n_lat)
+        cy_max = spatialindex.grid_cell(lat + delta, 90.0, grid.cell_size, grid.n_lat)
+        for cy in xrange(cy_min, cy_max + 1):
+            for cx in xrange(cx_min, cx_max + 1):
+                cell = cy * grid.n_lon + cx
+                for i in xrange(grid.offsets[cell], grid.offsets[cell + 1]):
+                    record = grid.record(i)
+                    if abs(record[0] - lon) > delta or abs(record[1] - lat) > delta:
+                        continue
+                    if codes is not None and record[3] not in codes:
+                        continue
+                    distance = spatialindex.geodist(lat, lon, record[1], record[0])
+                    if best is None or distance < best[1]:
+                        best = (record[2], distance)
+        if best is not None:
+            return best
+    return None
+
+
+@benchmark
+def bench_grid(fixture):
+    names = ['GridIndex.nearest', 'legacy_nearest']
+    if FILTER and not any(FILTER in '{}[{}]'.format(name, point[0])
+                          for name in names for point in GRID_POINTS):
+        return
+    filename = os.path.join(tempfile.mkdtemp(), 'reverse.grid')
+    grid = make_grid(filename, random.Random(42))
+    try:
+        for name, lon, lat, classes in GRID_POINTS:
+            ops = bench('{}[{}]'.format(names[0], name),
+                        lambda: grid.nearest(lon, lat, classes))
+            legacy_ops = bench('{}[{}]'.format(names[1], name),
+                               lambda: legacy_nearest(grid, lon, lat, classes))
+            speedup(ops, legacy_ops)
+    finally:
+        grid.close()
+        shutil.rmtree(os.path.dirname(filename))
+
+
+# -----------------------------------------------------------------------------
+def compare(results, baseline, threshold):
+    """Return regressions of the results against the baseline, as messages."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        measured = results[name]
+        base = baseline[name]
+        if measured['ops'] < base['ops'] * (1 - threshold):
+            regressions.append('{}: {:.1f} ops/sec, baseline {:.1f}'.format(
+                name, measured['ops'], base['ops']))
+        for key in ('objects', 'bytes'):
+            if measured[key] > base[key] * (1 + threshold):
+                regressions.append('{}: {} {}, baseline {}'.format(
+                    name, measured[key], key, base[key]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the web layer hot paths.')
+    parser.add_argument('--filter', help='run only benchmarks with the substring in the name')
+    parser.add_argument('--min-time', type=float, default=MIN_TIME,
+                        help='minimal time of each benchmark in seconds')
+    parser.add_argument('--fixture', default=SEARCHD_FIXTURE,
+                        help='recorded searchd result sets')
+    parser.add_argument('--save', nargs='?', const=BASELINE,
+                        help='save the results as the baseline')
+    parser.add_argument('--compare', nargs='?', const=BASELINE,
+                        help='compare the results with the baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed relative regression against the baseline')
+    parser.add_argument('--record', action='store_true',
+                        help='record the fixture from running searchd and exit')
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.fixture)
+        sys.exit(0)
+
+    FILTER = args.filter
+    MIN_TIME = args.min_time
+    fixture = load_fixture(args.fixture)
+    install_fixture(fixture)
+
+    start = time()
+    for group in BENCHMARKS:
+        group(fixture)
+    print("benchmarks completed in {:.1f}s".format(time() - start))
+
+    if args.save:
+        with open(args.save, 'wb') as f:
+            dump(RESULTS, f, indent=1, sort_keys=True)
+        print('Baseline saved to ' + args.save)
+    if args.compare:
+        with open(args.compare, 'rb') as f:
+            baseline = load(f)
+        regressions = compare(RESULTS, baseline, args.threshold)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        if regressions:
+            sys.exit(1)
+        print('No regression against ' + args.compare)
@@ -0,0 +1,220 @@
+"""
+Tests of reverse geocoding with delta indexes
+
+Places of reverse_test.tsv are served by a replacement of searchd, which
+masks the documents killed by the deltas and adds the delta documents like
+the distributed indexes do, so no running searchd is needed. The spatial
+grid index and the prefix trie are built from the input data only, the deltas
+are applied on top.
+
+Run from within the docker container (docker exec -it <container> bash)
+or from the repository with the web dependencies installed:
+
+    python tests/delta_test.py
+"""
+import os
+import re
+import shutil
+import sys
+import tempfile
+sys.path.insert(0, '/usr/local/src/websearch')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web'))
+
+import datainput
+import delta
+import prefixtrie
+import spatialindex
+import websearch
+
+REVERSE_TEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reverse_test.tsv')
+COLUMNS = ('id', 'name', 'class', 'lon', 'lat', 'distance')
+RE_GEODIST = re.compile(r'GEODIST\(([-\d.e]+), ([-\d.e]+),')
+RE_BETWEEN = re.compile(r'(lon|lat) BETWEEN ([-\d.e]+) AND ([-\d.e]+)')
+
+
+class PlacesCursor(object):
+    """Cursor answering the reverse geocoding queries of ind_name_exact."""
+
+    def __init__(self, places):
+        self.places = places
+        self.description = None
+        self.rows = []
+
+    def execute(self, sql, args=()):
+        EXECUTED.append(sql)
+        point = RE_GEODIST.search(sql)
+        if point is not None:
+            lat, lon = float(point.group(1)), float(point.group(2))
+        ids = None
+        if ' id = ' in sql or ' id IN ' in sql:
+            ids = set(args)
+        places = []
+        for doc_id, place in sorted(self.places.items()):
+            if ids is not None and doc_id not in ids:
+                continue
+            if ids is None:
+                if any(not float(low) <= place[col] <= float(high)
+                       for col, low, high in RE_BETWEEN.findall(sql)):
+                    continue
+                if args and place['class'] != args[0]:
+                    continue
+            distance = 0.0
+            if point is not None:
+                distance = spatialindex.geodist(lat, lon, place['lat'], place['lon'])
+            places.append((distance, doc_id, place))
+        if 'ORDER BY distance' in sql:
+            places = sorted(places)[:1]
+        self.description = tuple((col, ) for col in COLUMNS)
+        self.rows = [(doc_id, place['name'], place['class'], place['lon'], place['lat'], distance)
+                     for distance, doc_id, place in places]
+
+    def nextset(self):
+        return None
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+
+class PlacesConnection(object):
+
+    def __init__(self, places):
+        self.places = places
+
+    def cursor(self):
+        return PlacesCursor(self.places)
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def place(cols):
+    return {
+        'name': cols[datainput.COLUMN_INDEX['name']].encode('utf-8'),
+        'class': cols[datainput.COLUMN_INDEX['class']].encode('utf-8'),
+        'lon': float(cols[datainput.COLUMN_INDEX['lon']]),
+        'lat': float(cols[datainput.COLUMN_INDEX['lat']]),
+    }
+
+
+def searchd_places(input_file, state):
+    """Documents of the indexes: input rows, killed ones masked, with the delta documents."""
+    places = {}
+    killed = delta.killed_ids(state)
+    for doc_id, cols in datainput.iter_rows(input_file):
+        if doc_id not in killed:
+            places[doc_id] = place([col.decode('utf-8') for col in cols])
+    for doc_id, cols in delta.documents(state).items():
+        places[doc_id] = place(cols)
+    return places
+
+
+def apply_changes(input_file, lines):
+    """Apply the delta changes and serve the updated indexes."""
+    state = delta.load_state() or delta.new_state(input_file)
+    changes, rejected = delta.parse_changes(lines)
+    assert not rejected
+    delta.apply_changes(state, changes, input_file)
+    delta.save_state(state)
+    websearch.DB_POOL.clear()
+    places = searchd_places(input_file, state)
+    websearch.DB_POOL.connect = lambda: PlacesConnection(places)
+    # New data version, loaded by the web workers
+    websearch.DELTAS_VERSION = None
+    websearch.PREFIX_TRIE_VERSION = None
+
+
+def change_line(action, name, osm_id, lon, lat, cl='place'):
+    cols = [''] * len(datainput.COLUMNS)
+    cols[datainput.COLUMN_INDEX['name']] = name
+    cols[datainput.COLUMN_INDEX['osm_type']] = 'node'
+    cols[datainput.COLUMN_INDEX['osm_id']] = str(osm_id)
+    cols[datainput.COLUMN_INDEX['class']] = cl
+    cols[datainput.COLUMN_INDEX['lon']] = str(lon)
+    cols[datainput.COLUMN_INDEX['lat']] = str(lat)
+    return '\t'.join([action] + cols) + '\n'
+
+
+def nearest_name(lon, lat, classes=None):
+    result, distance = websearch.reverse_search(lon, lat, classes or [], False)
+    assert result['status'], result.get('message')
+    return result['matches'][0].attr('name')
+
+
+def trie_names(query):
+    result = websearch.search_prefix_trie(query, {}, 0, 100)
+    return sorted(match.attr('name') for match in result['matches']), result['total_found']
+
+
+def batch_names(points):
+    return [result['matches'][0].attr('name') if result['matches'] else None
+            for result, distance in websearch.reverse_search_batch(points)]
+
+
+EXECUTED = []
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    # Rows of reverse_test.tsv without the housenumbers column
+    input_file = os.path.join(tmp_dir, 'data.tsv')
+    with open(REVERSE_TEST, 'rb') as f, open(input_file, 'wb') as out:
+        for line in f:
+            out.write(line.rstrip('\n') + '\t\n')
+    grid_file = os.path.join(tmp_dir, 'reverse.grid')
+    spatialindex.build(input_file, grid_file)
+    trie_file = os.path.join(tmp_dir, 'prefix.trie')
+    prefixtrie.build(input_file, trie_file)
+
+    delta.DELTA_STATE = os.path.join(tmp_dir, 'delta', 'state.json')
+    websearch.WEBSEARCH_REVERSE_ENGINE = 'grid'
+    websearch.WEBSEARCH_REVERSE_INDEX = grid_file
+    websearch.WEBSEARCH_CACHE_SIZE = 0
+    websearch.WEBSEARCH_PREFIX_TRIE = 0
+    websearch.REVERSE_INDEX_VERSION = None
+    apply_changes(input_file, [])
+
+    assert nearest_name(25.0, 25.0) == 'NE quadrant 1'
+    print("test 1 passed")
+
+    # Delete the nearest place, the next one is found without searchd fallback
+    apply_changes(input_file, [change_line('delete', '', 1, 0, 0)])
+    del EXECUTED[:]
+    assert nearest_name(25.0, 25.0) == 'NE quadrant 2'
+    assert not any('GEODIST' in sql and 'BETWEEN' in sql for sql in EXECUTED)
+    assert batch_names([(25.0, 25.0, []), (25.1, 25.1, [])]) == ['NE quadrant 2', 'NE quadrant 2']
+    print("test 2 passed")
+
+    # Added place is found, though it is not in the grid
+    apply_changes(input_file, [change_line('add', 'NE delta', 1001, 25.01, 25.01, 'highway')])
+    assert nearest_name(25.0, 25.0) == 'NE delta'
+    assert batch_names([(25.0, 25.0, []), (25.1, 25.1, [])]) == ['NE delta', 'NE quadrant 2']
+    assert nearest_name(25.0, 25.0, ['place']) == 'NE quadrant 2'
+    print("test 3 passed")
+
+    # Grid winner not in the indexes (deltas not loaded yet), searchd is asked
+    websearch.DELTAS = ({}, frozenset())
+    websearch.DELTAS_VERSION = websearch.get_data_version()
+    del EXECUTED[:]
+    assert nearest_name(25.0, 25.0) == 'NE delta'
+    assert any('GEODIST' in sql and 'BETWEEN' in sql for sql in EXECUTED)
+    assert batch_names([(25.0, 25.0, []), (-25.0, 25.0, [])]) == ['NE delta', 'SE quadrant 1']
+    print("test 4 passed")
+
+    # Prefix trie skips the deleted place and finds the added one
+    websearch.WEBSEARCH_PREFIX_TRIE = 1
+    websearch.WEBSEARCH_PREFIX_TRIE_FILE = trie_file
+    websearch.PREFIX_TRIE_VERSION = None
+    websearch.DELTAS_VERSION = None
+    names, total_found = trie_names('ne')
+    assert 'NE quadrant 1' not in names and 'NE quadrant 2' in names and 'NE delta' in names
+    assert total_found == len(names)
+    apply_changes(input_file, [change_line('delete', '', 1001, 25.01, 25.01, 'highway')])
+    assert trie_names('ne')[0] == [name for name in names if name != 'NE delta']
+    print("test 5 passed")
+finally:
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,79 @@
+"""
+Tests of the ranking of the prefix trie
+
+Rows with a word equal to the prefix rank first as the matches of the
+ind_name_exact step of the autocomplete cascade, the other rows follow as the
+matches of ind_name_prefix. Weights are on the WEIGHT()*importance scale of
+searchd, so the trie results merge with the results of the cascade.
+
+Run from within the docker container (docker exec -it <container> bash)
+or from the repository with the web dependencies installed:
+
+    python tests/prefixtrie_test.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+sys.path.insert(0, '/usr/local/src/websearch')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web'))
+
+import datainput
+import prefixtrie
+
+
+def row(name, importance, alternative_names='', country_code='de'):
+    cols = [''] * len(datainput.COLUMNS)
+    cols[datainput.COLUMN_INDEX['name']] = name
+    cols[datainput.COLUMN_INDEX['alternative_names']] = alternative_names
+    cols[datainput.COLUMN_INDEX['importance']] = str(importance)
+    cols[datainput.COLUMN_INDEX['country_code']] = country_code
+    return cols
+
+
+def names(found):
+    matches, total_found = found
+    return [match.attr('name') for match in matches]
+
+
+ROWS = [
+    row('Bergen', 0.9),
+    row('Berlin', 0.5),
+    row('Be', 0.1),
+    row('Bad Be', 0.2),
+    row('Xanten', 0.05, 'Be'),
+]
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    input_file = os.path.join(tmp_dir, 'data.tsv')
+    with open(input_file, 'wb') as f:
+        f.write('\t'.join(datainput.COLUMNS) + '\n')
+        for cols in ROWS:
+            f.write('\t'.join(cols) + '\n')
+    trie_file = os.path.join(tmp_dir, 'prefix.trie')
+    prefixtrie.build(input_file, trie_file)
+    trie = prefixtrie.PrefixTrie(trie_file)
+
+    # Exact words first, though the prefix matches are more important
+    assert names(trie.search(u'be')) == ['Bad Be', 'Be', 'Xanten', 'Bergen', 'Berlin']
+    print("test 1 passed")
+
+    # Weights of single keyword queries on the scale of searchd
+    matches, total_found = trie.search(u'be')
+    weights = dict((match.attr('name'), match.weight) for match in matches)
+    assert total_found == 5
+    assert abs(weights['Be'] - 30 * 1000 * 1000 * 0.1) < 1
+    assert abs(weights['Bad Be'] - 20 * 1000 * 1000 * 0.2) < 1
+    assert abs(weights['Berlin'] - 20 * 900 * 1000 * 0.5) < 1
+    assert names(trie.search(u'b', ['de'], 0, 2)) == ['Bergen', 'Berlin']
+    print("test 2 passed")
+
+    # Delta rows are ranked the same way, Bergen (line 2) is killed
+    delta_id = 1000000001
+    trie.apply_deltas(frozenset([2]), {delta_id: [col.decode('utf-8') for col in row('Be Delta', 0.3)]})
+    assert names(trie.search(u'be')) == ['Be Delta', 'Bad Be', 'Be', 'Xanten', 'Berlin']
+    trie.close()
+    print("test 3 passed")
+finally:
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,66 @@
+"""
+Tests of the result cache warmup from the searchd query log
+
+Log lines are written as searchd logs the statements of the web layer, with
+the steps of several searches interleaved on the pooled connections, so no
+running searchd is needed.
+
+Run from within the docker container (docker exec -it <container> bash)
+or from the repository with the web dependencies installed:
+
+    python tests/warmup_test.py
+"""
+import os
+import sys
+sys.path.insert(0, '/usr/local/src/websearch')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web'))
+
+import warmup
+import websearch
+
+
+def log_line(conn, index, name_weight, query, start=0, count=20):
+    return ("/* Mon Oct 12 10:00:00.000 2026 conn {} real 0.001 wall 0.001 found 1 */ "
+            "SELECT WEIGHT()*importance+0 as weight, * FROM {} WHERE MATCH('{}') "
+            "ORDER BY weight DESC LIMIT {}, {} OPTION field_weights = "
+            "(name = {}, alternative_names = {});\n").format(
+                conn, index, query, start, count, name_weight, name_weight - 10)
+
+
+def autocomplete_steps(conn, query):
+    """Steps of the autocomplete search, up to its original query step."""
+    query_ac = websearch.modify_query_autocomplete(query)[0]
+    return [
+        log_line(conn, 'ind_name_exact', 1000, query_ac),
+        log_line(conn, 'ind_name_prefix', 900, query_ac),
+        log_line(conn, 'ind_name_exact', 800, query),
+    ]
+
+
+def searches(lines, top=10):
+    found = websearch.warmup_searches(warmup.parse_log(lines), top)
+    return sorted((query, autocomplete) for query, query_filter, autocomplete, start, count in found)
+
+
+# Original query step of the autocomplete cascade is not a search of its own
+assert searches(autocomplete_steps(1, 'london')) == [('london', True)]
+print("test 1 passed")
+
+# Autocomplete search stopped after its first step, the next search on the
+# pooled connection is the original query of another request
+lines = [autocomplete_steps(1, 'london')[0], log_line(1, 'ind_name_exact', 800, 'london')]
+assert searches(lines) == [('london', False), ('london', True)]
+print("test 2 passed")
+
+# Searches interleaved on two pooled connections
+london = autocomplete_steps(1, 'london')
+paris = autocomplete_steps(2, 'paris')
+lines = [london[0], paris[0], london[1], log_line(2, 'ind_name_exact', 800, 'berlin'),
+         paris[1], london[2], paris[2]]
+assert searches(lines) == [('berlin', False), ('london', True), ('paris', False), ('paris', True)]
+print("test 3 passed")
+
+# Statement of another search between the autocomplete steps ends the cascade
+lines = [london[0], log_line(1, 'ind_name_prefix', 700, 'oxford'), london[2]]
+assert searches(lines) == [('london', False), ('london', True)]
+print("test 4 passed")
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Snapshot of distinct attribute values of OSMNames-SphinxSearch
+#
+# The snapshot is written at index time next to the indexes and loaded by
+# the web workers to validate filter values, instead of GROUP BY queries.
+#
+# Usage: attributes.py [--attributes country_code,class,type] [input] output
+
+from json import dump, load
+from os import rename
+import argparse
+import sys
+
+from datainput import COLUMN_INDEX, default_input, iter_rows
+
+
+DEFAULT_ATTRIBUTES = ['country_code', 'class', 'type']
+# Attributes with more distinct values are not validated
+MAX_VALUES = 1000
+
+
+def build(input_file, output_file, attributes=DEFAULT_ATTRIBUTES):
+    """Write distinct values of the attributes, return number of attributes."""
+    values = dict((attr, set()) for attr in attributes)
+    for doc_id, cols in iter_rows(input_file):
+        for attr in attributes:
+            if values[attr] is not None:
+                values[attr].add(cols[COLUMN_INDEX[attr]].decode('utf-8', 'replace'))
+                if len(values[attr]) > MAX_VALUES:
+                    values[attr] = None
+
+    snapshot = {}
+    for attr in attributes:
+        if values[attr]:
+            snapshot[attr] = sorted(values[attr])
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        dump(snapshot, f, indent=0, sort_keys=True)
+    rename(tmp_file, output_file)
+    return len(snapshot)
+
+
+def load_snapshot(filename, attributes):
+    """
+    Load values of the attributes from the snapshot.
+
+    dict[ attribute ] = frozenset(values)
+    """
+    with open(filename, 'rb') as f:
+        snapshot = load(f)
+    values = {}
+    for attr in attributes:
+        if attr in snapshot:
+            values[attr] = frozenset(value.encode('utf-8') for value in snapshot[attr])
+    return values
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write snapshot of distinct attribute values.')
+    parser.add_argument('--attributes', default=','.join(DEFAULT_ATTRIBUTES),
+                        help='comma separated attributes')
+    parser.add_argument('input', nargs='?', help='input data.tsv[.gz]')
+    parser.add_argument('output', help='output snapshot file')
+    args = parser.parse_args()
+
+    count = build(args.input or default_input(), args.output, args.attributes.split(','))
+    print('Attributes snapshot {} written with {} attributes'.format(args.output, count))
+    sys.exit(0)
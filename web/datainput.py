@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Input data of OSMNames-SphinxSearch, used by index time tools
+#
+# Rows are read the same way as the tsvpipe sources in sphinx.conf,
+# so the document id of a row matches the id in the sphinx indexes.
+#
+# The input is split into the shard files of the local indexes in a single
+# pass, read by the tsvpipe sources instead of the whole input. The docstore
+# of the wide string attributes is optionally written in the same pass.
+#
+# Usage: datainput.py [--shards 4] [--output-dir /data/index/shards]
+#                     [--docstore /data/index/docstore.bin] [input]
+
+from json import dump, load
+from os import makedirs, remove, rename, stat
+from os.path import isdir, isfile, join
+import argparse
+import gzip
+import subprocess
+import sys
+
+from docstore import DOCSTORE_COLUMNS, DocStoreWriter
+
+
+# Columns of the input data.tsv, see README
+COLUMNS = [
+    'name', 'alternative_names', 'osm_type', 'osm_id', 'class', 'type',
+    'lon', 'lat', 'place_rank', 'importance', 'street', 'city', 'county',
+    'state', 'country', 'country_code', 'display_name', 'west', 'south',
+    'east', 'north', 'wikidata', 'wikipedia', 'housenumbers',
+]
+COLUMN_INDEX = dict((col, i) for i, col in enumerate(COLUMNS))
+
+# Columns stored as float attributes in the indexes
+FLOAT_COLUMNS = ['lon', 'lat', 'place_rank', 'importance',
+                 'west', 'south', 'east', 'north']
+
+DATA_INPUT = '/data/input/data.tsv'
+SHARD_DIR = '/data/index/shards'
+SHARD_MANIFEST = 'manifest.json'
+DEFAULT_SHARDS = 4
+
+
+def default_input():
+    """Path of the input data, gzip-ed version is preferred as in sphinx.conf."""
+    if isfile(DATA_INPUT + '.gz'):
+        return DATA_INPUT + '.gz'
+    return DATA_INPUT
+
+
+def open_input(filename):
+    """Open input data, optionally gzip-ed."""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def iter_rows(filename=None):
+    """
+    Iterate over valid rows of the input data.
+
+    Header is skipped, carriage returns are replaced by space and rows
+    without 24 columns are skipped. Document id is the line number.
+    Yield (document id, list of columns)
+    """
+    if filename is None:
+        filename = default_input()
+    ncols = len(COLUMNS)
+    f = open_input(filename)
+    try:
+        nr = 0
+        for line in f:
+            nr += 1
+            if nr == 1:
+                continue
+            cols = line.rstrip('\n').replace('\r', ' ').split('\t')
+            if len(cols) != ncols:
+                continue
+            yield nr, cols
+    finally:
+        f.close()
+
+
+def parse_float(value):
+    """Parse float attribute, invalid values are 0 as in sphinx."""
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+
+# -----------------------------------------------------------------------------
+def shard_file(output_dir, shard):
+    return join(output_dir, 'data_{}.tsv'.format(shard))
+
+
+def input_signature(filename):
+    """Size and modification time of the input, shards are valid for it."""
+    st = stat(filename)
+    return {'input': filename, 'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def load_manifest(output_dir=SHARD_DIR, shards=DEFAULT_SHARDS, filename=None, docstore=None):
+    """
+    Manifest of the shards, None if missing or outdated, any shards if None.
+    The docstore, if given, must be written with the shards.
+    """
+    if filename is None:
+        filename = default_input()
+    try:
+        with open(join(output_dir, SHARD_MANIFEST), 'rb') as f:
+            manifest = load(f)
+        signature = input_signature(filename)
+    except (IOError, OSError, ValueError):
+        return None
+    for key, value in signature.iteritems():
+        if manifest.get(key) != value:
+            return None
+    if shards is not None and manifest.get('shards') != shards:
+        return None
+    if not all(isfile(name) for name in manifest['files']):
+        return None
+    if docstore is not None and (manifest.get('docstore') != docstore or not isfile(docstore)):
+        return None
+    return manifest
+
+
+def iter_keys(filename=None, output_dir=SHARD_DIR):
+    """
+    Iterate over (document id, osm_type, osm_id) of valid rows, read from
+    the shards if they are up to date.
+    """
+    if filename is None:
+        filename = default_input()
+    manifest = load_manifest(output_dir, None, filename)
+    if manifest is None:
+        for nr, cols in iter_rows(filename):
+            yield nr, cols[2], cols[3]
+        return
+    for name in manifest['files']:
+        with open(name, 'rb', 1 << 20) as f:
+            for line in f:
+                nr, name, alternative_names, osm_type, osm_id, rest = line.split('\t', 5)
+                yield int(nr), osm_type, osm_id
+
+
+def shard(filename, output_dir=SHARD_DIR, shards=DEFAULT_SHARDS, docstore=None):
+    """
+    Split the input into shards in a single pass, return the manifest.
+
+    Each row is validated and numbered as in iter_rows, row with line number
+    NR is written as 'NR<tab>columns' into shard NR % shards, the same shard
+    the gawk filter of the tsvpipe sources would select. Columns of the
+    docstore are written into the docstore file, if given.
+    """
+    if not isdir(output_dir):
+        makedirs(output_dir)
+    manifest = input_signature(filename)
+    # Decompression runs in a separate process, in parallel with sharding
+    proc = None
+    if filename.endswith('.gz'):
+        proc = subprocess.Popen(['gzip', '-c', '-d', filename],
+                                stdout=subprocess.PIPE, bufsize=1 << 20)
+        f = proc.stdout
+    else:
+        f = open(filename, 'rb', 1 << 20)
+    files = [shard_file(output_dir, i) for i in range(shards)]
+    outputs = [open(name + '.tmp', 'wb', 1 << 20) for name in files]
+    rows = [0] * shards
+    rejected = []
+    ntabs = len(COLUMNS) - 1
+    writer = None
+    if docstore is not None:
+        writer = DocStoreWriter(docstore)
+        docstore_cols = [COLUMN_INDEX[col] for col in DOCSTORE_COLUMNS]
+    try:
+        nr = 0
+        for line in f:
+            nr += 1
+            if nr == 1:
+                continue
+            if line.count('\t') != ntabs:
+                rejected.append(nr)
+                continue
+            if '\r' in line:
+                line = line.replace('\r', ' ')
+            if line[-1:] != '\n':
+                line += '\n'
+            i = nr % shards
+            outputs[i].write('{}\t{}'.format(nr, line))
+            rows[i] += 1
+            if writer is not None:
+                cols = line[:-1].split('\t')
+                writer.add(nr, [cols[col] for col in docstore_cols])
+    finally:
+        f.close()
+        for output in outputs:
+            output.close()
+    if proc is not None and proc.wait() != 0:
+        for name in files:
+            remove(name + '.tmp')
+        if writer is not None:
+            writer.abort()
+        raise IOError('Decompression of {} failed'.format(filename))
+    for name in files:
+        rename(name + '.tmp', name)
+    if writer is not None:
+        writer.close()
+
+    manifest.update({
+        'shards': shards,
+        'files': files,
+        'rows': rows,
+        'rejected': len(rejected),
+        'rejected_lines': rejected[:100],
+        'docstore': docstore,
+    })
+    tmp_file = join(output_dir, SHARD_MANIFEST + '.tmp')
+    with open(tmp_file, 'wb') as f:
+        dump(manifest, f, indent=1)
+    rename(tmp_file, join(output_dir, SHARD_MANIFEST))
+    return manifest
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split input data into shards of the local indexes.')
+    parser.add_argument('--shards', type=int, default=DEFAULT_SHARDS,
+                        help='number of shards, LOCAL_INDEX_THREADS of sphinx.conf')
+    parser.add_argument('--output-dir', default=SHARD_DIR,
+                        help='directory of the shard files and manifest')
+    parser.add_argument('--docstore',
+                        help='write the docstore of wide string attributes, see docstore.py')
+    parser.add_argument('--force', action='store_true',
+                        help='split the input even if the shards are up to date')
+    parser.add_argument('input', nargs='?', help='input data.tsv[.gz]')
+    args = parser.parse_args()
+
+    filename = args.input or default_input()
+    manifest = None
+    if not args.force:
+        manifest = load_manifest(args.output_dir, args.shards, filename, args.docstore)
+        if manifest is not None:
+            print('Shards of {} are up to date'.format(filename))
+    if manifest is None:
+        manifest = shard(filename, args.output_dir, args.shards, args.docstore)
+    print('Input {} split into {} shards with {} rows, {} rows rejected'.format(
+        filename, manifest['shards'], sum(manifest['rows']), manifest['rejected']))
+    if manifest['rejected']:
+        print('Rejected lines (without {} columns): {}'.format(
+            len(COLUMNS), ' '.join(str(nr) for nr in manifest['rejected_lines'])))
+    sys.exit(0 if sum(manifest['rows']) > 0 else 1)
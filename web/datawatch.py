@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Watcher of the data timestamp of OSMNames-SphinxSearch
+#
+# Background thread waits for changes of the file with inotify, or polls
+# its modification time where inotify is not available, and reports new
+# modification time to the callback.
+
+from os import path
+from threading import Thread
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import time
+import traceback
+
+
+# inotify constants, see <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+def inotify_watch(directory, mask=IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+    """Inotify descriptor watching the directory, None if not available."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, directory, mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def get_mtime(filename):
+    try:
+        return path.getmtime(filename)
+    except OSError:
+        return None
+
+
+class DataWatcher(Thread):
+    """
+    Daemon thread calling callback(mtime) when modification time of the file
+    changes.
+
+    With inotify, the modification time is checked on events in the directory
+    of the file and at least every max_interval seconds, otherwise it is
+    polled every interval seconds.
+    """
+
+    def __init__(self, filename, callback, mtime=None, interval=1.0, max_interval=60.0):
+        Thread.__init__(self, name='datawatch')
+        self.daemon = True
+        self.filename = filename
+        self.callback = callback
+        self.mtime = mtime
+        self.interval = interval
+        self.max_interval = max_interval
+        self.fd = None
+
+    def start(self):
+        self.fd = inotify_watch(path.dirname(path.abspath(self.filename)))
+        Thread.start(self)
+
+    def run(self):
+        while True:
+            self.check()
+            if self.fd is None:
+                time.sleep(self.interval)
+            else:
+                self.wait_events()
+
+    def wait_events(self):
+        """Wait for inotify events, all pending events are read."""
+        try:
+            ready = select.select([self.fd], [], [], self.max_interval)[0]
+        except select.error as ex:
+            if ex.args[0] == errno.EINTR:
+                return
+            raise
+        while ready:
+            try:
+                os.read(self.fd, 4096)
+            except OSError as ex:
+                if ex.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+        # Wait shortly for the rest of related events
+        if ready:
+            time.sleep(0.1)
+
+    def check(self):
+        mtime = get_mtime(self.filename)
+        if mtime is None or mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            self.callback(mtime)
+        except Exception:
+            traceback.print_exc()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Delta indexes of OSMNames-SphinxSearch
+#
+# Changed rows keyed by osm_type/osm_id are kept in the delta state, the
+# delta indexes of each local index thread are rebuilt from it. Changed rows
+# get new document ids above DELTA_ID_BASE, the superseded documents of the
+# main indexes are masked by the kill-lists of the delta indexes, which follow
+# the main indexes in the distributed indexes. Merge folds the delta indexes
+# into the main ones with indexer --merge.
+#
+# Changes are TSV with the action (add, change or delete) followed by the
+# columns of data.tsv, only osm_type and osm_id are required for delete.
+#
+# Usage: delta.py apply changes.tsv
+#        delta.py build | merge | rebase | status
+#        delta.py xmlpipe --shard 0 --shards 4
+
+from json import dump, load
+from os import getpid, listdir, makedirs, remove, rename, utime
+from os.path import dirname, isdir, isfile
+from time import sleep, time
+from xml.sax.saxutils import escape
+import argparse
+import fcntl
+import re
+import sys
+
+from datainput import COLUMNS, COLUMN_INDEX, default_input, input_signature, iter_keys
+import indexjobs
+
+
+DELTA_STATE = '/data/index/delta/state.json'
+DELTA_ID_BASE = 1000000000
+DATA_TIMESTAMP = '/tmp/osmnames-sphinxsearch-data.timestamp'
+ACTIONS = ('add', 'change', 'delete')
+ROTATE_TIMEOUT = 300
+
+# Characters not allowed in XML
+INVALID_XML = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def row_key(osm_type, osm_id):
+    return u'{}/{}'.format(osm_type, osm_id)
+
+
+def new_state(filename):
+    state = input_signature(filename)
+    state.update({'next_id': DELTA_ID_BASE, 'records': {}})
+    return state
+
+
+def load_state(filename=None):
+    """Delta state, None if there are no deltas."""
+    filename = filename or DELTA_STATE
+    if not isfile(filename):
+        return None
+    with open(filename, 'rb') as f:
+        return load(f)
+
+
+def documents(state):
+    """Rows of the delta documents by document id, merged documents included."""
+    rows = {}
+    records = state['records'] if state is not None else {}
+    for record in records.itervalues():
+        if record['id'] is not None and record['row'] is not None:
+            rows[record['id']] = record['row']
+    return rows
+
+
+def killed_ids(state):
+    """Documents of the main indexes and merged deltas masked by the kill-lists."""
+    killed = set()
+    records = state['records'] if state is not None else {}
+    for record in records.itervalues():
+        killed.update(record['main'])
+        killed.update(record['superseded'])
+    return killed
+
+
+def save_state(state, filename=None):
+    filename = filename or DELTA_STATE
+    if not isdir(dirname(filename)):
+        makedirs(dirname(filename))
+    tmp_file = '{}.{}.tmp'.format(filename, getpid())
+    with open(tmp_file, 'wb') as f:
+        dump(state, f)
+    rename(tmp_file, filename)
+
+
+def lock_state(filename=None):
+    """Exclusive lock of the delta state, released when the file is closed."""
+    filename = filename or DELTA_STATE
+    if not isdir(dirname(filename)):
+        makedirs(dirname(filename))
+    f = open(filename + '.lock', 'a')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+
+def input_changed(state, filename):
+    signature = input_signature(filename)
+    return any(state.get(key) != value for key, value in signature.iteritems())
+
+
+# -----------------------------------------------------------------------------
+def parse_changes(lines):
+    """
+    Parse the changes, return (changes, rejected line numbers).
+
+    Change is (action, key, row), the row is None for delete.
+    """
+    changes = []
+    rejected = []
+    col_osm_type = COLUMN_INDEX['osm_type'] + 1
+    col_osm_id = COLUMN_INDEX['osm_id'] + 1
+    for nr, line in enumerate(lines, 1):
+        cols = line.rstrip('\n').replace('\r', ' ').split('\t')
+        if nr == 1 and cols[0] == 'action':
+            continue
+        action = cols[0]
+        if action not in ACTIONS or len(cols) <= col_osm_id:
+            rejected.append(nr)
+            continue
+        key = row_key(cols[col_osm_type].decode('utf-8', 'replace'),
+                      cols[col_osm_id].decode('utf-8', 'replace'))
+        if action == 'delete':
+            changes.append((action, key, None))
+        elif len(cols) == len(COLUMNS) + 1:
+            changes.append((action, key, [col.decode('utf-8', 'replace') for col in cols[1:]]))
+        else:
+            rejected.append(nr)
+    return changes, rejected
+
+
+def find_main_ids(keys, filename=None):
+    """Document ids of the rows of the input data with the keys."""
+    found = {}
+    for doc_id, osm_type, osm_id in iter_keys(filename):
+        key = row_key(osm_type.decode('utf-8', 'replace'), osm_id.decode('utf-8', 'replace'))
+        if key in keys:
+            found.setdefault(key, []).append(doc_id)
+    return found
+
+
+def apply_changes(state, changes, filename=None):
+    """Apply the changes to the state, return counts of the actions."""
+    records = state['records']
+    new_keys = set(key for action, key, row in changes if key not in records)
+    main_ids = find_main_ids(new_keys, filename) if new_keys else {}
+    counts = dict((action, 0) for action in ACTIONS)
+    counts['unknown'] = 0
+    for action, key, row in changes:
+        record = records.get(key)
+        if record is None:
+            main = main_ids.get(key, [])
+            if row is None and not main:
+                counts['unknown'] += 1
+                continue
+            record = records[key] = {
+                'row': None, 'id': None, 'main': main,
+                'superseded': [], 'pending': True,
+            }
+        elif not record['pending']:
+            # Document of the merged delta is superseded in the main index
+            if record['id'] is not None:
+                record['superseded'].append(record['id'])
+            record['id'] = None
+            record['pending'] = True
+        record['row'] = row
+        if row is None:
+            record['id'] = None
+        elif record['id'] is None:
+            record['id'] = state['next_id']
+            state['next_id'] += 1
+        counts[action] += 1
+    return counts
+
+
+def write_xmlpipe(state, shard, shards, out):
+    """Write xmlpipe2 documents and kill-list of the delta index of the shard."""
+    out.write('<?xml version="1.0" encoding="utf-8"?>\n<sphinx:docset>\n')
+    killed = set()
+    records = state['records'] if state is not None else {}
+    for key in sorted(records):
+        record = records[key]
+        # Kill-lists mask superseded documents even after the merge
+        for doc_id in record['main'] + record['superseded']:
+            if doc_id % shards == shard:
+                killed.add(doc_id)
+        if not record['pending'] or record['row'] is None or record['id'] % shards != shard:
+            continue
+        out.write('<sphinx:document id="{}">\n'.format(record['id']))
+        for col, value in zip(COLUMNS, record['row']):
+            value = escape(INVALID_XML.sub(u' ', value)).encode('utf-8')
+            out.write('<{0}>{1}</{0}>\n'.format(col, value))
+        out.write('</sphinx:document>\n')
+    if killed:
+        out.write('<sphinx:killlist>\n')
+        for doc_id in sorted(killed):
+            out.write('<id>{}</id>\n'.format(doc_id))
+        out.write('</sphinx:killlist>\n')
+    out.write('</sphinx:docset>\n')
+
+
+# -----------------------------------------------------------------------------
+def run_indexers(jobs, config_text, parallel):
+    """Run the indexer jobs and rotate them, return False if any failed."""
+    indexjobs.run_jobs(jobs, parallel)
+    if any(job.failed for job in jobs):
+        indexjobs.remove_new_files(jobs)
+        return False
+    if indexjobs.rotate(config_text):
+        wait_rotated(jobs)
+    return True
+
+
+def wait_rotated(jobs, timeout=ROTATE_TIMEOUT):
+    """Wait until searchd rotates the new index files."""
+    deadline = time() + timeout
+    while time() < deadline:
+        pending = False
+        for job in jobs:
+            directory, prefix = job.path.rsplit('/', 1)
+            if any(name.startswith(prefix + '.new.') for name in listdir(directory)):
+                pending = True
+                break
+        if not pending:
+            return True
+        sleep(1)
+    indexjobs.log('Rotation of the indexes did not finish in {} s'.format(timeout))
+    return False
+
+
+def delta_jobs(config, indexer, config_text):
+    return [indexjobs.IndexJob(name, path, config, indexer)
+            for name, path in indexjobs.local_indexes(config_text)
+            if '_delta_' in name]
+
+
+def build(config, indexer, parallel):
+    """Rebuild the delta indexes from the state, publish the new data version."""
+    config_text = indexjobs.read_config(config)
+    jobs = delta_jobs(config, indexer, config_text)
+    indexjobs.log('Building {} delta indexes'.format(len(jobs)))
+    if not run_indexers(jobs, config_text, parallel):
+        return False
+    touch_data_timestamp()
+    return True
+
+
+def merge(config, indexer, parallel):
+    """Merge the delta indexes into the main ones, then rebuild empty deltas."""
+    config_text = indexjobs.read_config(config)
+    paths = dict(indexjobs.local_indexes(config_text))
+    jobs = []
+    for name in sorted(paths):
+        if '_delta_' not in name:
+            continue
+        main = name.replace('_delta_', '_')
+        if main in paths:
+            jobs.append(indexjobs.IndexJob(main, paths[main], config, indexer,
+                                           ['--merge', main, name]))
+    indexjobs.log('Merging {} delta indexes'.format(len(jobs)))
+    if not run_indexers(jobs, config_text, parallel):
+        return False
+    state = load_state()
+    for record in state['records'].itervalues():
+        record['pending'] = False
+    save_state(state)
+    return build(config, indexer, parallel)
+
+
+def rebase(filename):
+    """
+    Prepare the state for the full reindex. Deltas of the same input data
+    are indexed again, deltas are dropped if the input data changed.
+    """
+    state = load_state()
+    if state is None:
+        return 'no deltas'
+    if input_changed(state, filename):
+        remove(DELTA_STATE)
+        return 'input data changed, deltas dropped'
+    for record in state['records'].itervalues():
+        record['superseded'] = []
+        record['pending'] = True
+    save_state(state)
+    return 'deltas of {} rows kept'.format(len(state['records']))
+
+
+def touch_data_timestamp():
+    """Web workers clear their caches once the data timestamp changes."""
+    with open(DATA_TIMESTAMP, 'a'):
+        utime(DATA_TIMESTAMP, None)
+
+
+def status(state):
+    if state is None:
+        return 'No deltas'
+    records = state['records'].values()
+    pending = [record for record in records if record['pending']]
+    return '{} changed rows, {} pending ({} deleted), {} merged'.format(
+        len(records), len(pending),
+        sum(1 for record in pending if record['row'] is None),
+        len(records) - len(pending))
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delta indexes of changed rows.')
+    parser.add_argument('--config', default=indexjobs.CONFIG, help='sphinx config')
+    parser.add_argument('--indexer', default=indexjobs.INDEXER, help='indexer binary')
+    parser.add_argument('--jobs', type=int, help='parallel indexers, indexer_jobs of the plan by default')
+    parser.add_argument('--input', help='input data.tsv[.gz]')
+    commands = parser.add_subparsers(dest='command')
+    apply_parser = commands.add_parser('apply', help='apply changes and build the delta indexes')
+    apply_parser.add_argument('changes', help='changes TSV, - for stdin')
+    apply_parser.add_argument('--no-build', action='store_true', help='only update the delta state')
+    commands.add_parser('build', help='rebuild the delta indexes')
+    commands.add_parser('merge', help='merge the delta indexes into the main indexes')
+    commands.add_parser('rebase', help='prepare the deltas for the full reindex')
+    commands.add_parser('status', help='print the delta state')
+    xmlpipe_parser = commands.add_parser('xmlpipe', help='xmlpipe2 source of the delta index')
+    xmlpipe_parser.add_argument('--shard', type=int, required=True)
+    xmlpipe_parser.add_argument('--shards', type=int, required=True)
+    args = parser.parse_args()
+
+    filename = args.input or default_input()
+    parallel = args.jobs or indexjobs.default_jobs()
+
+    if args.command == 'xmlpipe':
+        write_xmlpipe(load_state(), args.shard, args.shards, sys.stdout)
+        sys.exit(0)
+    if args.command == 'status':
+        print(status(load_state()))
+        sys.exit(0)
+
+    with lock_state():
+        if args.command == 'rebase':
+            print('Delta rebase: ' + rebase(filename))
+            sys.exit(0)
+        state = load_state()
+        if args.command == 'apply':
+            if state is None:
+                state = new_state(filename)
+            elif input_changed(state, filename):
+                print('Input data changed since the deltas were started, reindex first')
+                sys.exit(1)
+            with (sys.stdin if args.changes == '-' else open(args.changes, 'rb')) as f:
+                changes, rejected = parse_changes(f)
+            counts = apply_changes(state, changes, filename)
+            save_state(state)
+            print('Applied {add} added, {change} changed, {delete} deleted rows, '
+                  '{unknown} unknown rows skipped'.format(**counts))
+            if rejected:
+                print('Rejected lines: ' + ' '.join(str(nr) for nr in rejected[:100]))
+            if args.no_build:
+                sys.exit(0)
+            ok = build(args.config, args.indexer, parallel)
+        elif state is None:
+            print('No deltas')
+            sys.exit(0)
+        elif args.command == 'build':
+            ok = build(args.config, args.indexer, parallel)
+        else:
+            ok = merge(args.config, args.indexer, parallel)
+    print(status(load_state()))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Document store of wide string attributes of OSMNames-SphinxSearch
+#
+# Wide string columns (display_name, alternative_names, wikidata, wikipedia,
+# housenumbers) of each row are written once at index time, keyed by the
+# document id, and memory-mapped by the web workers. Indexes built with the
+# reduced schema of sphinx.conf leave these attributes out, the final page
+# of the results is hydrated from the docstore.
+#
+# Usage: docstore.py [docstore] [--get id ...]
+
+from array import array
+from os import remove, rename
+import argparse
+import mmap
+import struct
+import sys
+
+
+MAGIC = 'OSMNDOCS'
+VERSION = 1
+DOCSTORE_FILE = '/data/index/docstore.bin'
+
+# Columns of the docstore, left out of the indexes with the reduced schema
+DOCSTORE_COLUMNS = ['alternative_names', 'display_name', 'wikidata', 'wikipedia',
+                    'housenumbers']
+
+# magic, version, number of ids, offsets position, column names size
+HEADER = struct.Struct('<8sIQQI')
+OFFSET = struct.Struct('<Q')
+# Offsets are collected in array of unsigned long, 64 bits on the 64-bit platforms
+OFFSET_TYPE = 'L'
+
+
+# -----------------------------------------------------------------------------
+class DocStoreWriter(object):
+    """
+    Writer of the docstore, documents are added in ascending order of ids.
+
+    Values of the document are joined by tab, the record of document id N
+    spans from offset N to offset N + 1, ids without document are empty.
+    """
+
+    def __init__(self, filename, columns=DOCSTORE_COLUMNS):
+        self.filename = filename
+        self.names = '\t'.join(columns)
+        self.f = open(filename + '.tmp', 'wb', 1 << 20)
+        self.f.write(HEADER.pack(MAGIC, VERSION, 0, 0, len(self.names)))
+        self.f.write(self.names)
+        self.offsets = array(OFFSET_TYPE, [0])
+        self.pos = 0
+
+    def add(self, doc_id, values):
+        """Add the document, values are utf-8 strings of the columns."""
+        if doc_id < len(self.offsets) - 1:
+            raise ValueError('Document {} added out of order'.format(doc_id))
+        while len(self.offsets) <= doc_id:
+            self.offsets.append(self.pos)
+        record = '\t'.join(values)
+        self.f.write(record)
+        self.pos += len(record)
+        self.offsets.append(self.pos)
+
+    def close(self):
+        """Write the offsets of the ids and rename the docstore."""
+        offsets_pos = self.f.tell()
+        if self.offsets.itemsize != OFFSET.size:
+            raise ValueError('Offsets of {} bytes are not supported'.format(self.offsets.itemsize))
+        if sys.byteorder != 'little':
+            self.offsets.byteswap()
+        self.offsets.tofile(self.f)
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, VERSION, len(self.offsets) - 1, offsets_pos,
+                                 len(self.names)))
+        self.f.close()
+        rename(self.filename + '.tmp', self.filename)
+
+    def abort(self):
+        self.f.close()
+        remove(self.filename + '.tmp')
+
+
+# -----------------------------------------------------------------------------
+class DocStore(object):
+    """Memory-mapped docstore, answering wide string attributes of document ids."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.n_ids, self.offsets_pos, names_size = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Invalid docstore file ' + filename)
+        self.columns = self.mm[HEADER.size:HEADER.size + names_size].split('\t')
+        self.data_pos = HEADER.size + names_size
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return self.n_ids
+
+    def get(self, doc_id):
+        """Dict of the attributes (utf-8) of the document, None if missing."""
+        if doc_id < 0 or doc_id >= self.n_ids:
+            return None
+        pos = self.offsets_pos + OFFSET.size * doc_id
+        first = OFFSET.unpack_from(self.mm, pos)[0]
+        last = OFFSET.unpack_from(self.mm, pos + OFFSET.size)[0]
+        if first == last:
+            return None
+        values = self.mm[self.data_pos + first:self.data_pos + last].split('\t')
+        return dict(zip(self.columns, values))
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show documents of the docstore, written by datainput.py --docstore.')
+    parser.add_argument('--get', type=int, nargs='*', default=[], help='document ids')
+    parser.add_argument('docstore', nargs='?', default=DOCSTORE_FILE, help='docstore file')
+    args = parser.parse_args()
+
+    store = DocStore(args.docstore)
+    print('Docstore {} with columns {} of {} ids'.format(
+        args.docstore, ', '.join(store.columns), len(store)))
+    for doc_id in args.get:
+        print('{}\t{}'.format(doc_id, store.get(doc_id)))
+    sys.exit(0)
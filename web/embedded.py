@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Embedded search backend of OSMNames-SphinxSearch
+#
+# In-process inverted index of the input data, answering the searches of
+# the web layer without indexer and searchd, for small regional extracts.
+# Index flavours follow the indexes in sphinx.conf: exact and prefix
+# indexes of name and alternative_names, prefix and infix with soundex
+# indexes of all full text fields and infix index of the postcodes.
+#
+# Usage: embedded.py [--index ind_name_prefix] [--input data.tsv] query
+
+from array import array
+from copy import copy
+from bisect import bisect_left, bisect_right
+from time import time
+import argparse
+import csv
+import glob
+import heapq
+import re
+import sys
+
+from datainput import COLUMNS, FLOAT_COLUMNS, default_input, iter_rows, parse_float
+from match import Match, get_columns
+from prefixtrie import split_words
+
+
+POSTCODE_FILES = '/data/input/postcodes-*.csv'
+POSTCODE_COLUMNS = ['postcode', 'lat', 'lon', 'importance', 'display_name', 'name',
+                    'type', 'west', 'south', 'east', 'north', 'place_rank',
+                    'country_code']
+
+# Same limits as the OPTION of the queries sent to searchd
+CUTOFF = 2000
+MAX_MATCHES = 200
+# Attributes with more distinct values are not validated, see attributes.py
+MAX_VALUES = 1000
+
+# Values repeated in many rows are stored once
+INTERNED_COLUMNS = ('osm_type', 'class', 'type', 'city', 'county', 'state',
+                    'country', 'country_code')
+FILTER_COLUMNS = ('class', 'type', 'street', 'city', 'county', 'state',
+                  'country_code', 'country')
+
+MIN_PREFIX_LEN = 2
+MIN_INFIX_LEN = 2
+# Rows of the other query groups are checked in a set up to this size
+MAX_ROW_SET = 200000
+
+# Query terms, optionally with wildcard, and OR operators
+QUERY_TOKEN = re.compile(r'(\w+)(\*?)|(\|)', re.UNICODE)
+ASCII_WORD = re.compile(r'[a-z0-9_]+')
+SOUNDEX_CODES = dict(zip(u'bfpvcgjkqsxzdtlmnr', u'111122222222334556'))
+
+
+def tokenize(text):
+    """Normalized words of the text, fast path for ascii texts."""
+    try:
+        text.decode('ascii')
+    except (UnicodeError, AttributeError):
+        return split_words(text)
+    return ASCII_WORD.findall(text.lower())
+
+
+def soundex(word):
+    """Soundex code of the word, words not starting with a letter are kept."""
+    if not word or not word[0].isalpha():
+        return word
+    code = [word[0]]
+    last = SOUNDEX_CODES.get(word[0])
+    for c in word[1:]:
+        digit = SOUNDEX_CODES.get(c)
+        if digit is not None and digit != last:
+            code.append(digit)
+            if len(code) == 4:
+                break
+        if c not in u'hw':
+            last = digit
+    return u''.join(code).ljust(4, u'0')
+
+
+def parse_query(query):
+    """
+    Parse the query of the web layer into terms of the extended syntax.
+
+    Return list of groups, all groups must match, group is list of
+    alternative (word, wildcard) terms joined by OR.
+    """
+    if isinstance(query, str):
+        query = query.decode('utf-8', 'replace')
+    groups = []
+    join = False
+    for word, wildcard, operator in QUERY_TOKEN.findall(query):
+        if operator:
+            join = bool(groups)
+            continue
+        for term in split_words(word):
+            if join:
+                groups[-1].append((term, bool(wildcard)))
+            else:
+                groups.append([(term, bool(wildcard))])
+            join = False
+    return groups
+
+
+def parse_field_weights(field_weights):
+    """Dict of 'name = 1000, alternative_names = 990' weights."""
+    weights = {}
+    for item in field_weights.split(','):
+        if '=' in item:
+            field, weight = item.split('=', 1)
+            weights[field.strip()] = int(weight)
+    return weights
+
+
+# -----------------------------------------------------------------------------
+class Documents(object):
+    """Rows of the attributes with their document ids."""
+
+    def __init__(self, columns):
+        self.columns = get_columns(tuple(columns))
+        self.column_index = dict((col, i) for i, col in enumerate(columns))
+        self.float_indexes = set(i for i, col in enumerate(columns) if col in FLOAT_COLUMNS)
+        self.interned_indexes = set(i for i, col in enumerate(columns) if col in INTERNED_COLUMNS)
+        self.ids = array('L')
+        self.rows = []
+
+    def add(self, doc_id, cols):
+        """Add the row of the string columns, return its number."""
+        row = []
+        for i, value in enumerate(cols):
+            if i in self.float_indexes:
+                value = parse_float(value)
+            elif i in self.interned_indexes:
+                value = intern(value)
+            row.append(value)
+        self.ids.append(doc_id)
+        self.rows.append(tuple(row))
+        return len(self.rows) - 1
+
+    def values(self, column, max_values=MAX_VALUES):
+        """Distinct values of the column, None if there are more than max_values."""
+        i = self.column_index[column]
+        values = set()
+        for row in self.rows:
+            values.add(row[i])
+            if len(values) > max_values:
+                return None
+        return frozenset(values)
+
+
+class TextIndex(object):
+    """
+    Inverted index of the full text fields of the documents.
+
+    Wildcard and infix terms are expanded over the sorted vocabulary,
+    prefix and infix expansion can be disabled as in sphinx.conf.
+    """
+
+    def __init__(self, documents, fields, prefix=False, infix=False):
+        self.documents = documents
+        self.fields = fields
+        self.field_indexes = [documents.column_index[field] for field in fields]
+        self.prefix = prefix
+        self.infix = infix
+        self.soundex = False
+        self.postings = {}
+        self.vocabulary = []
+        self.vocabulary_text = u''
+        self.vocabulary_offsets = array('L')
+        self.soundex_words = {}
+
+    def add(self, row_number, row):
+        words = set()
+        for i in self.field_indexes:
+            words.update(tokenize(row[i]))
+        for word in words:
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = array('L')
+            postings.append(row_number)
+
+    def finish(self):
+        """Prepare the vocabulary when all documents are added."""
+        self.vocabulary = sorted(self.postings)
+        # Words delimited by new lines, searched for infix terms
+        offsets = array('L')
+        offset = 1
+        for word in self.vocabulary:
+            offsets.append(offset)
+            offset += len(word) + 1
+        self.vocabulary_offsets = offsets
+        self.vocabulary_text = u'\n' + u'\n'.join(self.vocabulary) + u'\n'
+
+    def flavour(self, **options):
+        """Index sharing the postings and vocabulary, with other expansion of terms."""
+        index = copy(self)
+        index.prefix = options.get('prefix', False)
+        index.infix = options.get('infix', False)
+        index.soundex = options.get('soundex', False)
+        if index.soundex:
+            index.soundex_words = {}
+            for word in index.vocabulary:
+                index.soundex_words.setdefault(soundex(word), []).append(word)
+        return index
+
+    def expand(self, term, wildcard):
+        """Words of the vocabulary matching the term."""
+        words = set()
+        if term in self.postings:
+            words.add(term)
+        if self.infix and len(term) >= MIN_INFIX_LEN:
+            # Keywords are expanded to infixes as with expand_keywords
+            text = self.vocabulary_text
+            pos = text.find(term)
+            while pos >= 0:
+                i = bisect_right(self.vocabulary_offsets, pos) - 1
+                words.add(self.vocabulary[i])
+                # Continue after the found word
+                pos = text.find(term, self.vocabulary_offsets[i] + len(self.vocabulary[i]))
+        elif self.prefix and len(term) >= MIN_PREFIX_LEN:
+            first = bisect_left(self.vocabulary, term)
+            last = bisect_left(self.vocabulary, term + u'\uffff')
+            words.update(self.vocabulary[first:last])
+        if self.soundex:
+            words.update(self.soundex_words.get(soundex(term), ()))
+        return words
+
+    def candidates(self, words):
+        """Row numbers containing any of the words, in ascending order."""
+        postings = [self.postings[word] for word in words]
+        if len(postings) == 1:
+            return iter(postings[0])
+        return unique(heapq.merge(*postings))
+
+    def estimate(self, words):
+        return sum(len(self.postings[word]) for word in words)
+
+    def row_set(self, words):
+        """Set of row numbers containing any of the words."""
+        rows = set()
+        for word in words:
+            rows.update(self.postings[word])
+        return rows
+
+
+def unique(numbers):
+    last = None
+    for number in numbers:
+        if number != last:
+            yield number
+            last = number
+
+
+# -----------------------------------------------------------------------------
+class QueryGroup(object):
+    """Words of the vocabulary matching the group of the query."""
+
+    __slots__ = ('words', 'exact')
+
+    def __init__(self, index, terms):
+        self.words = set()
+        self.exact = set()
+        for term, wildcard in terms:
+            self.words.update(index.expand(term, wildcard))
+            self.exact.add(term)
+
+
+def rank_field(words, groups):
+    """
+    Rank of the field similar to the expression ranker of the web layer,
+    sum((10*lcs+5*exact_order+10*exact_hit+5*wlccs)*user_weight).
+    """
+    lcs = 0
+    runs = {}
+    order = 0
+    for word in words:
+        matched = {}
+        for g, group in enumerate(groups):
+            if word in group.words:
+                matched[g] = runs.get(g - 1, 0) + 1
+                lcs = max(lcs, matched[g])
+        if order < len(groups) and order in matched:
+            order += 1
+        runs = matched
+    exact_order = 1 if order == len(groups) else 0
+    exact_hit = 1 if (len(words) == len(groups) and
+                      all(word in group.exact for word, group in zip(words, groups))) else 0
+    return 10 * lcs + 5 * exact_order + 10 * exact_hit + 5 * lcs
+
+
+def filter_row(documents, row, query_filter):
+    """True if the row passes the attribute and viewbox filters."""
+    for f in FILTER_COLUMNS:
+        values = query_filter.get(f)
+        if values is None:
+            continue
+        i = documents.column_index.get(f)
+        if i is None or row[i] not in values:
+            return False
+    viewbox = query_filter.get('viewbox')
+    if viewbox is not None:
+        bbox = [float(value) for value in viewbox.split(',')]
+        lat = row[documents.column_index['lat']]
+        lon = row[documents.column_index['lon']]
+        if not (bbox[0] < lat < bbox[2] and bbox[1] < lon < bbox[3]):
+            return False
+    return True
+
+
+def sort_matches(matches, sort_by):
+    """Sort by the sortBy attributes ('city', 'importance-desc', ...)."""
+    for attr in reversed(sort_by):
+        attr = attr.split('-')
+        reverse = len(attr) > 1 and attr[1].lower() == 'desc'
+        if attr[0] == 'weight':
+            matches.sort(key=lambda match: match.weight, reverse=reverse)
+        elif attr[0] == 'id':
+            matches.sort(key=lambda match: match.id, reverse=reverse)
+        else:
+            matches.sort(key=lambda match: match.attr(attr[0]), reverse=reverse)
+    return matches
+
+
+# -----------------------------------------------------------------------------
+class EmbeddedIndex(object):
+    """Indexes of the input data, searched by the names of the sphinx indexes."""
+
+    def __init__(self, input_file=None, postcode_files=POSTCODE_FILES):
+        documents = Documents(COLUMNS)
+        name_fields = ('name', 'alternative_names')
+        names_fields = ('name', 'alternative_names', 'country_code', 'display_name')
+        name_index = TextIndex(documents, name_fields)
+        names_index = TextIndex(documents, names_fields)
+        for doc_id, cols in iter_rows(input_file or default_input()):
+            row_number = documents.add(doc_id, cols)
+            row = documents.rows[row_number]
+            name_index.add(row_number, row)
+            names_index.add(row_number, row)
+        name_index.finish()
+        names_index.finish()
+        self.documents = documents
+        # Flavours of the indexes differ only in the expansion of terms
+        self.indexes = {
+            'ind_name_exact': name_index,
+            'ind_name_prefix': name_index.flavour(prefix=True),
+            'ind_names_prefix': names_index.flavour(prefix=True),
+            'ind_names_infix_soundex': names_index.flavour(infix=True, soundex=True),
+        }
+
+        postcodes = Documents(POSTCODE_COLUMNS)
+        postcodes_infix = TextIndex(postcodes, ('postcode', ), infix=True)
+        for filename in sorted(glob.glob(postcode_files or '')):
+            m = re.search(r'postcodes-([a-z]{2})\.csv$', filename)
+            if m:
+                self.add_postcodes(postcodes, postcodes_infix, filename, m.group(1))
+        if postcodes.rows:
+            postcodes_infix.finish()
+            self.indexes['ind_postcodes_infix'] = postcodes_infix
+
+    def add_postcodes(self, postcodes, index, filename, country_code):
+        """Add rows of the postcodes CSV (id, postcode, lat, lon) as the postcodes source does."""
+        with open(filename, 'rb') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for cols in reader:
+                if len(cols) != 4:
+                    continue
+                doc_id, postcode, lat, lon = cols
+                row_number = postcodes.add(int(doc_id), [
+                    postcode, lat, lon, '1.0', postcode, postcode, 'postcode',
+                    lon, lat, lon, lat, '20.0', country_code])
+                index.add(row_number, postcodes.rows[row_number])
+
+    def __len__(self):
+        return len(self.documents.rows)
+
+    def attribute_values(self, attributes):
+        """Distinct values of the attributes, dict[ attribute ] = frozenset(values)."""
+        values = {}
+        for attr in attributes:
+            found = self.documents.values(attr)
+            if found:
+                values[attr] = found
+        return values
+
+    def search(self, index_name, query, query_filter, start=0, count=20, field_weights='',
+               max_matches=MAX_MATCHES, cutoff=CUTOFF):
+        """
+        Search the index as searchd does for the web layer.
+
+        Return dict with matches of the page and total_found, or with
+        message if the index does not exist.
+        """
+        index = self.indexes.get(index_name)
+        if index is None:
+            return {'matches': [], 'total_found': 0, 'status': False,
+                    'message': 'unknown local index(es) in search request: ' + index_name}
+        groups = [QueryGroup(index, terms) for terms in parse_query(query)]
+        if not groups or not all(group.words for group in groups):
+            return {'matches': [], 'total_found': 0}
+
+        documents = index.documents
+        weights = parse_field_weights(field_weights)
+        fields = [(i, weights.get(field, 1))
+                  for field, i in zip(index.fields, index.field_indexes)]
+        importance_index = documents.column_index['importance']
+        columns = documents.columns
+        has_filter = any(value is not None for value in query_filter.itervalues())
+
+        # Candidates of the most selective group, other groups are checked on the rows
+        groups.sort(key=lambda group: index.estimate(group.words))
+        row_sets = [index.row_set(group.words) for group in groups[1:]
+                    if index.estimate(group.words) <= MAX_ROW_SET]
+        checked_groups = groups[1 + len(row_sets):]
+        matches = []
+        for row_number in index.candidates(groups[0].words):
+            if row_sets and not all(row_number in rows for rows in row_sets):
+                continue
+            row = documents.rows[row_number]
+            if has_filter and not filter_row(documents, row, query_filter):
+                continue
+            field_words = [(tokenize(row[i]), weight) for i, weight in fields]
+            ok = True
+            for group in checked_groups:
+                if not any(not group.words.isdisjoint(words) for words, weight in field_words):
+                    ok = False
+                    break
+            if not ok:
+                continue
+
+            rank = 0
+            exact = 0
+            for words, weight in field_words:
+                rank += rank_field(words, groups) * weight
+            for group in groups:
+                if any(not group.exact.isdisjoint(words) for words, weight in field_words):
+                    exact += 1
+            # BM25 is approximated by the share of exactly matched groups
+            weight = (rank * 1000 + 999 * exact // len(groups)) * row[importance_index]
+            matches.append(Match(documents.ids[row_number], weight, row, columns))
+            if len(matches) >= cutoff:
+                break
+
+        total_found = len(matches)
+        sort_by = query_filter.get('sortBy')
+        if sort_by:
+            matches = sort_matches(matches, sort_by)[:max_matches]
+        else:
+            matches = heapq.nsmallest(max_matches, matches,
+                                      key=lambda match: (-match.weight, match.id))
+        return {'matches': matches[start:start + count], 'total_found': total_found}
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search the input data with the embedded backend.')
+    parser.add_argument('--index', default='ind_name_prefix', help='name of the index')
+    parser.add_argument('--input', help='input data.tsv[.gz]')
+    parser.add_argument('--postcodes', default=POSTCODE_FILES, help='postcodes CSV files')
+    parser.add_argument('--count', type=int, default=20, help='number of matches')
+    parser.add_argument('query', help='query')
+    args = parser.parse_args()
+
+    started = time()
+    embedded = EmbeddedIndex(args.input, args.postcodes)
+    print('Loaded {} rows in {:.1f}s'.format(len(embedded), time() - started))
+    started = time()
+    result = embedded.search(args.index, args.query, {}, 0, args.count)
+    elapsed = time() - started
+    for match in result['matches']:
+        print('{:>10} {:>14.1f} {}'.format(match.id, match.weight, match.attr('display_name')))
+    print('Found {} in {:.2f}ms'.format(result['total_found'], elapsed * 1000))
+    sys.exit(0)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Parallel indexer of OSMNames-SphinxSearch
+#
+# Local indexes of sphinx.conf are built by several indexer processes at once,
+# each indexing one index with --rotate --nohup. Output of the indexers is
+# prefixed by the index name, progress is reported in intervals. searchd
+# rotates the new indexes once all of them were built, new index files are
+# removed if any indexer failed.
+#
+# Usage: indexjobs.py [--jobs 4] [--config sphinx.conf] [index ...]
+
+from json import load
+from os import kill, listdir, remove
+from os.path import join
+from threading import Lock, Thread
+from time import time
+import argparse
+import errno
+import re
+import signal
+import subprocess
+import sys
+
+
+CONFIG = '/etc/sphinxsearch/sphinx.conf'
+INDEXER = '/usr/bin/indexer'
+PLAN_FILE = '/data/index/plan.json'
+DEFAULT_JOBS = 1
+PROGRESS_INTERVAL = 30
+
+INDEX_BLOCK = re.compile(r'^index\s+(\w+)(?:\s*:\s*\w+)?\s*\{(.*?)^\}', re.M | re.S)
+INDEX_OPTION = re.compile(r'^\s*(\w+)\s*=\s*(.*?)\s*$', re.M)
+# Progress lines of the indexer, rewritten in place with carriage return
+PROGRESS = re.compile(r'^(collected|sorted|processed) ')
+
+# Indexes of the larger families first, the longest jobs should start early
+FAMILY_ORDER = ['ind_names_infix_soundex', 'ind_names_prefix', 'ind_name_prefix',
+                'ind_name_exact', 'ind_postcodes_infix']
+
+OUTPUT_LOCK = Lock()
+
+
+def log(message):
+    with OUTPUT_LOCK:
+        print(message)
+        sys.stdout.flush()
+
+
+def read_config(config):
+    """Text of the config, config starting with python shebang is executed."""
+    with open(config) as f:
+        text = f.read()
+    if text.startswith('#!') and 'python' in text.split('\n', 1)[0]:
+        text = subprocess.check_output([sys.executable, config])
+    return text
+
+
+def local_indexes(text):
+    """Return list of (name, path) of local indexes with source in the config."""
+    indexes = []
+    for name, body in INDEX_BLOCK.findall(text):
+        options = dict(INDEX_OPTION.findall(body))
+        if 'source' in options and 'path' in options:
+            indexes.append((name, options['path']))
+    return indexes
+
+
+def family_rank(name):
+    for i, family in enumerate(FAMILY_ORDER):
+        if name.startswith(family + '_'):
+            return i
+    return len(FAMILY_ORDER)
+
+
+# -----------------------------------------------------------------------------
+class IndexJob(object):
+    """Indexer process of one index, output is streamed into the log."""
+
+    def __init__(self, name, path, config, indexer=INDEXER, args=None):
+        self.name = name
+        self.path = path
+        self.command = [indexer, '-c', config, '--rotate', '--nohup'] + (args or [name])
+        self.rc = None
+        self.elapsed = None
+        self.last_progress = 0
+
+    def output(self, line):
+        line = line.strip()
+        if not line:
+            return
+        if PROGRESS.match(line):
+            now = time()
+            if now - self.last_progress < PROGRESS_INTERVAL:
+                return
+            self.last_progress = now
+        log('[{}] {}'.format(self.name, line))
+
+    def run(self):
+        started = time()
+        log('[{}] started'.format(self.name))
+        proc = subprocess.Popen(self.command, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        # Lines are terminated by newline or carriage return of the progress
+        pending = ''
+        for chunk in iter(lambda: proc.stdout.read(4096), ''):
+            lines = re.split(r'[\r\n]', pending + chunk)
+            pending = lines.pop()
+            for line in lines:
+                self.output(line)
+        self.output(pending)
+        self.rc = proc.wait()
+        self.elapsed = time() - started
+        log('[{}] finished with rc {} in {:.1f} s'.format(self.name, self.rc, self.elapsed))
+
+    @property
+    def failed(self):
+        # indexer exits with 1 on errors, 2 on warnings
+        return self.rc is None or self.rc == 1
+
+
+def run_jobs(jobs, parallel):
+    """Run the jobs, at most parallel at once. New jobs stop after a failure."""
+    queue = list(jobs)
+    queue_lock = Lock()
+
+    def worker():
+        while True:
+            with queue_lock:
+                if not queue or any(job.failed for job in jobs if job.elapsed is not None):
+                    return
+                job = queue.pop(0)
+            try:
+                job.run()
+            except OSError as ex:
+                log('[{}] failed: {}'.format(job.name, ex))
+                job.elapsed = 0.0
+
+    threads = [Thread(target=worker) for i in range(max(1, parallel))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def remove_new_files(jobs):
+    """Remove the new index files, the failed reindex is not rotated."""
+    for job in jobs:
+        directory, prefix = job.path.rsplit('/', 1)
+        try:
+            names = listdir(directory)
+        except OSError:
+            continue
+        for name in names:
+            if name.startswith(prefix + '.new.'):
+                remove(join(directory, name))
+
+
+def rotate(config_text):
+    """Signal searchd to rotate the new indexes, return False if not running."""
+    m = re.search(r'^\s*pid_file\s*=\s*(\S+)', config_text, re.M)
+    if not m:
+        return False
+    try:
+        with open(m.group(1)) as f:
+            pid = int(f.read().strip())
+        kill(pid, signal.SIGHUP)
+    except (IOError, ValueError):
+        return False
+    except OSError as ex:
+        if ex.errno == errno.ESRCH:
+            return False
+        raise
+    return True
+
+
+def default_jobs():
+    """Parallel indexer jobs of the plan made by sphinx.conf --plan."""
+    try:
+        with open(PLAN_FILE) as f:
+            return int(load(f).get('indexer_jobs', DEFAULT_JOBS))
+    except (IOError, ValueError):
+        return DEFAULT_JOBS
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build local indexes with parallel indexers.')
+    parser.add_argument('--config', default=CONFIG, help='sphinx config')
+    parser.add_argument('--indexer', default=INDEXER, help='indexer binary')
+    parser.add_argument('--jobs', type=int, help='parallel indexers, indexer_jobs of the plan by default')
+    parser.add_argument('--dry-run', action='store_true', help='print the jobs only')
+    parser.add_argument('indexes', nargs='*', help='local indexes, all by default')
+    args = parser.parse_args()
+
+    config_text = read_config(args.config)
+    indexes = local_indexes(config_text)
+    if args.indexes:
+        indexes = [index for index in indexes if index[0] in args.indexes]
+    indexes.sort(key=lambda index: family_rank(index[0]))
+    jobs = [IndexJob(name, path, args.config, args.indexer) for name, path in indexes]
+    parallel = args.jobs or default_jobs()
+    log('Indexing {} indexes with {} parallel indexers'.format(len(jobs), parallel))
+    if args.dry_run:
+        for job in jobs:
+            log(' '.join(job.command))
+        sys.exit(0)
+
+    started = time()
+    run_jobs(jobs, parallel)
+    for job in sorted(jobs, key=lambda job: -(job.elapsed or 0)):
+        status = 'not started' if job.elapsed is None else \
+            'failed' if job.failed else 'ok'
+        log('{:<32} {:>10.1f} s  {}'.format(job.name, job.elapsed or 0, status))
+    if any(job.failed for job in jobs):
+        remove_new_files(jobs)
+        log('Indexing failed in {:.1f} s, indexes are not rotated'.format(time() - started))
+        sys.exit(1)
+    if rotate(config_text):
+        log('Indexing finished in {:.1f} s, searchd rotates the indexes'.format(time() - started))
+    else:
+        log('Indexing finished in {:.1f} s, searchd is not running'.format(time() - started))
+    sys.exit(0)
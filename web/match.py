@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Compact matches of OSMNames-SphinxSearch results
+#
+# Match keeps the row of the result set as returned by the cursor, columns
+# of the row are resolved once per result set and shared by its matches.
+
+from threading import Lock
+
+
+class MatchColumns(object):
+    """Columns of a result set, shared by all of its matches."""
+
+    __slots__ = ('names', 'id_index', 'weight_index', 'attrs', 'attr_index')
+
+    def __init__(self, names):
+        self.names = names
+        self.id_index = names.index('id') if 'id' in names else None
+        self.weight_index = names.index('weight') if 'weight' in names else None
+        # Attributes are the other columns, as (name, index in the row)
+        self.attrs = tuple((name, i) for i, name in enumerate(names)
+                           if name not in ('id', 'weight'))
+        self.attr_index = dict(self.attrs)
+
+
+COLUMNS_CACHE = {}
+COLUMNS_CACHE_LOCK = Lock()
+
+
+def get_columns(names):
+    """Shared columns of the column names (tuple)."""
+    columns = COLUMNS_CACHE.get(names)
+    if columns is None:
+        with COLUMNS_CACHE_LOCK:
+            columns = COLUMNS_CACHE.setdefault(names, MatchColumns(names))
+    return columns
+
+
+class Match(object):
+    """
+    Match of the result, with id, weight and attributes of the row.
+
+    Matches are shared by cached results and must not be modified, with_attr
+    returns a new match. Items 'id', 'weight' and 'attrs' are available as in
+    the dict matches.
+    """
+
+    __slots__ = ('id', 'weight', 'row', 'columns')
+
+    def __init__(self, id, weight, row, columns):
+        self.id = id
+        self.weight = weight
+        self.row = row
+        self.columns = columns
+
+    @classmethod
+    def from_row(cls, row, columns):
+        """Match of the cursor row."""
+        return cls(row[columns.id_index] if columns.id_index is not None else 0,
+                   row[columns.weight_index] if columns.weight_index is not None else 0,
+                   row, columns)
+
+    @classmethod
+    def from_attrs(cls, id, weight, attrs):
+        """Match of the attributes dict."""
+        names = tuple(attrs)
+        return cls(id, weight, tuple(attrs[name] for name in names), get_columns(names))
+
+    def attr(self, name, default=None):
+        i = self.columns.attr_index.get(name)
+        if i is None:
+            return default
+        return self.row[i]
+
+    def iterattrs(self):
+        """Iterate over (name, value) of the attributes."""
+        row = self.row
+        for name, i in self.columns.attrs:
+            yield name, row[i]
+
+    def attrs(self):
+        return dict(self.iterattrs())
+
+    def with_attr(self, name, value):
+        """Copy of the match with the attribute set."""
+        attrs = self.attrs()
+        attrs[name] = value
+        return Match.from_attrs(self.id, self.weight, attrs)
+
+    def to_dict(self):
+        return {'id': self.id, 'weight': self.weight, 'attrs': self.attrs()}
+
+    def __getitem__(self, key):
+        if key == 'id':
+            return self.id
+        if key == 'weight':
+            return self.weight
+        if key == 'attrs':
+            return self.attrs()
+        raise KeyError(key)
+
+    def __repr__(self):
+        return 'Match({!r})'.format(self.to_dict())
+
+
+def json_default(obj):
+    """Serialize matches in JSON output (debug)."""
+    if isinstance(obj, Match):
+        return obj.to_dict()
+    raise TypeError(repr(obj) + ' is not JSON serializable')
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# Metrics of OSMNames-SphinxSearch web workers
+#
+# Counters and histograms are kept in each worker process and written
+# periodically as snapshots into a directory shared by the workers of the
+# host. /metrics merges the snapshots into Prometheus text format. Snapshots
+# of exited workers are merged into the archive, so counters never go back.
+
+from bisect import bisect_left
+from json import dump, load
+from os import getpid, kill, listdir, makedirs, path, remove, rename
+from threading import Lock
+from time import time
+import errno
+import fcntl
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+ARCHIVE = 'archive.json'
+LOCK_FILE = '.lock'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + '}'
+
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def process_alive(pid):
+    try:
+        kill(pid, 0)
+    except OSError as ex:
+        return ex.errno != errno.ESRCH
+    return True
+
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms of the worker process.
+
+    Samples are identified by the metric name and labels, tuple of
+    (label, value) pairs. Metrics are described before use.
+    """
+
+    def __init__(self, directory=None, interval=5.0, enabled=True):
+        self.directory = directory
+        self.interval = interval
+        self.enabled = enabled
+        self.lock = Lock()
+        self.described = {}
+        self.buckets = {}
+        self.reset()
+
+    def reset(self):
+        """Drop all samples, the worker process starts with empty metrics."""
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.pid = getpid()
+            self.written = 0
+
+    def describe(self, name, kind, help, buckets=DEFAULT_BUCKETS):
+        """Describe the metric, kind is 'counter', 'gauge' or 'histogram'."""
+        self.described[name] = (kind, help)
+        if kind == 'histogram':
+            self.buckets[name] = tuple(buckets)
+
+    def inc(self, name, labels=(), value=1):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, labels=(), value=0):
+        """Set the counter or gauge maintained elsewhere."""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[(name, labels)] = value
+
+    def observe(self, name, labels, value):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        buckets = self.buckets[name]
+        i = bisect_left(buckets, value)
+        with self.lock:
+            sample = self.histograms.get(key)
+            if sample is None:
+                # Counts of the buckets and +Inf, sum
+                sample = self.histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            sample[i] += 1
+            sample[-1] += value
+
+    # -------------------------------------------------------------------------
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, labels, value]
+                             for (name, labels), value in self.counters.iteritems()],
+                'histograms': [[name, labels, list(sample)]
+                               for (name, labels), sample in self.histograms.iteritems()],
+            }
+
+    def write(self, force=False):
+        """Write the snapshot of the process, at most every interval seconds."""
+        if not self.enabled or self.directory is None:
+            return
+        now = time()
+        if not force and now - self.written < self.interval:
+            return
+        self.written = now
+        if not path.isdir(self.directory):
+            try:
+                makedirs(self.directory)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+        filename = path.join(self.directory, '{}.json'.format(getpid()))
+        with open(filename + '.tmp', 'wb') as f:
+            dump(self.snapshot(), f)
+        rename(filename + '.tmp', filename)
+
+    def clear_directory(self):
+        """Remove snapshots of the previous run, before the workers start."""
+        if self.directory is None or not path.isdir(self.directory):
+            return
+        for name in listdir(self.directory):
+            if name.endswith('.json') or name.endswith('.tmp'):
+                remove(path.join(self.directory, name))
+
+    def collect(self):
+        """Merged snapshots of all worker processes, this one included."""
+        if self.directory is None:
+            return merge([self.snapshot()])
+        self.write(force=True)
+        with open(path.join(self.directory, LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive_file = path.join(self.directory, ARCHIVE)
+            snapshots = [read_snapshot(archive_file)]
+            archived = []
+            for name in listdir(self.directory):
+                if not name.endswith('.json') or name == ARCHIVE:
+                    continue
+                filename = path.join(self.directory, name)
+                snapshot = read_snapshot(filename)
+                if process_alive(int(name[:-len('.json')])):
+                    snapshots.append(snapshot)
+                else:
+                    archived.append((filename, snapshot))
+            if archived:
+                archive = merge([snapshots[0]] + [snapshot for filename, snapshot in archived])
+                with open(archive_file + '.tmp', 'wb') as f:
+                    dump(archive, f)
+                rename(archive_file + '.tmp', archive_file)
+                for filename, snapshot in archived:
+                    remove(filename)
+                snapshots[0] = archive
+        return merge(snapshots)
+
+    def render(self, merged):
+        """Prometheus text format of the merged snapshots."""
+        lines = []
+        samples = {}
+        for name, labels, value in merged['counters']:
+            samples.setdefault(name, []).append((labels, value))
+        for name, labels, sample in merged['histograms']:
+            samples.setdefault(name, []).append((labels, sample))
+        for name in sorted(samples):
+            kind, help = self.described.get(name, ('untyped', name))
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in sorted(samples[name]):
+                labels = tuple(tuple(label) for label in labels)
+                if kind != 'histogram':
+                    lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+                    continue
+                cumulative = 0
+                bounds = [repr(bound) for bound in self.buckets[name]] + ['+Inf']
+                for bound, count in zip(bounds, value[:-1]):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(labels + (('le', bound), )), cumulative))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(value[-1])))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def read_snapshot(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return load(f)
+    except (IOError, ValueError):
+        return {'counters': [], 'histograms': []}
+
+
+def merge(snapshots):
+    """Sum the samples of the snapshots."""
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, sample in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = list(sample)
+            else:
+                histograms[key] = [a + b for a, b in zip(merged, sample)]
+    return {
+        'counters': [[name, labels, value] for (name, labels), value in counters.iteritems()],
+        'histograms': [[name, labels, sample] for (name, labels), sample in histograms.iteritems()],
+    }
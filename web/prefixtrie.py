@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Prefix trie for short autocomplete queries of OSMNames-SphinxSearch
+#
+# The trie is built from the input data at index time and memory-mapped
+# by the web workers. Trie is flattened into a sorted table of keys
+# (country code and prefix of a word from name or alternative_names),
+# each key refers to its top rows, rows with a word equal to the prefix
+# first, ordered by the weight of the autocomplete steps of the cascade.
+#
+# Usage: prefixtrie.py [--max-len 2] [--top 100] [input] output
+
+from json import dumps, loads
+from os import rename
+import argparse
+import heapq
+import mmap
+import re
+import struct
+import sys
+import unicodedata
+
+from datainput import COLUMN_INDEX, COLUMNS, FLOAT_COLUMNS, default_input, iter_rows, parse_float
+from match import Match
+
+
+MAGIC = 'OSMNTRIE'
+VERSION = 2
+DEFAULT_MAX_LEN = 2
+DEFAULT_TOP = 100
+
+# magic, version, max_len, top, n_keys, n_refs, n_rows, keys_size
+HEADER = struct.Struct('<8sIIIIIIQ')
+# key offset, key length, first ref, number of refs, total rows of the key
+KEY = struct.Struct('<QHIII')
+# row number, weight, exact word
+REF = struct.Struct('<IfB')
+ROW_OFFSET = struct.Struct('<Q')
+
+# Words are delimited by characters outside of the charset_table in sphinx,
+# accents are folded as the charset_table does for latin characters
+WORD_SPLIT = re.compile(r'[^\w]+', re.UNICODE)
+
+# Field weights of the autocomplete steps of the cascade, words equal to
+# the query (ind_name_exact) and prefixes of words (ind_name_prefix)
+FIELD_WEIGHTS = {
+    ('name', True): 1000,
+    ('alternative_names', True): 990,
+    ('name', False): 900,
+    ('alternative_names', False): 890,
+}
+
+
+def normalize_word(word):
+    """Lower case word without accents."""
+    word = unicodedata.normalize('NFKD', word.lower())
+    return u''.join(c for c in word if not unicodedata.combining(c))
+
+
+def split_words(text):
+    """Normalized words of the text (utf-8 or unicode)."""
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return [normalize_word(word) for word in WORD_SPLIT.split(text) if word]
+
+
+def make_key(country_code, prefix):
+    """Key of the trie, country code is empty for the global key."""
+    return (country_code or '') + '\t' + prefix.encode('utf-8')
+
+
+def rank_weight(field_weight, exact_hit, importance):
+    """
+    Weight of a single keyword query matching a field, on the scale of
+    WEIGHT()*importance of searchd. The ranker of the cascade is
+    sum((10*lcs+5*exact_order+10*exact_hit+5*wlccs)*user_weight)*1000+bm25,
+    lcs, exact_order and wlccs are 1 for a single keyword, bm25 is left out.
+    """
+    return (20 + 10 * exact_hit) * field_weight * 1000 * importance
+
+
+def row_keys(cols, max_len):
+    """
+    Keys of the row (utf-8 columns), global and of its country, with
+    the rank (exact word, weight) of the row for the key.
+
+    Like in the cascade, rows with a word equal to the prefix are weighted
+    as the matches of ind_name_exact and rank before the other rows,
+    weighted as the matches of ind_name_prefix.
+    """
+    importance = parse_float(cols[COLUMN_INDEX['importance']])
+    # prefix: {exact: weight}
+    prefixes = {}
+    for field in ('name', 'alternative_names'):
+        words = split_words(cols[COLUMN_INDEX[field]])
+        matched = {}
+        for word in words:
+            for length in range(1, min(len(word), max_len) + 1):
+                prefix = word[:length]
+                matched[prefix] = matched.get(prefix, False) or length == len(word)
+        for prefix, exact in matched.iteritems():
+            exact_hit = words == [prefix]
+            weight = rank_weight(FIELD_WEIGHTS[field, exact], exact_hit, importance)
+            weights = prefixes.setdefault(prefix, {})
+            weights[exact] = weights.get(exact, 0) + weight
+    country_code = cols[COLUMN_INDEX['country_code']].lower()
+    keys = {}
+    for prefix, weights in prefixes.iteritems():
+        exact = True in weights
+        rank = (exact, weights[exact])
+        keys[make_key('', prefix)] = rank
+        keys[make_key(country_code, prefix)] = rank
+    return keys
+
+
+def row_attrs(cols):
+    """Attributes of the row (utf-8 columns), floats parsed and strings decoded."""
+    attrs = {}
+    for col, value in zip(COLUMNS, cols):
+        if col in FLOAT_COLUMNS:
+            attrs[col] = parse_float(value)
+        else:
+            attrs[col] = value.decode('utf-8', 'replace')
+    return attrs
+
+
+# -----------------------------------------------------------------------------
+def build(input_file, output_file, max_len=DEFAULT_MAX_LEN, top=DEFAULT_TOP):
+    """Build the prefix trie from the input data, return number of keys."""
+    # Top rows of each key as min-heap of (exact, weight, id)
+    heaps = {}
+    totals = {}
+    for doc_id, cols in iter_rows(input_file):
+        for key, rank in row_keys(cols, max_len).iteritems():
+            item = rank + (doc_id, )
+            totals[key] = totals.get(key, 0) + 1
+            heap = heaps.get(key)
+            if heap is None:
+                heaps[key] = [item]
+            elif len(heap) < top:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+    # Rows referenced by any key, loaded in the second pass over the input
+    row_numbers = {}
+    for heap in heaps.itervalues():
+        for exact, weight, doc_id in heap:
+            row_numbers[doc_id] = 0
+    ids = sorted(row_numbers)
+    for i, doc_id in enumerate(ids):
+        row_numbers[doc_id] = i
+
+    keys = sorted(heaps)
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        n_refs = sum(len(heap) for heap in heaps.itervalues())
+        keys_size = sum(len(key) for key in keys)
+        f.write(HEADER.pack(MAGIC, VERSION, max_len, top, len(keys), n_refs,
+                            len(ids), keys_size))
+        key_offset = 0
+        first_ref = 0
+        for key in keys:
+            f.write(KEY.pack(key_offset, len(key), first_ref, len(heaps[key]), totals[key]))
+            key_offset += len(key)
+            first_ref += len(heaps[key])
+        for key in keys:
+            f.write(key)
+        for key in keys:
+            for exact, weight, doc_id in sorted(heaps[key], reverse=True):
+                f.write(REF.pack(row_numbers[doc_id], weight, exact))
+        del heaps, totals
+
+        # Row offsets are written after the rows are known, reserve the space
+        offsets_pos = f.tell()
+        f.write(ROW_OFFSET.pack(0) * (len(ids) + 1))
+        rows_pos = f.tell()
+        offsets = [0]
+        for doc_id, cols in iter_rows(input_file):
+            if doc_id not in row_numbers:
+                continue
+            f.write(dumps([doc_id, row_attrs(cols)]))
+            offsets.append(f.tell() - rows_pos)
+        f.seek(offsets_pos)
+        for offset in offsets:
+            f.write(ROW_OFFSET.pack(offset))
+    rename(tmp_file, output_file)
+    return len(keys)
+
+
+# -----------------------------------------------------------------------------
+def encode_attrs(attrs):
+    """Strings as utf-8, same as the attributes read from searchd."""
+    for col, value in attrs.iteritems():
+        if isinstance(value, unicode):
+            attrs[col] = value.encode('utf-8')
+    return attrs
+
+
+class PrefixTrie(object):
+    """Memory-mapped prefix trie, answering top rows of short prefixes."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.max_len, self.top, self.n_keys, n_refs,
+         self.n_rows, keys_size) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Invalid prefix trie file ' + filename)
+        self.keys_pos = HEADER.size
+        self.key_names_pos = self.keys_pos + KEY.size * self.n_keys
+        self.refs_pos = self.key_names_pos + keys_size
+        self.offsets_pos = self.refs_pos + REF.size * n_refs
+        self.rows_pos = self.offsets_pos + ROW_OFFSET.size * (self.n_rows + 1)
+        # Rows killed by the deltas and the delta rows of each key
+        self.killed_rows = frozenset()
+        self.delta_keys = {}
+
+    def close(self):
+        self.mm.close()
+
+    def key(self, i):
+        """Return (key, first ref, number of refs, total rows) of i-th key."""
+        offset, size, first_ref, n_refs, total = KEY.unpack_from(
+            self.mm, self.keys_pos + KEY.size * i)
+        pos = self.key_names_pos + offset
+        return self.mm[pos:pos + size], first_ref, n_refs, total
+
+    def find(self, key):
+        """Binary search of the key, return (first ref, number of refs, total) or None."""
+        first, last = 0, self.n_keys
+        while first < last:
+            middle = (first + last) // 2
+            if self.key(middle)[0] < key:
+                first = middle + 1
+            else:
+                last = middle
+        if first < self.n_keys:
+            found = self.key(first)
+            if found[0] == key:
+                return found[1:]
+        return None
+
+    def row(self, row_number):
+        """Return (document id, attributes) of the row."""
+        pos = self.offsets_pos + ROW_OFFSET.size * row_number
+        first = ROW_OFFSET.unpack_from(self.mm, pos)[0]
+        last = ROW_OFFSET.unpack_from(self.mm, pos + ROW_OFFSET.size)[0]
+        doc_id, attrs = loads(self.mm[self.rows_pos + first:self.rows_pos + last])
+        return doc_id, encode_attrs(attrs)
+
+    def find_row(self, doc_id):
+        """Binary search of the row of the document id, rows are ordered by ids."""
+        first, last = 0, self.n_rows
+        while first < last:
+            middle = (first + last) // 2
+            if self.row(middle)[0] < doc_id:
+                first = middle + 1
+            else:
+                last = middle
+        if first < self.n_rows and self.row(first)[0] == doc_id:
+            return first
+        return None
+
+    def apply_deltas(self, killed, rows):
+        """
+        Mask the rows of the killed document ids and add the delta rows
+        (document id: unicode columns), the trie is built from the input
+        data only.
+        """
+        killed_rows = set()
+        for doc_id in killed:
+            row_number = self.find_row(doc_id)
+            if row_number is not None:
+                killed_rows.add(row_number)
+        delta_keys = {}
+        for doc_id, row in rows.iteritems():
+            cols = [value.encode('utf-8') for value in row]
+            attrs = encode_attrs(row_attrs(cols))
+            for key, rank in row_keys(cols, self.max_len).iteritems():
+                delta_keys.setdefault(key, []).append(rank + (doc_id, attrs))
+        self.killed_rows = frozenset(killed_rows)
+        self.delta_keys = delta_keys
+
+    def prefix(self, query):
+        """Normalized prefix of the query, None if the trie can't answer it."""
+        words = split_words(query.replace('*', ''))
+        if len(words) != 1 or len(words[0]) > self.max_len:
+            return None
+        return words[0]
+
+    def search(self, prefix, country_codes=None, start=0, count=DEFAULT_TOP):
+        """
+        Top rows of the prefix, optionally of the country codes.
+
+        Rows killed by the deltas are skipped and the delta rows are merged.
+        Return (matches, total found) with matches weighted as in the cascade,
+        exact words first, or None if the trie has not enough rows for the
+        requested page.
+        """
+        keys = set(make_key(cc.lower(), prefix) for cc in country_codes or [''])
+        # (exact, weight, row number, None) of the trie
+        # or (exact, weight, None, (id, attrs)) of deltas
+        refs = []
+        total = 0
+        for key in keys:
+            deltas = self.delta_keys.get(key, [])
+            found = self.find(key) or (0, 0, 0)
+            first_ref, n_refs, key_total = found
+            # Killed rows are counted out of the stored refs of the key
+            last_ref = first_ref + n_refs
+            if not self.killed_rows:
+                last_ref = min(last_ref, first_ref + start + count)
+            key_refs = 0
+            for i in xrange(first_ref, last_ref):
+                row_number, weight, exact = REF.unpack_from(self.mm, self.refs_pos + REF.size * i)
+                if row_number in self.killed_rows:
+                    key_total -= 1
+                    continue
+                if key_refs < start + count:
+                    refs.append((exact, weight, row_number, None))
+                    key_refs += 1
+            if n_refs < found[2] and key_refs < start + count:
+                return None
+            total += key_total + len(deltas)
+            for exact, weight, doc_id, attrs in deltas:
+                refs.append((exact, weight, None, (doc_id, attrs)))
+
+        # Refs of each key are ordered by rank, rows of the page are loaded
+        refs.sort(key=lambda ref: (not ref[0], -ref[1]))
+        matches = []
+        for exact, weight, row_number, row in refs[start:start + count]:
+            doc_id, attrs = self.row(row_number) if row is None else row
+            matches.append(Match.from_attrs(doc_id, weight, attrs))
+        return matches, total
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build prefix trie for short autocomplete queries.')
+    parser.add_argument('--max-len', type=int, default=DEFAULT_MAX_LEN,
+                        help='maximal length of the prefix')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP,
+                        help='number of rows stored for each prefix')
+    parser.add_argument('input', nargs='?', help='input data.tsv[.gz]')
+    parser.add_argument('output', help='output prefix trie file')
+    args = parser.parse_args()
+
+    count = build(args.input or default_input(), args.output, args.max_len, args.top)
+    print('Prefix trie {} built with {} keys'.format(args.output, count))
+    sys.exit(0 if count > 0 else 1)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Spatial grid index for reverse geo-coding of OSMNames-SphinxSearch
+#
+# The index is built from the input data at index time and memory-mapped
+# by the web workers. Records (lon, lat, id, class) are grouped by grid cell
+# and sorted by class and latitude inside the cell.
+#
+# Usage: spatialindex.py [--cell-size 0.25] [input] output
+
+from array import array
+from math import asin, cos, radians, sin, sqrt
+from os import rename
+import argparse
+import mmap
+import struct
+import sys
+
+from datainput import COLUMN_INDEX, default_input, iter_rows, parse_float
+
+
+MAGIC = 'OSMNGRID'
+VERSION = 2
+DEFAULT_CELL_SIZE = 0.25
+# Cells of a block side, blocks skip empty areas in the nearest search
+BLOCK = 8
+
+HEADER = struct.Struct('<8sIdIIII')
+RECORD = struct.Struct('<ffIH')
+OFFSET = struct.Struct('<I')
+FLOAT32 = struct.Struct('<f')
+
+# Same sphere as GEODIST in sphinx
+EARTH_DIAMETER = 2 * 6384000.0
+
+
+def float32(value):
+    """Round value to single precision, as float attributes in sphinx."""
+    return FLOAT32.unpack(FLOAT32.pack(value))[0]
+
+
+def geodist(lat1, lon1, lat2, lon2):
+    """Haversine distance in meters of two points in degrees."""
+    lat1, lon1, lat2, lon2 = radians(lat1), radians(lon1), radians(lat2), radians(lon2)
+    a = (sin(0.5 * (lat1 - lat2)) ** 2 +
+         cos(lat1) * cos(lat2) * sin(0.5 * (lon1 - lon2)) ** 2)
+    return EARTH_DIAMETER * asin(min(1.0, sqrt(a)))
+
+
+def meridian_distance(lat1, lat2):
+    """Distance in meters along the meridian, lower bound of geodist of the latitudes."""
+    return 0.5 * EARTH_DIAMETER * radians(abs(lat1 - lat2))
+
+
+def parallel_distance(lat, lon_gap):
+    """
+    Lower bound of geodist of the point to places at least lon_gap degrees
+    of longitude away, the distance to the meridian lon_gap away.
+    """
+    if lon_gap >= 90.0:
+        return 0.0
+    return 0.5 * EARTH_DIAMETER * asin(min(1.0, cos(radians(lat)) * sin(radians(lon_gap))))
+
+
+def ring_cells(x0, y0, ring, n_x, n_y):
+    """Cells (x, y) in the Chebyshev distance ring around the cell, wrapped at 180."""
+    if ring == 0:
+        return [(x0, y0)]
+    cells = []
+    # Rows of the ring span at most all columns of the grid
+    columns = [x % n_x for x in xrange(x0 - ring, x0 - ring + min(2 * ring + 1, n_x))]
+    for y in (y0 - ring, y0 + ring):
+        if 0 <= y < n_y:
+            cells.extend((x, y) for x in columns)
+    # Side columns, unless the inner columns already go around the globe
+    if 2 * ring - 1 < n_x:
+        sides = (x0 - ring, x0 + ring) if 2 * ring < n_x else (x0 - ring, )
+        rows = xrange(max(y0 - ring + 1, 0), min(y0 + ring, n_y))
+        for x in sides:
+            cells.extend((x % n_x, y) for y in rows)
+    return cells
+
+
+def cell_distance(lon, lat, x, y, size):
+    """Lower bound of the distance of the point to places in the cell of the size."""
+    lon_min = x * size - 180.0
+    lat_min = y * size - 90.0
+    if lat < lat_min:
+        lat_gap = lat_min - lat
+    elif lat > lat_min + size:
+        lat_gap = lat - lat_min - size
+    else:
+        lat_gap = 0.0
+    lon_gap = 0.0
+    if not lon_min <= lon <= lon_min + size:
+        lon_gap = min((lon_min - lon) % 360.0, (lon - lon_min - size) % 360.0)
+    return max(meridian_distance(0.0, lat_gap), parallel_distance(lat, lon_gap))
+
+
+def rings_distance(lon, lat, x0, y0, ring, size, n_x, n_y):
+    """
+    Lower bound of the distance of the point to cells outside of the rings
+    up to ring around the cell (x0, y0), None if the rings cover the grid.
+    """
+    bounds = []
+    if y0 - ring > 0:
+        bounds.append(meridian_distance(lat, (y0 - ring) * size - 90.0))
+    if y0 + ring + 1 < n_y:
+        bounds.append(meridian_distance(lat, (y0 + ring + 1) * size - 90.0))
+    if 2 * ring + 1 < n_x:
+        lon_min = (x0 - ring) * size - 180.0
+        lon_max = (x0 + ring + 1) * size - 180.0
+        bounds.append(parallel_distance(lat, min(lon - lon_min, lon_max - lon)))
+    if not bounds:
+        return None
+    return min(bounds)
+
+
+def grid_size(cell_size):
+    return int(round(360.0 / cell_size)), int(round(180.0 / cell_size))
+
+
+def grid_cell(value, origin, cell_size, cells):
+    return min(max(int((value + origin) / cell_size), 0), cells - 1)
+
+
+# -----------------------------------------------------------------------------
+def build(input_file, output_file, cell_size=DEFAULT_CELL_SIZE):
+    """Build the grid index from the input data, return number of records."""
+    n_lon, n_lat = grid_size(cell_size)
+    n_cells = n_lon * n_lat
+
+    lons = array('f')
+    lats = array('f')
+    ids = array('I')
+    classes = array('H')
+    cells = array('I')
+    class_codes = {}
+    col_lon = COLUMN_INDEX['lon']
+    col_lat = COLUMN_INDEX['lat']
+    col_class = COLUMN_INDEX['class']
+    for doc_id, cols in iter_rows(input_file):
+        lon = parse_float(cols[col_lon])
+        lat = parse_float(cols[col_lat])
+        lons.append(lon)
+        lats.append(lat)
+        ids.append(doc_id)
+        classes.append(class_codes.setdefault(cols[col_class], len(class_codes)))
+        cells.append(grid_cell(lat, 90.0, cell_size, n_lat) * n_lon +
+                     grid_cell(lon, 180.0, cell_size, n_lon))
+
+    # Counting sort by cell, then sort each cell by class and latitude
+    offsets = array('I', [0]) * (n_cells + 1)
+    for cell in cells:
+        offsets[cell + 1] += 1
+    for cell in xrange(n_cells):
+        offsets[cell + 1] += offsets[cell]
+    position = array('I', offsets)
+    order = array('I', [0]) * len(ids)
+    for i, cell in enumerate(cells):
+        order[position[cell]] = i
+        position[cell] += 1
+    del position, cells
+    for cell in xrange(n_cells):
+        first, last = offsets[cell], offsets[cell + 1]
+        if last - first > 1:
+            order[first:last] = array('I', sorted(order[first:last],
+                                                  key=lambda i: (classes[i], lats[i])))
+
+    names = sorted(class_codes, key=class_codes.get)
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, cell_size, n_lon, n_lat,
+                            len(ids), len(names)))
+        for name in names:
+            f.write(struct.pack('<H', len(name)) + name)
+        offsets.tofile(f)
+        for i in order:
+            f.write(RECORD.pack(lons[i], lats[i], ids[i], classes[i]))
+    rename(tmp_file, output_file)
+    return len(ids)
+
+
+# -----------------------------------------------------------------------------
+class GridIndex(object):
+    """
+    Memory-mapped grid index, answering nearest place queries.
+
+    Cells are grouped into blocks of BLOCK x BLOCK cells with the number of
+    their records, counted from the cell offsets at load. Blocks are searched
+    in rings of growing distance around the point, cells of a block in the
+    order of their distance.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.cell_size, self.n_lon, self.n_lat,
+         self.n_records, n_classes) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Invalid grid index file ' + filename)
+        pos = HEADER.size
+        self.n_classes = n_classes
+        self.classes = {}
+        for code in range(n_classes):
+            size = struct.unpack_from('<H', self.mm, pos)[0]
+            self.classes[self.mm[pos + 2:pos + 2 + size]] = code
+            pos += 2 + size
+        n_cells = self.n_lon * self.n_lat
+        self.offsets = array('I', self.mm[pos:pos + OFFSET.size * (n_cells + 1)])
+        if sys.byteorder != 'little':
+            self.offsets.byteswap()
+        self.records_pos = pos + OFFSET.size * (n_cells + 1)
+
+        # Blocks cover the grid exactly, cells of a block row are contiguous
+        self.block = next(size for size in (BLOCK, 4, 2, 1)
+                          if self.n_lon % size == 0 and self.n_lat % size == 0)
+        self.n_block_lon = self.n_lon // self.block
+        self.n_block_lat = self.n_lat // self.block
+        self.block_counts = array('I', [0]) * (self.n_block_lon * self.n_block_lat)
+        for cy in xrange(self.n_lat):
+            row = cy * self.n_lon
+            blocks = cy // self.block * self.n_block_lon
+            for bx in xrange(self.n_block_lon):
+                cell = row + bx * self.block
+                self.block_counts[blocks + bx] += self.offsets[cell + self.block] - self.offsets[cell]
+
+    def close(self):
+        self.mm.close()
+
+    def record(self, i):
+        return RECORD.unpack_from(self.mm, self.records_pos + RECORD.size * i)
+
+    def lower_bound(self, first, last, before):
+        """Binary search of the first record in the range, which is not before."""
+        while first < last:
+            middle = (first + last) // 2
+            if before(self.record(middle)):
+                first = middle + 1
+            else:
+                last = middle
+        return first
+
+    def cell_records(self, first, last, lon, lat, best, codes, exclude=None):
+        """
+        Yield (distance, id) of the records from first to last (of a cell)
+        closer than best[0], the best distance so far, which is updated.
+        Records of the excluded ids are skipped.
+        Records of each class are scanned from the latitude of the point to
+        both sides, each side stops once the latitude alone is farther than
+        the best distance.
+        """
+        for code in sorted(codes) if codes is not None else xrange(self.n_classes):
+            low = self.lower_bound(first, last, lambda record: record[3] < code)
+            high = self.lower_bound(low, last, lambda record: record[3] <= code)
+            if low == high:
+                continue
+            middle = self.lower_bound(low, high, lambda record: record[1] < lat)
+            for i, step, end in ((middle, 1, high), (middle - 1, -1, low - 1)):
+                while i != end:
+                    record = self.record(i)
+                    i += step
+                    if meridian_distance(lat, record[1]) >= best[0]:
+                        break
+                    distance = geodist(lat, lon, record[1], record[0])
+                    if distance < best[0] and (exclude is None or record[2] not in exclude):
+                        best[0] = distance
+                        yield distance, record[2]
+
+    def nearest(self, lon, lat, classes=None, exclude=None):
+        """
+        Find the closest place to the coordinates, optionally of the classes,
+        skipping the document ids of exclude (killed by the delta indexes).
+
+        Rings of blocks around the point are searched until the best distance
+        is below the lower bound of the distance of the blocks outside of the
+        rings. Return (document id, distance in meters) or None.
+        """
+        codes = None
+        if classes:
+            codes = set(self.classes[cl] for cl in classes if cl in self.classes)
+            if not codes:
+                return None
+
+        block_size = self.cell_size * self.block
+        bx0 = grid_cell(lon, 180.0, self.cell_size, self.n_lon) // self.block
+        by0 = grid_cell(lat, 90.0, self.cell_size, self.n_lat) // self.block
+        best = [float('inf')]
+        best_id = None
+        ring = 0
+        while True:
+            for bx, by in ring_cells(bx0, by0, ring, self.n_block_lon, self.n_block_lat):
+                if (not self.block_counts[by * self.n_block_lon + bx] or
+                        cell_distance(lon, lat, bx, by, block_size) >= best[0]):
+                    continue
+                for bound, first, last in self.block_cells(lon, lat, bx, by):
+                    if bound >= best[0]:
+                        break
+                    records = self.cell_records(first, last, lon, lat, best, codes, exclude)
+                    for distance, doc_id in records:
+                        best_id = doc_id
+            bound = rings_distance(lon, lat, bx0, by0, ring, block_size,
+                                   self.n_block_lon, self.n_block_lat)
+            if bound is None or best[0] <= bound:
+                break
+            ring += 1
+        if best_id is None:
+            return None
+        return best_id, best[0]
+
+    def block_cells(self, lon, lat, bx, by):
+        """Non-empty cells of the block as (distance bound, first, last), nearest first."""
+        cells = []
+        for cy in xrange(by * self.block, (by + 1) * self.block):
+            for cx in xrange(bx * self.block, (bx + 1) * self.block):
+                cell = cy * self.n_lon + cx
+                first, last = self.offsets[cell], self.offsets[cell + 1]
+                if first != last:
+                    cells.append((cell_distance(lon, lat, cx, cy, self.cell_size), first, last))
+        cells.sort()
+        return cells
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build spatial grid index for reverse geo-coding.')
+    parser.add_argument('--cell-size', type=float, default=DEFAULT_CELL_SIZE,
+                        help='size of the grid cell in degrees')
+    parser.add_argument('input', nargs='?', help='input data.tsv[.gz]')
+    parser.add_argument('output', help='output grid index file')
+    args = parser.parse_args()
+
+    count = build(args.input or default_input(), args.output, args.cell_size)
+    print('Spatial index {} built with {} records'.format(args.output, count))
+    sys.exit(0 if count > 0 else 1)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Warmup of OSMNames-SphinxSearch from the searchd query log
+#
+# The most frequent statements of the query log (query_log_format = sphinxql)
+# are replayed against searchd after the indexes are rotated, which loads
+# the index files into the page cache. The web layer uses the same log to
+# fill its result cache, see websearch.warmup_result_cache.
+#
+# Usage: warmup.py [--top 1000] [--max-bytes 67108864] [--time 300] [query.log]
+
+from collections import Counter
+from os import getenv
+from time import time
+import argparse
+import re
+import sys
+
+
+QUERY_LOG = '/var/log/sphinxsearch/query.log'
+DEFAULT_TOP = 1000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# /* Thu Oct 18 10:00:00.000 2026 conn 3 real 0.004 wall 0.005 found 12 */ SELECT ...
+LOG_LINE = re.compile(r"^/\*.*?\bconn (\d+)\b.*?\*/\s*(SELECT\b.*?);?\s*$", re.I)
+STRING = r"'((?:[^'\\]|\\.)*)'"
+RE_FROM = re.compile(r"\bFROM\s+(\w+)", re.I)
+RE_MATCH = re.compile(r"\bMATCH\s*\(\s*" + STRING + r"\s*\)", re.I)
+RE_IN = re.compile(r"\b(\w+)\s+IN\s*\(([^)]*)\)", re.I)
+RE_STRING = re.compile(STRING)
+RE_LIMIT = re.compile(r"\bLIMIT\s+(\d+)\s*,\s*(\d+)", re.I)
+RE_ORDER = re.compile(r"\bORDER\s+BY\s+(.*?)\s+(?:LIMIT|OPTION)\b", re.I)
+RE_NAME_WEIGHT = re.compile(r"field_weights\s*=\s*\((?:[^)]*[\s,])?name\s*=\s*(\d+)", re.I)
+RE_RANGE = re.compile(r"[<>]\s*(?:lat|lon)\b|\b(?:lat|lon)\s*[<>]", re.I)
+
+
+def unescape(value):
+    """Value of the quoted SphinxQL string."""
+    return re.sub(r"\\(.)", r"\1", value)
+
+
+def read_log(filename=QUERY_LOG, max_bytes=DEFAULT_MAX_BYTES):
+    """Lines of the end of the query log, at most max_bytes."""
+    with open(filename, 'rb') as f:
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(max(0, size - max_bytes))
+        if size > max_bytes:
+            # Skip the partial line
+            f.readline()
+        return f.readlines()
+
+
+def parse_log(lines):
+    """Yield (connection id, statement) of the SELECT statements of the log."""
+    for line in lines:
+        m = LOG_LINE.match(line.strip())
+        if m:
+            yield int(m.group(1)), m.group(2)
+
+
+def top_statements(entries, top=DEFAULT_TOP):
+    """Most frequent statements, most frequent first."""
+    return [sql for sql, n in Counter(sql for conn, sql in entries).most_common(top)]
+
+
+def parse_select(sql):
+    """
+    Parse the search statement of the web layer.
+
+    Return dict with index, query, filters (attribute: tuple of values),
+    name_weight, start and count, or None if the statement can't be
+    reproduced by the search of the web layer.
+    """
+    index = RE_FROM.search(sql)
+    match = RE_MATCH.search(sql)
+    limit = RE_LIMIT.search(sql)
+    if index is None or match is None or limit is None:
+        return None
+    # Viewbox and custom sorting are not warmed up
+    if RE_RANGE.search(sql):
+        return None
+    order = RE_ORDER.search(sql)
+    if order is not None and order.group(1).lower().replace(' ', '') != 'weightdesc':
+        return None
+    name_weight = RE_NAME_WEIGHT.search(sql)
+
+    filters = []
+    for m in RE_IN.finditer(sql):
+        values = tuple(unescape(value) for value in RE_STRING.findall(m.group(2)))
+        filters.append((m.group(1).lower(), values))
+    return {
+        'index': index.group(1),
+        'query': unescape(match.group(1)),
+        'filters': tuple(sorted(filters)),
+        'name_weight': int(name_weight.group(1)) if name_weight else None,
+        'start': int(limit.group(1)),
+        'count': int(limit.group(2)),
+    }
+
+
+# -----------------------------------------------------------------------------
+def replay(statements, max_time=None, host='127.0.0.1', port=9306):
+    """Execute the statements against searchd, return number of successful ones."""
+    import MySQLdb
+
+    started = time()
+    succeeded = 0
+    try:
+        db = MySQLdb.connect(host=host, port=port, user='root')
+    except MySQLdb.Error as ex:
+        print >> sys.stderr, 'Warmup connection failed: ' + str(ex)
+        return succeeded
+    try:
+        for sql in statements:
+            if max_time is not None and time() - started > max_time:
+                break
+            cursor = db.cursor()
+            try:
+                cursor.execute(sql)
+                cursor.fetchall()
+                succeeded += 1
+            except MySQLdb.OperationalError as ex:
+                print >> sys.stderr, 'Warmup connection failed: ' + str(ex)
+                break
+            except MySQLdb.Error as ex:
+                print >> sys.stderr, 'Warmup statement failed: ' + str(ex)
+            finally:
+                cursor.close()
+    finally:
+        db.close()
+    return succeeded
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay the most frequent queries of the searchd query log.')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP,
+                        help='number of the most frequent statements replayed')
+    parser.add_argument('--max-bytes', type=int, default=DEFAULT_MAX_BYTES,
+                        help='size of the end of the log used')
+    parser.add_argument('--time', type=float, default=None,
+                        help='maximal time of the replay in seconds')
+    parser.add_argument('log', nargs='?', default=QUERY_LOG, help='searchd query log')
+    args = parser.parse_args()
+
+    try:
+        statements = top_statements(parse_log(read_log(args.log, args.max_bytes)), args.top)
+    except IOError as ex:
+        print('Warmup skipped, query log not available: ' + str(ex))
+        sys.exit(0)
+    host = getenv('WEBSEARCH_SERVER') or '127.0.0.1'
+    port = int(getenv('WEBSEARCH_SERVER_PORT') or 9306)
+    count = replay(statements, args.time, host, port)
+    print('Warmup replayed {} of {} statements'.format(count, len(statements)))
@@ -9,24 +9,47 @@
 # Author: Martin Mikita (martin.mikita @ klokantech.com)
 # Date: 15.07.2016
 
-from flask import Flask, request, Response, render_template, url_for, redirect
+from flask import Flask, request, Response, render_template, url_for, redirect, stream_with_context, g
 from pprint import pprint, PrettyPrinter
-from json import dumps
-from os import getenv, path, utime
-from time import time, mktime
+from json import dumps, loads
+from os import getenv, getpid, path, utime
+from time import time, mktime, sleep
 from datetime import datetime
+from threading import Event, Lock
+from multiprocessing.pool import ThreadPool
+from collections import Counter, deque, OrderedDict
+from itertools import izip
 import sys
+import csv
 import MySQLdb
+from MySQLdb.constants import CLIENT
 import re
-import natsort
+import heapq
 import rfc822   # Used for parsing RFC822 into datetime
 import email    # Used for formatting TS into RFC822
 import traceback
+import base64
+import random
+
+from spatialindex import GridIndex, geodist
+from prefixtrie import PrefixTrie
+from attributes import load_snapshot
+from datawatch import DataWatcher
+from match import Match, get_columns, json_default
+from embedded import EmbeddedIndex
+from metrics import Metrics
+from datainput import COLUMN_INDEX, default_input
+from docstore import DOCSTORE_COLUMNS, DOCSTORE_FILE, DocStore
+from delta import DELTA_ID_BASE, documents as delta_documents, killed_ids as delta_killed_ids, \
+    load_state as load_delta_state
+import warmup
 
 
 # Prepare global variables
 SEARCH_MAX_COUNT = 100
 SEARCH_DEFAULT_COUNT = 20
+# max_matches of searchd, deepest page reachable by startIndex or cursor
+SEARCH_MAX_MATCHES = 200
 if getenv('SEARCH_MAX_COUNT'):
     SEARCH_MAX_COUNT = int(getenv('SEARCH_MAX_COUNT'))
 if getenv('SEARCH_DEFAULT_COUNT'):
@@ -46,11 +69,224 @@ except OSError:
         utime(TMPFILE_DATA_TIMESTAMP, None)
     mtime = time()
 DATA_LAST_MODIFIED = email.utils.formatdate(mtime, usegmt=True)
-
-# Filter attributes values
-# dict[ attribute ] = list(values)
+# Data version used for invalidation of cached results, tracked by the data
+# watcher thread started in each worker process
+DATA_VERSION = mtime
+DATA_VERSION_CHECKED = time()
+DATA_WATCHER_PID = None
+DATA_WATCHER_LOCK = Lock()
+
+# Filter attributes values, loaded from snapshot written by sphinx-reindex.sh
+# or from searchd, replaced as a whole with new data
+# dict[ attribute ] = frozenset(values)
 CHECK_ATTR_FILTER = ['country_code', 'class']
+WEBSEARCH_ATTR_SNAPSHOT = '/data/index/attributes.json'
+if getenv('CHECK_ATTR_FILTER') is not None:
+    CHECK_ATTR_FILTER = [attr for attr in getenv('CHECK_ATTR_FILTER').split(',') if attr]
+if getenv('WEBSEARCH_ATTR_SNAPSHOT'):
+    WEBSEARCH_ATTR_SNAPSHOT = getenv('WEBSEARCH_ATTR_SNAPSHOT')
 ATTR_VALUES = {}
+ATTR_VALUES_VERSION = None
+ATTR_VALUES_CHECKED = 0
+ATTR_VALUES_LOCK = Lock()
+# Interval of retries, if attribute values are not available
+ATTR_VALUES_RETRY = 10
+
+# Request threads of each worker process (uwsgi --threads), the search spends
+# most of the time waiting for searchd, which runs without GIL held
+WEBSEARCH_THREADS = 1
+if getenv('WEBSEARCH_THREADS'):
+    WEBSEARCH_THREADS = int(getenv('WEBSEARCH_THREADS'))
+
+# SphinxQL connection pool, per worker process
+# Idle connections are kept at most WEBSEARCH_POOL_MAX_IDLE seconds,
+# which has to be lower than searchd client_timeout.
+WEBSEARCH_POOL_SIZE = max(4, WEBSEARCH_THREADS)
+WEBSEARCH_POOL_MAX_IDLE = 30
+WEBSEARCH_POOL_PING_AFTER = 5
+if getenv('WEBSEARCH_POOL_SIZE'):
+    WEBSEARCH_POOL_SIZE = int(getenv('WEBSEARCH_POOL_SIZE'))
+if getenv('WEBSEARCH_POOL_MAX_IDLE'):
+    WEBSEARCH_POOL_MAX_IDLE = float(getenv('WEBSEARCH_POOL_MAX_IDLE'))
+if getenv('WEBSEARCH_POOL_PING_AFTER'):
+    WEBSEARCH_POOL_PING_AFTER = float(getenv('WEBSEARCH_POOL_PING_AFTER'))
+
+# Execution of the query modifiers cascade
+#  - 'sequential' - one searchd round trip per cascade step
+#  - 'batch' - cascade steps sent as multi-statement batches
+#  - 'parallel' - cascade steps processed concurrently on a thread pool
+# Batch size is limited by searchd max_batch_queries (SELECT + SHOW META per step)
+# Parallel threads of all workers should fit into searchd max_children
+WEBSEARCH_CASCADE_MODE = 'sequential'
+WEBSEARCH_BATCH_QUERIES = 32
+WEBSEARCH_CASCADE_THREADS = 4
+if getenv('WEBSEARCH_CASCADE_MODE'):
+    WEBSEARCH_CASCADE_MODE = getenv('WEBSEARCH_CASCADE_MODE')
+if getenv('WEBSEARCH_BATCH_QUERIES'):
+    WEBSEARCH_BATCH_QUERIES = int(getenv('WEBSEARCH_BATCH_QUERIES'))
+if getenv('WEBSEARCH_CASCADE_THREADS'):
+    WEBSEARCH_CASCADE_THREADS = int(getenv('WEBSEARCH_CASCADE_THREADS'))
+# Two-phase retrieval: cascade steps on the OSMNames indexes select only id,
+# weight and sort keys, attributes of the final page are fetched at once
+WEBSEARCH_TWO_PHASE = 0
+if getenv('WEBSEARCH_TWO_PHASE'):
+    WEBSEARCH_TWO_PHASE = int(getenv('WEBSEARCH_TWO_PHASE'))
+# Indexes sharing the documents of the input data, attributes are fetched
+# from the first one
+TWO_PHASE_INDEXES = ('ind_name_exact', 'ind_name_prefix', 'ind_names_prefix',
+                     'ind_names_infix_soundex')
+
+# Search backend
+#  - 'searchd' - SphinxQL queries to searchd
+#  - 'embedded' - in-process index of the input data, built before uwsgi
+#    forks the workers, for small extracts without indexer and searchd
+# Embedded backend searches in the worker process, the cascade is sequential
+WEBSEARCH_BACKEND = 'searchd'
+WEBSEARCH_EMBEDDED_INPUT = None
+if getenv('WEBSEARCH_BACKEND'):
+    WEBSEARCH_BACKEND = getenv('WEBSEARCH_BACKEND')
+if getenv('WEBSEARCH_EMBEDDED_INPUT'):
+    WEBSEARCH_EMBEDDED_INPUT = getenv('WEBSEARCH_EMBEDDED_INPUT')
+if WEBSEARCH_BACKEND == 'embedded':
+    WEBSEARCH_CASCADE_MODE = 'sequential'
+EMBEDDED_INDEX = None
+EMBEDDED_INDEX_MTIME = None
+EMBEDDED_INDEX_VERSION = None
+EMBEDDED_INDEX_LOCK = Lock()
+
+# Thread pools of the worker process, dict[ name ] = (pid, pool)
+THREAD_POOLS = {}
+THREAD_POOLS_LOCK = Lock()
+
+# Result cache of search() and reverse_search(), per worker process
+# Size is number of cached results (0 disables cache), rows limit total number
+# of cached matches, TTL in seconds. Data timestamp is checked at most every
+# WEBSEARCH_CACHE_CHECK seconds, cache is cleared once data are reindexed.
+WEBSEARCH_CACHE_SIZE = 1000
+WEBSEARCH_CACHE_ROWS = 20000
+WEBSEARCH_CACHE_TTL = 3600
+WEBSEARCH_CACHE_CHECK = 1
+if getenv('WEBSEARCH_CACHE_SIZE'):
+    WEBSEARCH_CACHE_SIZE = int(getenv('WEBSEARCH_CACHE_SIZE'))
+if getenv('WEBSEARCH_CACHE_ROWS'):
+    WEBSEARCH_CACHE_ROWS = int(getenv('WEBSEARCH_CACHE_ROWS'))
+if getenv('WEBSEARCH_CACHE_TTL'):
+    WEBSEARCH_CACHE_TTL = float(getenv('WEBSEARCH_CACHE_TTL'))
+if getenv('WEBSEARCH_CACHE_CHECK'):
+    WEBSEARCH_CACHE_CHECK = float(getenv('WEBSEARCH_CACHE_CHECK'))
+
+# Reverse geo-coding engine
+#  - 'searchd' - growing bounding box queries with GEODIST
+#  - 'grid' - nearest place from spatial grid index built by sphinx-reindex.sh
+WEBSEARCH_REVERSE_ENGINE = 'searchd'
+WEBSEARCH_REVERSE_INDEX = '/data/index/reverse.grid'
+if getenv('WEBSEARCH_REVERSE_ENGINE'):
+    WEBSEARCH_REVERSE_ENGINE = getenv('WEBSEARCH_REVERSE_ENGINE')
+if getenv('WEBSEARCH_REVERSE_INDEX'):
+    WEBSEARCH_REVERSE_INDEX = getenv('WEBSEARCH_REVERSE_INDEX')
+REVERSE_INDEX = None
+REVERSE_INDEX_VERSION = None
+REVERSE_INDEX_LOCK = Lock()
+
+# Batch endpoints, maximum number of points and points processed at once
+WEBSEARCH_BATCH_MAX_POINTS = 10000
+WEBSEARCH_BATCH_CHUNK = 500
+if getenv('WEBSEARCH_BATCH_MAX_POINTS'):
+    WEBSEARCH_BATCH_MAX_POINTS = int(getenv('WEBSEARCH_BATCH_MAX_POINTS'))
+if getenv('WEBSEARCH_BATCH_CHUNK'):
+    WEBSEARCH_BATCH_CHUNK = int(getenv('WEBSEARCH_BATCH_CHUNK'))
+# Bulk search endpoint, number of queries searched concurrently
+WEBSEARCH_BULK_THREADS = 4
+if getenv('WEBSEARCH_BULK_THREADS'):
+    WEBSEARCH_BULK_THREADS = int(getenv('WEBSEARCH_BULK_THREADS'))
+
+# Prefix trie answering short autocomplete queries, built by sphinx-reindex.sh
+WEBSEARCH_PREFIX_TRIE = 0
+WEBSEARCH_PREFIX_TRIE_FILE = '/data/index/prefix.trie'
+if getenv('WEBSEARCH_PREFIX_TRIE'):
+    WEBSEARCH_PREFIX_TRIE = int(getenv('WEBSEARCH_PREFIX_TRIE'))
+if getenv('WEBSEARCH_PREFIX_TRIE_FILE'):
+    WEBSEARCH_PREFIX_TRIE_FILE = getenv('WEBSEARCH_PREFIX_TRIE_FILE')
+PREFIX_TRIE = None
+PREFIX_TRIE_VERSION = None
+PREFIX_TRIE_LOCK = Lock()
+
+# Docstore of the wide string attributes, written by sphinx-reindex.sh. With
+# WEBSEARCH_DOCSTORE=1 the indexes are built with the reduced schema and the
+# final page of the results is hydrated from the docstore and delta rows.
+WEBSEARCH_DOCSTORE = 0
+WEBSEARCH_DOCSTORE_FILE = DOCSTORE_FILE
+if getenv('WEBSEARCH_DOCSTORE'):
+    WEBSEARCH_DOCSTORE = int(getenv('WEBSEARCH_DOCSTORE'))
+if getenv('WEBSEARCH_DOCSTORE_FILE'):
+    WEBSEARCH_DOCSTORE_FILE = getenv('WEBSEARCH_DOCSTORE_FILE')
+# (docstore, docstore attributes of the delta documents by id)
+DOCSTORE = (None, {})
+DOCSTORE_VERSION = None
+DOCSTORE_LOCK = Lock()
+# (rows of the delta documents by id, ids masked by the kill-lists of deltas),
+# the spatial grid and prefix trie are built from the input data only
+DELTAS = ({}, frozenset())
+DELTAS_VERSION = None
+DELTAS_LOCK = Lock()
+
+# Result cache warmup with the most frequent searches of the searchd query log,
+# at start and after data change, number of searches (0 = disabled) and time limit
+WEBSEARCH_WARMUP = 0
+WEBSEARCH_WARMUP_TIME = 60
+WEBSEARCH_WARMUP_LOG = warmup.QUERY_LOG
+if getenv('WEBSEARCH_WARMUP'):
+    WEBSEARCH_WARMUP = int(getenv('WEBSEARCH_WARMUP'))
+if getenv('WEBSEARCH_WARMUP_TIME'):
+    WEBSEARCH_WARMUP_TIME = float(getenv('WEBSEARCH_WARMUP_TIME'))
+if getenv('WEBSEARCH_WARMUP_LOG'):
+    WEBSEARCH_WARMUP_LOG = getenv('WEBSEARCH_WARMUP_LOG')
+# Each worker warms up its own result cache after data change, started at
+# random within WEBSEARCH_WARMUP_STAGGER seconds to spread the load of searchd
+# (searchd itself is warmed up by sphinx-reindex.sh)
+WEBSEARCH_WARMUP_STAGGER = 10
+if getenv('WEBSEARCH_WARMUP_STAGGER'):
+    WEBSEARCH_WARMUP_STAGGER = float(getenv('WEBSEARCH_WARMUP_STAGGER'))
+
+# Metrics exposed on /metrics in Prometheus text format, 0 disables them.
+# Worker processes write snapshots of their metrics into the directory
+# at most every WEBSEARCH_METRICS_INTERVAL seconds, merged by /metrics.
+WEBSEARCH_METRICS = 1
+WEBSEARCH_METRICS_DIR = '/tmp/websearch-metrics'
+WEBSEARCH_METRICS_INTERVAL = 5
+if getenv('WEBSEARCH_METRICS'):
+    WEBSEARCH_METRICS = int(getenv('WEBSEARCH_METRICS'))
+if getenv('WEBSEARCH_METRICS_DIR'):
+    WEBSEARCH_METRICS_DIR = getenv('WEBSEARCH_METRICS_DIR')
+if getenv('WEBSEARCH_METRICS_INTERVAL'):
+    WEBSEARCH_METRICS_INTERVAL = float(getenv('WEBSEARCH_METRICS_INTERVAL'))
+METRICS = Metrics(WEBSEARCH_METRICS_DIR, WEBSEARCH_METRICS_INTERVAL,
+                  WEBSEARCH_METRICS > 0)
+METRICS.describe('websearch_request_duration_seconds', 'histogram',
+                 'Duration of requests by endpoint.')
+METRICS.describe('websearch_requests_total', 'counter',
+                 'Requests by endpoint and status code.')
+METRICS.describe('websearch_index_query_duration_seconds', 'histogram',
+                 'Duration of queries of the cascade by index.')
+METRICS.describe('websearch_modifier_duration_seconds', 'histogram',
+                 'Duration of queries of the cascade by query modifier.')
+METRICS.describe('websearch_cascade_depth', 'histogram',
+                 'Number of cascade steps processed by a search.',
+                 (1, 2, 3, 4, 5, 6, 8, 10, 12, 14))
+METRICS.describe('websearch_result_modifier_total', 'counter',
+                 'Searches by query modifier of the final result.')
+METRICS.describe('websearch_connection_errors_total', 'counter',
+                 'Failed or broken connections to searchd.')
+METRICS.describe('websearch_cache_hits_total', 'counter',
+                 'Hits of the result cache.')
+METRICS.describe('websearch_cache_misses_total', 'counter',
+                 'Misses of the result cache.')
+METRICS.describe('websearch_cache_evictions_total', 'counter',
+                 'Entries evicted from the result cache.')
+METRICS.describe('websearch_cache_expirations_total', 'counter',
+                 'Entries expired in the result cache.')
+METRICS.describe('websearch_cache_entries', 'gauge',
+                 'Entries of the result cache.')
 
 
 app = Flask(__name__, template_folder='templates/')
@@ -58,26 +294,154 @@ app.debug = not (getenv('WEBSEARCH_DEBUG') is None)
 
 
 # ---------------------------------------------------------
+class SphinxConnectionPool(object):
+    """
+    Pool of persistent SphinxQL connections to searchd.
+
+    Connections idle for more than ping_after seconds are checked before
+    reuse, connections idle for more than max_idle seconds are closed.
+    The pool is dropped after fork, so uwsgi workers never share sockets.
+    """
+
+    def __init__(self, size, max_idle, ping_after):
+        self.size = size
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self.lock = Lock()
+        self.idle = deque()
+        self.pid = getpid()
+
+    def connect(self):
+        # connect to the mysql server
+        # default server configuration
+        host = '127.0.0.1'
+        port = 9306
+        if getenv('WEBSEARCH_SERVER'):
+            host = getenv('WEBSEARCH_SERVER')
+        if getenv('WEBSEARCH_SERVER_PORT'):
+            port = int(getenv('WEBSEARCH_SERVER_PORT'))
+
+        # Multi statements are used for batches of cascade queries
+        return MySQLdb.connect(host=host, port=port, user='root',
+                               client_flag=CLIENT.MULTI_STATEMENTS)
+
+    def evict(self, now):
+        """Remove expired connections, return them to be closed (lock held)."""
+        if self.pid != getpid():
+            # Forked worker - forget connections of the parent process
+            self.idle = deque()
+            self.pid = getpid()
+        expired = []
+        while self.idle and now - self.idle[0][1] > self.max_idle:
+            expired.append(self.idle.popleft()[0])
+        return expired
+
+    def get(self):
+        """Borrow healthy connection from the pool or open a new one."""
+        while True:
+            now = time()
+            db = None
+            with self.lock:
+                expired = self.evict(now)
+                if self.idle:
+                    db, last_used = self.idle.pop()
+            for old_db in expired:
+                self.close(old_db)
+            if db is None:
+                return self.connect()
+            if now - last_used <= self.ping_after:
+                return db
+            try:
+                db.ping()
+                return db
+            except MySQLdb.Error:
+                self.close(db)
+
+    def put(self, db, broken=False):
+        """Return borrowed connection, broken connections are closed."""
+        if not broken:
+            now = time()
+            with self.lock:
+                expired = self.evict(now)
+                if len(self.idle) < self.size:
+                    self.idle.append((db, now))
+                    db = None
+            for old_db in expired:
+                self.close(old_db)
+        if db is not None:
+            self.close(db)
+
+    def clear(self):
+        """Close all idle connections."""
+        with self.lock:
+            idle = self.idle
+            self.idle = deque()
+        for db, last_used in idle:
+            self.close(db)
+
+    @staticmethod
+    def close(db):
+        try:
+            db.close()
+        except MySQLdb.Error:
+            pass
+
+
+DB_POOL = SphinxConnectionPool(WEBSEARCH_POOL_SIZE, WEBSEARCH_POOL_MAX_IDLE,
+                               WEBSEARCH_POOL_PING_AFTER)
+
+
 def get_db_cursor():
-    # connect to the mysql server
-    # default server configuration
-    host = '127.0.0.1'
-    port = 9306
-    if getenv('WEBSEARCH_SERVER'):
-        host = getenv('WEBSEARCH_SERVER')
-    if getenv('WEBSEARCH_SERVER_PORT'):
-        port = int(getenv('WEBSEARCH_SERVER_PORT'))
-
-    db = MySQLdb.connect(host=host, port=port, user='root')
+    """Borrow connection from the pool, return it with release_db_cursor."""
+    try:
+        db = DB_POOL.get()
+    except Exception:
+        METRICS.inc('websearch_connection_errors_total')
+        raise
     cursor = db.cursor()
     return db, cursor
 
 
+def release_db_cursor(db, cursor, broken=False):
+    """Return connection borrowed by get_db_cursor back to the pool."""
+    try:
+        cursor.close()
+    except MySQLdb.Error:
+        broken = True
+    if broken:
+        METRICS.inc('websearch_connection_errors_total')
+    DB_POOL.put(db, broken)
+
+
+def execute_query(sql, args):
+    """
+    Get result from SQL Query using pooled connection.
+
+    Query is retried once on a new connection, if the pooled one went away.
+    """
+    for attempt in range(2):
+        try:
+            db, cursor = get_db_cursor()
+        except Exception as ex:
+            return False, {
+                'matches': [],
+                'status': False,
+                'total_found': 0,
+                'message': str(ex),
+            }
+        status, result = get_query_result(cursor, sql, args)
+        broken = result.pop('connection_error', False)
+        release_db_cursor(db, cursor, broken)
+        if not broken:
+            break
+    return status, result
+
+
 def get_query_result(cursor, sql, args):
     """
     Get result from SQL Query.
 
-    Boolean, {'matches': [{'weight': 0, 'id', 'attrs': {}}], 'total_found': 0}
+    Boolean, {'matches': [Match], 'total_found': 0}
     """
     status = False
     result = {
@@ -88,59 +452,102 @@ def get_query_result(cursor, sql, args):
     try:
         q = cursor.execute(sql, args)  # noqa
         # pprint([sql, args, cursor._last_executed, q])
-        desc = cursor.description
-        matches = []
+        result['matches'] = get_cursor_matches(cursor)
         status = True
-        for row in cursor:
-            match = {
-                'weight': 0,
-                'attrs': {},
-                'id': 0,
-            }
-            for (name, value) in zip(desc, row):
-                col = name[0]
-                if col == 'id':
-                    match['id'] = value
-                elif col == 'weight':
-                    match['weight'] = value
-                else:
-                    match['attrs'][col] = value
-            matches.append(match)
-        # ~ for row in cursor
-        result['matches'] = matches
 
         cursor.execute('SHOW META LIKE %s', ('total_found',))
-        for row in cursor:
-            result['total_found'] = int(row[1])
+        result['total_found'] = get_cursor_total_found(cursor)
     except Exception as ex:
         result['message'] = str(ex)
+        if isinstance(ex, MySQLdb.OperationalError):
+            result['connection_error'] = True
 
     result['status'] = status
     return status, result
 
 
+def get_batch_query_result(cursor, queries, meta=True):
+    """
+    Get results from SQL Queries sent in one multi-statement batch.
+
+    Each query is followed by SHOW META in the batch, unless meta is False.
+    searchd stops processing the batch on the first failed statement,
+    so results of the queries before the failure are returned with the exception.
+
+    [(Boolean, {'matches': [...], 'total_found': 0}), ...], exception or None
+    """
+    statements = []
+    batch_args = []
+    for sql, args in queries:
+        statements.append(sql.rstrip().rstrip(';'))
+        if meta:
+            statements.append("SHOW META LIKE 'total_found'")
+        batch_args.extend(args)
+
+    results = []
+    try:
+        cursor.execute(';\n'.join(statements), batch_args)
+        for i in range(len(queries)):
+            if i > 0:
+                cursor.nextset()
+            matches = get_cursor_matches(cursor)
+            total_found = len(matches)
+            if meta:
+                cursor.nextset()
+                total_found = get_cursor_total_found(cursor)
+            results.append((True, {
+                'matches': matches,
+                'status': True,
+                'total_found': total_found,
+            }))
+        while cursor.nextset():
+            pass
+    except Exception as ex:
+        return results, ex
+    return results, None
+
+
+def get_cursor_matches(cursor):
+    """Read matches from the current cursor result set."""
+    columns = get_columns(tuple(name[0] for name in cursor.description))
+    return [Match.from_row(row, columns) for row in cursor]
+
+
+def get_cursor_total_found(cursor):
+    """Read total_found from the current SHOW META result set."""
+    total_found = 0
+    for row in cursor:
+        total_found = int(row[1])
+    return total_found
+
+
 # ---------------------------------------------------------
 def get_attributes_values(index, attributes):
     """
     Get attributes distinct values, using data from index.
 
-    dict[ attribute ] = list(values)
+    Return dict[ attribute ] = frozenset(values) or None
     """
-    global ATTR_VALUES
+    if isinstance(attributes, str):
+        attributes = [attributes, ]
+    if WEBSEARCH_BACKEND == 'embedded':
+        embedded = get_embedded_index()
+        if embedded is None:
+            return None
+        return embedded.attribute_values(attributes)
 
     try:
         db, cursor = get_db_cursor()
     except Exception as ex:
         print(str(ex))
-        return False
+        return None
 
     # Loop over attributes
-    if isinstance(attributes, str):
-        attributes = [attributes, ]
 
+    attr_values = {}
     for attr in attributes:
         # clear values
-        ATTR_VALUES[attr] = []
+        attr_values[attr] = []
         count = 200
         total_found = 0
         # get attributes values for index
@@ -152,32 +559,151 @@ def get_attributes_values(index, attributes):
                 cursor.execute(sql_query.format(attr, index, attr, found, count), ())
                 for row in cursor:
                     found += 1
-                    ATTR_VALUES[attr].append(str(row[0]))
+                    attr_values[attr].append(str(row[0]))
                 if total_found == 0:
                     cursor.execute(sql_meta, ('total_found',))
                     for row in cursor:
                         total_found = int(row[1])
                         # Skip this attribute, if total found is more than max_matches
                         if total_found > 1000:
-                            del(ATTR_VALUES[attr])
+                            del(attr_values[attr])
                             found = total_found
             if found == 0:
-                del(ATTR_VALUES[attr])
+                del(attr_values[attr])
+            else:
+                attr_values[attr] = frozenset(attr_values[attr])
         except Exception as ex:
-            db.close()
+            release_db_cursor(db, cursor, isinstance(ex, MySQLdb.OperationalError))
             print(str(ex))
-            return False
+            return None
 
-    db.close()
-    return True
+    release_db_cursor(db, cursor)
+    return attr_values
+
+
+def get_attr_values(version=None):
+    """
+    Attribute values for validation of filters, loaded lazily for the data
+    version from the snapshot or from searchd.
+    """
+    global ATTR_VALUES, ATTR_VALUES_VERSION, ATTR_VALUES_CHECKED
+
+    if version is None:
+        version = get_data_version()
+    if version == ATTR_VALUES_VERSION or not CHECK_ATTR_FILTER:
+        return ATTR_VALUES
+    with ATTR_VALUES_LOCK:
+        if version == ATTR_VALUES_VERSION:
+            return ATTR_VALUES
+        now = time()
+        if ATTR_VALUES_VERSION is None and now - ATTR_VALUES_CHECKED < ATTR_VALUES_RETRY:
+            return ATTR_VALUES
+        ATTR_VALUES_CHECKED = now
+        return load_attr_values(version)
+
+
+def load_attr_values(version):
+    """Load the attribute values of the data version, called with ATTR_VALUES_LOCK."""
+    global ATTR_VALUES, ATTR_VALUES_VERSION
+
+    attr_values = {}
+    try:
+        attr_values = load_snapshot(WEBSEARCH_ATTR_SNAPSHOT, CHECK_ATTR_FILTER)
+    except (IOError, OSError, ValueError):
+        pass
+    missing = [attr for attr in CHECK_ATTR_FILTER if attr not in attr_values]
+    if missing:
+        loaded = get_attributes_values('ind_name_exact', missing)
+        if loaded is None:
+            # Retried later, values of the snapshot are used meanwhile
+            version = None
+        else:
+            attr_values.update(loaded)
+    if attr_values or version is not None:
+        ATTR_VALUES = attr_values
+    ATTR_VALUES_VERSION = version
+    return ATTR_VALUES
 
 
 # ---------------------------------------------------------
-def process_search_index(index, query, query_filter, start=0, count=0, field_weights=''):
+def get_embedded_index(version=None):
+    """
+    Embedded index of the input data, rebuilt when the input data change.
+
+    Input file is checked once per data version.
+    """
+    global EMBEDDED_INDEX, EMBEDDED_INDEX_MTIME, EMBEDDED_INDEX_VERSION
+
+    if version is None:
+        version = get_data_version()
+    if version == EMBEDDED_INDEX_VERSION:
+        return EMBEDDED_INDEX
+    with EMBEDDED_INDEX_LOCK:
+        if version == EMBEDDED_INDEX_VERSION:
+            return EMBEDDED_INDEX
+        input_file = WEBSEARCH_EMBEDDED_INPUT or default_input()
+        try:
+            mtime = path.getmtime(input_file)
+            if mtime != EMBEDDED_INDEX_MTIME:
+                started = time()
+                EMBEDDED_INDEX = EmbeddedIndex(input_file)
+                EMBEDDED_INDEX_MTIME = mtime
+                print('Embedded index of {} rows built in {:.1f}s'.format(
+                    len(EMBEDDED_INDEX), time() - started))
+        except (IOError, OSError, ValueError) as ex:
+            print >> sys.stderr, 'Embedded index not available: ' + str(ex)
+        EMBEDDED_INDEX_VERSION = version
+    return EMBEDDED_INDEX
+
+
+def search_embedded_index(index, query, query_filter, start, count, field_weights):
+    """Search the embedded index, return status and result as execute_query."""
+    embedded = get_embedded_index()
+    if embedded is None:
+        return False, {
+            'matches': [],
+            'status': False,
+            'total_found': 0,
+            'message': 'Embedded index not available.',
+        }
+    result = embedded.search(index, query, query_filter, start, count,
+                             field_weights, SEARCH_MAX_MATCHES)
+    status = result.get('status', True)
+    result['status'] = status
+    return status, result
+
+
+# ---------------------------------------------------------
+def process_search_index(index, query, query_filter, start=0, count=0, field_weights='',
+                         max_count=None):
     """Process query to Sphinx searchd with mysql."""
+    status, result, sql, args = prepare_search_index(
+        index, query, query_filter, start, count, field_weights, max_count)
+    if not status:
+        return status, result
+
+    if WEBSEARCH_BACKEND == 'embedded':
+        status, query_result = search_embedded_index(
+            index, query, query_filter, start, result['count'], field_weights)
+    else:
+        status, query_result = execute_query(sql, args)
+    result.update(query_result)
+    result['status'] = status
+    return status, result
+
+
+def prepare_search_index(index, query, query_filter, start=0, count=0, field_weights='',
+                         max_count=None):
+    """
+    Prepare SphinxQL query for process_search_index.
+
+    Count is limited by SEARCH_MAX_COUNT, or max_count of the internal
+    searches (candidates of the cursor pages).
+    Return status, result template, SQL query and its arguments
+    """
     if count == 0:
         count = SEARCH_DEFAULT_COUNT
-    count = min(SEARCH_MAX_COUNT, count)
+    count = min(max_count or SEARCH_MAX_COUNT, count)
 
     status = True
     result = {
@@ -189,16 +715,9 @@ def process_search_index(index, query, query_filter, start=0, count=0, field_wei
         'status': status,
     }
 
-    try:
-        db, cursor = get_db_cursor()
-    except Exception as ex:
-        status = False
-        result['message'] = str(ex)
-        result['status'] = status
-        return status, result
-
     argsFilter = []
     whereFilter = []
+    attr_values = get_attr_values()
 
     # Prepare filter for query
     for f in ['class', 'type', 'street', 'city', 'county', 'state', 'country_code', 'country']:
@@ -206,11 +725,11 @@ def process_search_index(index, query, query_filter, start=0, count=0, field_wei
             continue
         inList = []
         for val in query_filter[f]:
-            if f in ATTR_VALUES and val not in ATTR_VALUES[f]:
+            if f in attr_values and val not in attr_values[f]:
                 status = False
                 result['message'] = 'Invalid attribute value.'
                 result['status'] = status
-                return status, result
+                return status, result, None, None
             argsFilter.append(val)
             inList.append('%s')
         # Creates where condition: f in (%s, %s, %s...)
@@ -261,7 +780,8 @@ def process_search_index(index, query, query_filter, start=0, count=0, field_wei
     #  - 'max_query_time' - integer (max search time threshold, msec)
     #  - 'retry_count' - integer (distributed retries count)
     #  - 'retry_delay' - integer (distributed retry delay, msec)
-    option = "retry_count = 2, retry_delay = 500, max_matches = 200, max_query_time = 20000"
+    option = "retry_count = 2, retry_delay = 500, max_matches = {}, max_query_time = 20000".format(
+        SEARCH_MAX_MATCHES)
     option += ", cutoff = 2000"
     option += ", ranker=expr('sum((10*lcs+5*exact_order+10*exact_hit+5*wlccs)*user_weight)*1000+bm25')"
     if len(field_weights) > 0:
@@ -280,9 +800,16 @@ def process_search_index(index, query, query_filter, start=0, count=0, field_wei
             select_boost.append('IF(name=%s,1000000,0)')
             argsBoost.append(re.sub(r"\**", "", qe))
 
+    # Two-phase retrieval selects id and the sort keys only
+    columns = '*'
+    if WEBSEARCH_TWO_PHASE and index in TWO_PHASE_INDEXES:
+        columns = ', '.join(['id'] + [s.split()[0] for s in sortBy
+                                      if s.split()[0] not in ('weight', 'id')])
+
     # Prepare SELECT
-    sql = "SELECT WEIGHT()*importance+{} as weight, * FROM {} WHERE {} ORDER BY {} LIMIT %s, %s OPTION {};".format(
+    sql = "SELECT WEIGHT()*importance+{} as weight, {} FROM {} WHERE {} ORDER BY {} LIMIT %s, %s OPTION {};".format(
         '+'.join(select_boost) if len(select_boost) > 0 else '0',
+        columns,
         index,
         ' AND '.join(whereFilter),
         ', '.join(sortBy),
@@ -290,13 +817,34 @@ def process_search_index(index, query, query_filter, start=0, count=0, field_wei
     )
 
     args = argsBoost + argsFilter + [start, count]
-    status, result = get_query_result(cursor, sql, args)
-    db.close()
+    return status, result, sql, args
 
-    result['start_index'] = start
-    result['count'] = count
-    result['status'] = status
-    return status, result
+
+# ---------------------------------------------------------
+def fetch_match_attrs(matches):
+    """
+    Attributes of the matches of the two-phase retrieval, fetched by one
+    query of the page. Matches keep their weight and order, the matches
+    of cached results are not modified.
+
+    Return matches and error message or None.
+    """
+    ids = [row.id for row in matches if row.id and row.attr('name') is None]
+    if not ids:
+        return matches, None
+    sql = "SELECT * FROM {} WHERE id IN ({}) LIMIT {} OPTION max_matches = {}".format(
+        TWO_PHASE_INDEXES[0], ', '.join(['%s'] * len(ids)), len(ids), len(ids))
+    status, result = execute_query(sql, ids)
+    if not status:
+        return matches, result.get('message')
+    rows = dict((row.id, row) for row in result['matches'])
+    fetched = []
+    for row in matches:
+        found = rows.get(row.id)
+        if found is not None and row.attr('name') is None:
+            row = Match(row.id, row.weight, found.row, found.columns)
+        fetched.append(row)
+    return fetched, None
 
 
 # ---------------------------------------------------------
@@ -304,45 +852,42 @@ def mergeResultObject(result_old, result_new):
     """
     Merge two result objects into one.
 
-    Order matches by weight
+    Order matches by weight, matches with the same weight keep their order
+    (old before new). Only first #count matches are kept.
     """
-    # Merge matches
-    weight_matches = {}
-    unique_id = 0
-    unique_ids_list = []
-
+    # Merge matches, skip duplicates
+    unique_ids = set()
+    merged = []
+    duplicates = 0
     for matches in [result_old['matches'], result_new['matches'], ]:
         for row in matches:
-            if row['id'] in unique_ids_list:
-                result_old['total_found'] -= 1  # Decrease total found number
+            if row.id in unique_ids:
+                duplicates += 1
                 continue
-            unique_ids_list.append(row['id'])
-            weight = str(row['weight'])
-            if weight in weight_matches:
-                weight += '_{}'.format(unique_id)
-                unique_id += 1
-            weight_matches[weight] = row
-
-    # Sort matches according to the weight and unique id
-    sorted_matches = natsort.natsorted(weight_matches.items(), reverse=True)
-    matches = []
-    i = 0
-    for row in sorted_matches:
-        matches.append(row[1])
-        i += 1
-        # Append only first #count rows
-        if 'count' in result_old and i >= result_old['count']:
-            break
+            unique_ids.add(row.id)
+            merged.append(row)
+
+    # Sort matches according to the weight, both sorts are stable
+    if 'count' in result_old:
+        matches = heapq.nsmallest(result_old['count'], merged, key=negative_weight)
+    else:
+        matches = sorted(merged, key=negative_weight)
 
     result = result_old.copy()
     result['matches'] = matches
-    result['total_found'] += result_new['total_found']
+    # Decrease total found number by duplicates
+    result['total_found'] = result_old['total_found'] - duplicates + result_new['total_found']
     if 'message' in result_new and result_new['message']:
-        result['message'] = ', '.join(result['message'], result_new['message'])
+        messages = [result.get('message'), result_new['message']]
+        result['message'] = ', '.join([m for m in messages if m])
 
     return result
 
 
+def negative_weight(row):
+    return -row.weight
+
+
 # ---------------------------------------------------------
 def prepareResultJson(result):
     """Prepare JSON from pure Result array from SphinxQL."""
@@ -363,17 +908,23 @@ def prepareResultJson(result):
     if 'message' in result and result['message']:
         response['message'] = result['message']
 
-    for row in result['matches']:
-        r = row['attrs']
-        res = {'rank': row['weight'], 'id': row['id']}
-        for attr in r:
-            if isinstance(r[attr], str):
+    matches = result['matches']
+    if WEBSEARCH_TWO_PHASE:
+        matches, message = fetch_match_attrs(matches)
+        if message:
+            response['message'] = message
+    if WEBSEARCH_DOCSTORE:
+        matches = hydrate_matches(matches)
+    for row in matches:
+        res = {'rank': row.weight, 'id': row.id}
+        for attr, value in row.iterattrs():
+            if isinstance(value, str):
                 try:
-                    res[attr] = r[attr].decode('utf-8')
+                    res[attr] = value.decode('utf-8')
                 except:
-                    res[attr] = r[attr]
+                    res[attr] = value
             else:
-                res[attr] = r[attr]
+                res[attr] = value
         # Prepare bounding box from West/South/East/North attributes
         if 'west' in res:
             res['boundingbox'] = [res['west'], res['south'], res['east'], res['north']]
@@ -492,7 +1043,7 @@ def formatResponse(data, code=200):
             data['route'] = '/'
         return render_template(tpl, rc=(code == 200), **data), code
 
-    json = dumps(result)
+    json = dumps(result, default=json_default)
     mime = 'application/json'
     # Append callback for JavaScript
     if request.args.get('json_callback'):
@@ -558,11 +1109,14 @@ def modify_query_postcode(orig_query):
 
 
 # ---------------------------------------------------------
-def process_query_modifiers(orig_query, index_modifiers, debug_result, times,
-                            query_filter, start, count, debug=False):
-    """Process array of modifiers and return results."""
-    rc = False
-    result = {}
+def plan_query_modifiers(orig_query, index_modifiers):
+    """
+    Apply modifiers to the query, return steps of the cascade.
+
+    Step is (index, modify_function, field_weights, query), pairs without
+    modification of the query are left out.
+    """
+    steps = []
     proc_query = orig_query
     # Pair is (index, modify_function, [field_weights, [orig_query]])
     for pair in index_modifiers:
@@ -573,8 +1127,6 @@ def process_query_modifiers(orig_query, index_modifiers, debug_result, times,
             field_weights = pair[2]
         if len(pair) >= 4:
             proc_query = pair[3]
-        if debug and index not in times:
-            times[index] = {}
         # Cycle through few modifications of the query
         # Modification function return query with original query
         #  (possibly modified) used for the following processing
@@ -582,14 +1134,200 @@ def process_query_modifiers(orig_query, index_modifiers, debug_result, times,
         # No modification has been done
         if query is None:
             continue
-        # Process modified query
-        if debug:
-            times['start_query'] = time()
-        rc, result_new = process_search_index(
+        steps.append((index, modify, field_weights, query))
+    return steps
+
+
+def plan_step_reuse(steps, start):
+    """
+    Find cascade steps repeating the (index, query) of an earlier step.
+
+    The later step is processed only if the earlier one returned less
+    matches than requested, ie. all of them, so merge of the same matches
+    adds nothing and the earlier result is reused. Field weights change
+    the order of matches, with start offset only identical steps are reused.
+    Return index of the reused step or None for each step.
+    """
+    reuse = []
+    seen = {}
+    for i, (index, modify, field_weights, query) in enumerate(steps):
+        key = (index, query)
+        if start:
+            key += (field_weights,)
+        reuse.append(seen.get(key))
+        seen.setdefault(key, i)
+    return reuse
+
+
+def cascade_sequential(steps, query_filter, start, count, max_count=None):
+    """Process cascade steps one by one, yield (rc, result, time) per step."""
+    for index, modify, field_weights, query in steps:
+        start_query = time()
+        rc, result = process_search_index(
             index, query, query_filter,
-            start, count, field_weights)
+            start, count, field_weights, max_count)
+        yield rc, result, time() - start_query
+
+
+def cascade_batch(steps, query_filter, start, count, max_count=None):
+    """
+    Process cascade steps in multi-statement batches.
+
+    Next batch is sent only when results of the previous one are consumed,
+    yield (rc, result, time) per step. Time of the batch is divided across
+    its steps, steps processed one by one have their own time.
+    """
+    batch_size = max(1, WEBSEARCH_BATCH_QUERIES // 2)
+    for batch_start in range(0, len(steps), batch_size):
+        start_query = time()
+        prepared = []
+        for index, modify, field_weights, query in steps[batch_start:batch_start + batch_size]:
+            prepared.append(prepare_search_index(
+                index, query, query_filter,
+                start, count, field_weights, max_count))
+
+        queries = [(sql, args) for status, result, sql, args in prepared if status]
+        batch_results = []
+        if queries:
+            try:
+                db, cursor = get_db_cursor()
+            except Exception:
+                # Queries are processed one by one with their own errors
+                pass
+            else:
+                batch_results, ex = get_batch_query_result(cursor, queries)
+                release_db_cursor(db, cursor, isinstance(ex, MySQLdb.OperationalError))
+        batch_elapsed = (time() - start_query) / len(prepared)
+
+        # Queries not completed in the batch are processed one by one
+        batch_results = iter(batch_results)
+        for status, result, sql, args in prepared:
+            elapsed = batch_elapsed
+            if status:
+                start_query = time()
+                status, query_result = next(batch_results, (None, None))
+                if status is None:
+                    status, query_result = execute_query(sql, args)
+                    elapsed = time() - start_query
+                result.update(query_result)
+                result['status'] = status
+            yield status, result, elapsed
+
+
+class ParallelCascade(object):
+    """
+    Cascade steps processed concurrently on the cascade thread pool.
+
+    Results are iterated in the original order of the steps, closing the
+    cascade cancels steps which have not been started yet.
+    """
+
+    def __init__(self, steps, query_filter, start, count, max_count=None):
+        self.cancelled = Event()
+        pool = get_thread_pool('cascade', WEBSEARCH_CASCADE_THREADS)
+        self.pending = []
+        for step in steps:
+            self.pending.append(pool.apply_async(
+                self.process_step, (step, query_filter, start, count, max_count)))
+
+    def process_step(self, step, query_filter, start, count, max_count):
+        if self.cancelled.is_set():
+            return None
+        index, modify, field_weights, query = step
+        start_query = time()
+        rc, result = process_search_index(
+            index, query, query_filter,
+            start, count, field_weights, max_count)
+        return rc, result, time() - start_query
+
+    def __iter__(self):
+        for pending in self.pending:
+            yield pending.get()
+
+    def close(self):
+        self.cancelled.set()
+
+
+def get_thread_pool(name, size):
+    """Thread pool of the given name, created in each worker process."""
+    with THREAD_POOLS_LOCK:
+        pid, pool = THREAD_POOLS.get(name, (None, None))
+        if pool is None or pid != getpid():
+            pool = ThreadPool(size)
+            THREAD_POOLS[name] = (getpid(), pool)
+    return pool
+
+
+CASCADE_MODES = {
+    'sequential': cascade_sequential,
+    'batch': cascade_batch,
+    'parallel': ParallelCascade,
+}
+
+
+def start_query_modifiers(orig_query, index_modifiers, query_filter, start, count, depth=0):
+    """
+    Plan cascade steps and start the executor for steps not reused,
+    return steps, reused steps and cascade.
+    """
+    steps = plan_query_modifiers(orig_query, index_modifiers)
+    reuse = plan_step_reuse(steps, start)
+    max_count = None
+    if depth:
+        count, max_count = depth, SEARCH_MAX_MATCHES
+    cascade = CASCADE_MODES.get(WEBSEARCH_CASCADE_MODE, cascade_sequential)(
+        [step for step, reused in izip(steps, reuse) if reused is None],
+        query_filter, start, count, max_count)
+    return steps, reuse, cascade
+
+
+def process_query_modifiers(orig_query, index_modifiers, debug_result, times,
+                            query_filter, start, count, debug=False, started=None, depth=0):
+    """
+    Process array of modifiers and return results.
+
+    With depth, steps fetch up to depth matches (up to max_matches) and the
+    cascade stops at the same step as the search of count matches.
+    """
+    rc = False
+    result = {}
+    if started is None:
+        started = start_query_modifiers(
+            orig_query, index_modifiers, query_filter, start, count, depth)
+    enough = None
+    if depth:
+        enough = min(SEARCH_MAX_COUNT, count or SEARCH_DEFAULT_COUNT)
+    steps, reuse, cascade = started
+    processed = iter(cascade)
+    step_results = []
+    for step, reused in izip(steps, reuse):
+        index, modify, field_weights, query = step
+        debug_result['steps'] = debug_result.get('steps', 0) + 1
+        if reused is None:
+            rc, result_new, elapsed = next(processed)
+        elif step_results[reused][0]:
+            rc, result_new = step_results[reused]
+            elapsed = None
+            debug_result['steps_reused'] = debug_result.get('steps_reused', 0) + 1
+        else:
+            # Reused step failed, try again
+            start_query = time()
+            rc, result_new = process_search_index(
+                index, query, query_filter, start, depth or count, field_weights,
+                SEARCH_MAX_MATCHES if depth else None)
+            elapsed = time() - start_query
+        if elapsed is None:
+            elapsed = 0.0
+        else:
+            METRICS.observe('websearch_index_query_duration_seconds',
+                            (('index', index), ), elapsed)
+            METRICS.observe('websearch_modifier_duration_seconds',
+                            (('modifier', modify.__name__), ), elapsed)
+        step_results.append((rc, result_new))
         if debug:
-            times[index][modify.__name__] = time() - times['start_query']
+            if index not in times:
+                times[index] = {}
+            times[index][modify.__name__] = elapsed
         if rc and 'matches' in result_new and len(result_new['matches']) > 0:
             # Merge matches with previous result
             if 'matches' in result and len(result['matches']) > 0:
@@ -603,18 +1341,639 @@ def process_query_modifiers(orig_query, index_modifiers, debug_result, times,
             debug_result['query_succeed'].append(query.decode('utf-8'))
             debug_result['index_succeed'].append(index.decode('utf-8'))
             # Only break, if we have enough matches
-            if len(result['matches']) >= result['count']:
+            if len(result['matches']) >= (enough or result['count']):
                 break
         elif 'matches' not in result:
             result = result_new
-    # for pair in index_modifiers
+    # for step in steps
+    cascade.close()
     return rc, result
 
 
 # ---------------------------------------------------------
+class ResultCache(object):
+    """
+    LRU cache of results with TTL, bounded by entries and cached rows.
+
+    All entries are dropped when the data version changes. Cached values are
+    shared between requests and must not be modified.
+    """
+
+    def __init__(self, size, max_rows, ttl):
+        self.size = size
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.rows = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, version):
+        """Return cached value or None."""
+        with self.lock:
+            if version != self.version:
+                self.reset(version)
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] < time():
+                self.rows -= entry[1]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # Move entry to the end (most recently used)
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value, rows, version):
+        """Store value, which counts as rows towards the rows limit."""
+        if self.size <= 0 or rows > self.max_rows:
+            return
+        with self.lock:
+            if version != self.version:
+                self.reset(version)
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.rows -= old[1]
+            self.entries[key] = (time() + self.ttl, rows, value)
+            self.rows += rows
+            while len(self.entries) > self.size or self.rows > self.max_rows:
+                old = self.entries.popitem(last=False)[1]
+                self.rows -= old[1]
+                self.evictions += 1
+
+    def reset(self, version):
+        """Drop all entries (lock held)."""
+        self.entries.clear()
+        self.rows = 0
+        self.version = version
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'rows': self.rows,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+RESULT_CACHE = ResultCache(WEBSEARCH_CACHE_SIZE, WEBSEARCH_CACHE_ROWS,
+                           WEBSEARCH_CACHE_TTL)
+
+
+def get_data_version():
+    """
+    Get modification time of data timestamp, published by the data watcher
+    or checked in intervals without it.
+    """
+    global DATA_VERSION, DATA_VERSION_CHECKED, DATA_LAST_MODIFIED
+
+    if DATA_WATCHER_PID == getpid():
+        return DATA_VERSION
+    now = time()
+    if now - DATA_VERSION_CHECKED >= WEBSEARCH_CACHE_CHECK:
+        try:
+            version = path.getmtime(TMPFILE_DATA_TIMESTAMP)
+        except OSError:
+            version = DATA_VERSION
+        DATA_VERSION_CHECKED = now
+        if version != DATA_VERSION:
+            DATA_LAST_MODIFIED = email.utils.formatdate(version, usegmt=True)
+            DATA_VERSION = version
+    return DATA_VERSION
+
+
+def refresh_data_version(version):
+    """
+    Load data of the new version off the request path, in the data watcher
+    thread, then publish the version to requests.
+    """
+    global DATA_VERSION, DATA_LAST_MODIFIED
+
+    if WEBSEARCH_BACKEND == 'embedded':
+        get_embedded_index(version)
+    get_attr_values(version)
+    if WEBSEARCH_REVERSE_ENGINE == 'grid':
+        get_reverse_index(version)
+    if WEBSEARCH_REVERSE_ENGINE == 'grid' or WEBSEARCH_PREFIX_TRIE:
+        get_deltas(version)
+    if WEBSEARCH_PREFIX_TRIE:
+        get_prefix_trie(version)
+    if WEBSEARCH_DOCSTORE:
+        get_docstore(version)
+    DATA_LAST_MODIFIED = email.utils.formatdate(version, usegmt=True)
+    DATA_VERSION = version
+    print('Data version {:.0f} published'.format(version))
+    if WEBSEARCH_WARMUP > 0 and WEBSEARCH_CACHE_SIZE > 0:
+        sleep(random.uniform(0, WEBSEARCH_WARMUP_STAGGER))
+        warmup_result_cache()
+
+
+@app.before_request
+def start_data_watcher():
+    """Start the data watcher thread in the worker process."""
+    global DATA_WATCHER_PID
+
+    if DATA_WATCHER_PID == getpid():
+        return
+    with DATA_WATCHER_LOCK:
+        if DATA_WATCHER_PID != getpid():
+            watcher = DataWatcher(TMPFILE_DATA_TIMESTAMP, refresh_data_version,
+                                  DATA_VERSION, WEBSEARCH_CACHE_CHECK)
+            watcher.start()
+            DATA_WATCHER_PID = getpid()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time()
+
+
+@app.after_request
+def add_data_version_header(resp):
+    """Expose the data version of the response."""
+    resp.headers['X-Data-Version'] = '{:.0f}'.format(DATA_VERSION)
+    return resp
+
+
+@app.after_request
+def observe_request(resp):
+    """Metrics of the request, snapshot of the worker is written in intervals."""
+    endpoint = request.endpoint or 'none'
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        METRICS.observe('websearch_request_duration_seconds',
+                        (('endpoint', endpoint), ), time() - started)
+    METRICS.inc('websearch_requests_total',
+                (('endpoint', endpoint), ('code', str(resp.status_code))))
+    if METRICS.enabled:
+        observe_cache()
+        METRICS.write()
+    return resp
+
+
+def observe_cache():
+    """Counters of the result cache, maintained by the cache itself."""
+    stats = RESULT_CACHE.stats()
+    for name in ('hits', 'misses', 'evictions', 'expirations'):
+        METRICS.set('websearch_cache_{}_total'.format(name), (), stats[name])
+    METRICS.set('websearch_cache_entries', (), stats['entries'])
+
+
+@app.route('/metrics')
+def metrics():
+    """Metrics of all worker processes in Prometheus text format."""
+    if not METRICS.enabled:
+        return Response('Metrics are disabled.\n', status=404, mimetype='text/plain')
+    observe_cache()
+    resp = Response(METRICS.render(METRICS.collect()),
+                    mimetype='text/plain; version=0.0.4')
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+def normalize_query(query):
+    """Normalize whitespace in the query, used by cache keys and searching."""
+    return ' '.join(query.split())
+
+
+def query_filter_key(query_filter):
+    """Hashable representation of query filter."""
+    key = []
+    for f in sorted(query_filter):
+        val = query_filter[f]
+        if val is None:
+            continue
+        if isinstance(val, list):
+            val = tuple(val)
+        key.append((f, val))
+    return tuple(key)
+
+
+# ---------------------------------------------------------
+def warmup_searches(entries, top):
+    """
+    Most frequent searches of the query log, as arguments of search().
+
+    Search is recognized by its first ind_name_exact step, name field weight
+    1000 is autocomplete query, 800 is the original query. The original
+    query step of autocomplete search is skipped only if it follows in the
+    same cascade, right after both autocomplete steps on the connection
+    (pooled connections carry statements of many searches).
+    """
+    searches = Counter()
+    previous = {}
+    for conn, sql in entries:
+        select = warmup.parse_select(sql)
+        pending = previous.pop(conn, None)
+        if select is None:
+            continue
+        if (pending is not None and select['index'] == 'ind_name_prefix' and
+                select['name_weight'] == 900 and select['query'] == pending[1]):
+            # Autocomplete step of the prefix index, the cascade goes on
+            previous[conn] = (pending[0], pending[1], True)
+            continue
+        if select['index'] != 'ind_name_exact':
+            continue
+        query = select['query']
+        if select['name_weight'] == 1000:
+            autocomplete = True
+            query = normalize_query(query.replace('*', ''))
+            if modify_query_autocomplete(query)[0] != select['query']:
+                continue
+            previous[conn] = (query, select['query'], False)
+        elif select['name_weight'] == 800:
+            autocomplete = False
+            if pending is not None and pending[2] and pending[0] == query:
+                continue
+        else:
+            continue
+        if any(f not in ('type', 'class', 'city', 'county', 'country_code')
+               for f, values in select['filters']):
+            continue
+        searches[(query, select['filters'], autocomplete,
+                  select['start'], select['count'])] += 1
+
+    result = []
+    for (query, filters, autocomplete, start, count), n in searches.most_common(top):
+        query_filter = dict((f, list(values)) for f, values in filters)
+        result.append((query, query_filter, autocomplete, start, count))
+    return result
+
+
+def warmup_result_cache():
+    """Fill the result cache with the most frequent searches of the query log."""
+    if WEBSEARCH_WARMUP <= 0 or WEBSEARCH_CACHE_SIZE <= 0:
+        return 0
+    started = time()
+    try:
+        searches = warmup_searches(
+            warmup.parse_log(warmup.read_log(WEBSEARCH_WARMUP_LOG)),
+            WEBSEARCH_WARMUP)
+    except IOError as ex:
+        print >> sys.stderr, 'Warmup skipped, query log not available: ' + str(ex)
+        return 0
+
+    warmed = 0
+    for query, query_filter, autocomplete, start, count in searches:
+        if time() - started > WEBSEARCH_WARMUP_TIME:
+            break
+        try:
+            rc, result = search(query, query_filter, autocomplete, start,
+                                count, False, {}, {})
+        except Exception:
+            traceback.print_exc()
+            break
+        if rc:
+            warmed += 1
+    print('Warmup cached {} of {} searches in {:.1f}s'.format(
+        warmed, len(searches), time() - started))
+    return warmed
+
+
+def get_prefix_trie(version=None):
+    """Prefix trie of short autocomplete queries, reopened with new data."""
+    global PREFIX_TRIE, PREFIX_TRIE_VERSION
+
+    if version is None:
+        version = get_data_version()
+    if version == PREFIX_TRIE_VERSION:
+        return PREFIX_TRIE
+    with PREFIX_TRIE_LOCK:
+        if version != PREFIX_TRIE_VERSION:
+            try:
+                trie = PrefixTrie(WEBSEARCH_PREFIX_TRIE_FILE)
+                # The trie is built from the input data, changed rows are in deltas only
+                rows, killed = get_deltas(version)
+                trie.apply_deltas(killed, rows)
+                PREFIX_TRIE = trie
+            except (IOError, OSError, ValueError) as ex:
+                print >> sys.stderr, 'Prefix trie not available: ' + str(ex)
+                PREFIX_TRIE = None
+            PREFIX_TRIE_VERSION = version
+    return PREFIX_TRIE
+
+
+def get_docstore(version=None):
+    """Docstore and the delta documents, reopened with new data."""
+    global DOCSTORE, DOCSTORE_VERSION
+
+    if version is None:
+        version = get_data_version()
+    if version == DOCSTORE_VERSION:
+        return DOCSTORE
+    with DOCSTORE_LOCK:
+        if version != DOCSTORE_VERSION:
+            try:
+                docstore = DocStore(WEBSEARCH_DOCSTORE_FILE)
+            except (IOError, OSError, ValueError) as ex:
+                print >> sys.stderr, 'Docstore not available: ' + str(ex)
+                docstore = None
+            deltas = {}
+            for doc_id, row in get_deltas(version)[0].iteritems():
+                deltas[doc_id] = dict((col, row[COLUMN_INDEX[col]].encode('utf-8'))
+                                      for col in DOCSTORE_COLUMNS)
+            DOCSTORE = (docstore, deltas)
+            DOCSTORE_VERSION = version
+    return DOCSTORE
+
+
+def get_deltas(version=None):
+    """Delta documents and the ids killed by the deltas, reloaded with new data."""
+    global DELTAS, DELTAS_VERSION
+
+    if version is None:
+        version = get_data_version()
+    if version == DELTAS_VERSION:
+        return DELTAS
+    with DELTAS_LOCK:
+        if version != DELTAS_VERSION:
+            try:
+                state = load_delta_state()
+                DELTAS = (delta_documents(state), frozenset(delta_killed_ids(state)))
+            except (IOError, ValueError) as ex:
+                print >> sys.stderr, 'Delta documents not available: ' + str(ex)
+                DELTAS = ({}, frozenset())
+            DELTAS_VERSION = version
+    return DELTAS
+
+
+def hydrate_matches(matches):
+    """
+    Matches of the reduced indexes with attributes of the docstore.
+
+    Matches without display_name are replaced by new matches, the matches
+    of cached results are not modified.
+    """
+    docstore, deltas = get_docstore()
+    hydrated = []
+    for match in matches:
+        if match.id and match.attr('display_name') is None:
+            if match.id >= DELTA_ID_BASE:
+                doc = deltas.get(match.id)
+            else:
+                doc = docstore.get(match.id) if docstore is not None else None
+            if doc is not None:
+                attrs = match.attrs()
+                attrs.update(doc)
+                match = Match.from_attrs(match.id, match.weight, attrs)
+        hydrated.append(match)
+    return hydrated
+
+
+def search_prefix_trie(orig_query, query_filter, start, count, max_count=None):
+    """
+    Search short autocomplete query in the prefix trie.
+
+    Only country_code filter is supported, return result or None if
+    the query has to be searched with searchd.
+    """
+    for f in query_filter:
+        if f != 'country_code' and query_filter[f] is not None:
+            return None
+    trie = get_prefix_trie()
+    if trie is None:
+        return None
+    prefix = trie.prefix(orig_query)
+    if prefix is None:
+        return None
+
+    country_codes = query_filter.get('country_code')
+    attr_values = get_attr_values()
+    if country_codes and 'country_code' in attr_values:
+        for val in country_codes:
+            if val not in attr_values['country_code']:
+                return None
+    if count == 0:
+        count = SEARCH_DEFAULT_COUNT
+    count = min(max_count or SEARCH_MAX_COUNT, count)
+    found = trie.search(prefix, country_codes, start, count)
+    if found is None:
+        return None
+    matches, total_found = found
+    return {
+        'total_found': total_found,
+        'matches': matches,
+        'message': None,
+        'start_index': start,
+        'count': count,
+        'status': True,
+    }
+
+
+def search_key(orig_query, query_filter, autocomplete, start, count):
+    """Result cache key of search()."""
+    if count == 0:
+        count = SEARCH_DEFAULT_COUNT
+    return ('search', normalize_query(orig_query), query_filter_key(query_filter),
+            bool(autocomplete), start, min(SEARCH_MAX_COUNT, count))
+
+
 def search(orig_query, query_filter, autocomplete=False, start=0, count=0,
-           debug=False, times={}, debug_result={}):
-    """Common search method."""
+           debug=False, times=None, debug_result=None):
+    """Common search method, results are cached without debug."""
+    if times is None:
+        times = {}
+    if debug_result is None:
+        debug_result = {}
+    orig_query = normalize_query(orig_query)
+    if debug or WEBSEARCH_CACHE_SIZE <= 0:
+        return process_search(orig_query, query_filter, autocomplete, start,
+                              count, debug, times, debug_result)
+
+    key = search_key(orig_query, query_filter, autocomplete, start, count)
+    version = get_data_version()
+    cached = RESULT_CACHE.get(key, version)
+    if cached is not None:
+        rc, result, cached_debug_result = cached
+        debug_result.update(cached_debug_result)
+        return rc, result
+
+    rc, result = process_search(orig_query, query_filter, autocomplete, start,
+                                count, debug, times, debug_result)
+    if rc:
+        # Cached results are hydrated, cache hits need no more queries
+        matches, message = result.get('matches', []), None
+        if WEBSEARCH_TWO_PHASE:
+            matches, message = fetch_match_attrs(matches)
+        if WEBSEARCH_DOCSTORE:
+            matches = hydrate_matches(matches)
+        result = dict(result, matches=matches)
+        if message:
+            result['message'] = message
+        else:
+            RESULT_CACHE.set(key, (rc, result, dict(debug_result)),
+                             len(matches) + 1, version)
+    return rc, result
+
+
+# ---------------------------------------------------------
+# Cursors of the following pages refer to the candidates of the search,
+# up to max_matches merged matches cached in the result cache. Cursor
+# carries the search and the page issuing it, so any worker can rebuild
+# its candidates. Without the cached candidates, pages follow startIndex.
+def encode_cursor(query, query_filter, autocomplete, first_start, first_count, start, count):
+    """Opaque cursor of the page of the search."""
+    state = [query, query_filter_key(query_filter), bool(autocomplete),
+             first_start, first_count, start, count]
+    return base64.urlsafe_b64encode(dumps(state, separators=(',', ':')))
+
+
+def decode_cursor(cursor):
+    """
+    Decode the cursor of encode_cursor.
+
+    Return (query, query_filter, autocomplete, first_start, first_count,
+    start, count) or None if the cursor is invalid.
+    """
+    try:
+        state = loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        query, filters, autocomplete, first_start, first_count, start, count = state
+        query_filter = {}
+        for f, val in filters:
+            if isinstance(val, list):
+                val = [v.encode('utf-8') for v in val]
+            else:
+                val = val.encode('utf-8')
+            query_filter[f.encode('utf-8')] = val
+        return (query.encode('utf-8'), query_filter, bool(autocomplete),
+                max(0, int(first_start)), int(first_count), max(0, int(start)), int(count))
+    except (TypeError, ValueError, AttributeError, UnicodeError):
+        return None
+
+
+def candidates_key(orig_query, query_filter, autocomplete, first_start, first_count):
+    """Result cache key of the candidates of the cursor pages."""
+    return ('candidates', normalize_query(orig_query), query_filter_key(query_filter),
+            bool(autocomplete), first_start, first_count)
+
+
+def search_candidates(orig_query, query_filter, autocomplete, first_start, first_count,
+                      build=True):
+    """
+    Candidates of the pages of the search, cached.
+
+    The cascade of the page issuing the cursor (first_count matches from
+    first_start) is processed again with up to max_matches matches of its
+    steps, stopping at the same step. Matches of the issuing page, taken
+    from its cached result, keep their positions and the other matches
+    fill the rest, so the following pages never repeat them. Return None
+    if the candidates are not cached and can't be built.
+    """
+    key = candidates_key(orig_query, query_filter, autocomplete, first_start, first_count)
+    version = get_data_version()
+    if WEBSEARCH_CACHE_SIZE <= 0:
+        return None
+    cached = RESULT_CACHE.get(key, version)
+    if cached is not None or not build:
+        return cached
+    issuing = RESULT_CACHE.get(search_key(orig_query, query_filter, autocomplete,
+                                          first_start, first_count), version)
+    if issuing is None:
+        return None
+
+    rc, result = process_search(normalize_query(orig_query), query_filter, autocomplete,
+                                0, first_start + first_count, depth=SEARCH_MAX_MATCHES)
+    if rc:
+        first_matches = issuing[1]['matches']
+        first_ids = set(row.id for row in first_matches)
+        others = [row for row in result['matches'] if row.id not in first_ids]
+        matches = others[:first_start] + first_matches + others[first_start:]
+        result = dict(result, matches=matches[:SEARCH_MAX_MATCHES])
+        RESULT_CACHE.set(key, (rc, result), len(result['matches']) + 1, version)
+    return rc, result
+
+
+def search_cursor(cursor):
+    """
+    Page of the search referred by the cursor.
+
+    Return status, result and the cursor of the next page.
+    """
+    decoded = decode_cursor(cursor)
+    if decoded is None:
+        return False, {'message': 'Invalid cursor.', 'start_index': 0, 'count': 0,
+                       'total_found': 0, 'matches': []}, None
+    orig_query, query_filter, autocomplete, first_start, first_count, start, count = decoded
+    count = min(SEARCH_MAX_COUNT, count if count > 0 else SEARCH_DEFAULT_COUNT)
+
+    # Candidates are built for the page following the issuing one, expired
+    # candidates (or all without the result cache) are paged by startIndex
+    build = start == first_start + first_count
+    found = search_candidates(orig_query, query_filter, autocomplete, first_start,
+                              first_count, build)
+    if found is None:
+        rc, result = search(orig_query, query_filter, autocomplete, start, count)
+    else:
+        rc, candidates = found
+        matches = candidates['matches'][start:start + count]
+        if rc and WEBSEARCH_TWO_PHASE:
+            fetched, message = fetch_match_attrs(matches)
+            if message is None and fetched is not matches:
+                # Cached candidates are not modified, hydrated page replaces them
+                hydrated = list(candidates['matches'])
+                hydrated[start:start + len(fetched)] = fetched
+                RESULT_CACHE.set(candidates_key(orig_query, query_filter, autocomplete,
+                                                first_start, first_count),
+                                 (rc, dict(candidates, matches=hydrated)),
+                                 len(hydrated) + 1, get_data_version())
+            matches = fetched
+        result = dict(candidates, matches=matches, start_index=start, count=count)
+    if not rc:
+        return rc, result, None
+    return rc, result, next_cursor(orig_query, query_filter, autocomplete,
+                                   first_start, first_count, result)
+
+
+def next_cursor(orig_query, query_filter, autocomplete, first_start, first_count, result):
+    """Cursor of the page following the result, None on the last page."""
+    if not result.get('matches') or 'count' not in result:
+        return None
+    start = result['start_index'] + result['count']
+    if start >= min(result['total_found'], SEARCH_MAX_MATCHES):
+        return None
+    return encode_cursor(normalize_query(orig_query), query_filter, autocomplete,
+                         first_start, first_count, start, result['count'])
+
+
+def search_page(orig_query, query_filter, autocomplete=False, start=0, count=0,
+                debug=False, times=None, debug_result=None):
+    """
+    Search of the page requested by startIndex and count.
+
+    Return status, result and the cursor of the next page.
+    """
+    rc, result = search(orig_query, query_filter, autocomplete, start, count,
+                        debug, times, debug_result)
+    if not rc:
+        return rc, result, None
+    # Candidates following the page keep its matches on their positions
+    return rc, result, next_cursor(orig_query, query_filter, autocomplete,
+                                   start, result.get('count', 0), result)
+
+
+def process_search(orig_query, query_filter, autocomplete=False, start=0, count=0,
+                   debug=False, times=None, debug_result=None, depth=0):
+    """
+    Search using the cascade of query modifiers.
+
+    With depth, up to depth matches (internal, up to max_matches) of the
+    steps of the search of count matches are returned.
+    """
+    if times is None:
+        times = {}
+    if debug_result is None:
+        debug_result = {}
     # Basic steps to search - using query modifiers over different index
     # 0. Detect pure Lat Lon (2 float numbers) query [last]
     # 1. Search in PostCodes (UK)
@@ -656,21 +2015,17 @@ def search(orig_query, query_filter, autocomplete=False, start=0, count=0,
         classes = query_filter['class'] if 'class' in query_filter else []
         rev_result, distance = reverse_search(lon, lat, classes, debug)
         matches = [
-            {
-                'id': 0,
-                'weight': 0,
-                'attrs': {
-                    'name': orig_query,
-                    'display_name': orig_query,
-                    'lat': lat,
-                    'lon': lon,
-                    'west': lon,
-                    'south': lat,
-                    'east': lon,
-                    'north': lat,
-                    'type': 'latlon',
-                }
-            },
+            Match.from_attrs(0, 0, {
+                'name': orig_query,
+                'display_name': orig_query,
+                'lat': lat,
+                'lon': lon,
+                'west': lon,
+                'south': lat,
+                'east': lon,
+                'north': lat,
+                'type': 'latlon',
+            }),
         ]
         if len(rev_result['matches']):
             matches.append(rev_result['matches'][0])
@@ -682,6 +2037,15 @@ def search(orig_query, query_filter, autocomplete=False, start=0, count=0,
         }
         return True, result
 
+    # Short autocomplete queries from the prefix trie
+    if autocomplete and WEBSEARCH_PREFIX_TRIE:
+        result = search_prefix_trie(orig_query, query_filter, start, depth or count,
+                                    SEARCH_MAX_MATCHES if depth else None)
+        if result is not None:
+            debug_result['modify'] = ['prefix_trie']
+            observe_cascade(debug_result)
+            return True, result
+
     # 1. PostCodes (GB)
     index_modifiers.append((
         'ind_postcodes_infix',
@@ -743,13 +2107,50 @@ def search(orig_query, query_filter, autocomplete=False, start=0, count=0,
         orig_query,)
     )
 
+    # 4. Infix with soundex on names
+    fallback_modifiers = []
+    if autocomplete:
+        fallback_modifiers.append((
+            'ind_names_infix_soundex',
+            modify_query_autocomplete,
+            'name = 90, alternative_names = 89, display_name = 40',)
+        )
+    fallback_modifiers.append((
+        'ind_names_infix_soundex',
+        modify_query_orig,
+        'name = 70, alternative_names = 69, display_name = 20',)
+    )
+    fallback_modifiers.append((
+        'ind_names_infix_soundex',
+        modify_query_remhouse,
+        'name = 50, alternative_names = 49, display_name = 10',
+        orig_query,)
+    )
+    # 5. If no result were found, try splitor modifier on prefix and infix soundex
+    fallback_modifiers.append((
+        'ind_names_prefix',
+        modify_query_splitor,
+        'name = 20, alternative_names = 19, display_name = 1',)
+    )
+    fallback_modifiers.append((
+        'ind_names_infix_soundex',
+        modify_query_splitor,
+        'name = 10, alternative_names = 9, display_name = 1',)
+    )
+
     if debug:
         pprint(index_modifiers)
 
+    # Parallel cascade starts 4. + 5. speculatively, cancelled if not needed
+    fallback_cascade = None
+    if WEBSEARCH_CASCADE_MODE == 'parallel':
+        fallback_cascade = start_query_modifiers(
+            orig_query, fallback_modifiers, query_filter, start, count, depth)
+
     # 1. + 2. + 3.
     rc, result = process_query_modifiers(
         orig_query, index_modifiers, debug_result,
-        times, query_filter, start, count, debug)
+        times, query_filter, start, count, debug, None, depth)
 
     if debug:
         pprint(rc)
@@ -758,48 +2159,29 @@ def search(orig_query, query_filter, autocomplete=False, start=0, count=0,
     result_first = result
     # 4. + 5.
     if not rc or 'matches' not in result or len(result['matches']) == 0:
-        index_modifiers = []
-        # 4. Infix with soundex on names
-        if autocomplete:
-            index_modifiers.append((
-                'ind_names_infix_soundex',
-                modify_query_autocomplete,
-                'name = 90, alternative_names = 89, display_name = 40',)
-            )
-        index_modifiers.append((
-            'ind_names_infix_soundex',
-            modify_query_orig,
-            'name = 70, alternative_names = 69, display_name = 20',)
-        )
-        index_modifiers.append((
-            'ind_names_infix_soundex',
-            modify_query_remhouse,
-            'name = 50, alternative_names = 49, display_name = 10',
-            orig_query,)
-        )
-        # 5. If no result were found, try splitor modifier on prefix and infix soundex
-        index_modifiers.append((
-            'ind_names_prefix',
-            modify_query_splitor,
-            'name = 20, alternative_names = 19, display_name = 1',)
-        )
-        index_modifiers.append((
-            'ind_names_infix_soundex',
-            modify_query_splitor,
-            'name = 10, alternative_names = 9, display_name = 1',)
-        )
         rc, result = process_query_modifiers(
-            orig_query, index_modifiers, debug_result,
-            times, query_filter, start, count, debug)
+            orig_query, fallback_modifiers, debug_result,
+            times, query_filter, start, count, debug, fallback_cascade, depth)
+    elif fallback_cascade is not None:
+        fallback_cascade[-1].close()
 
     if debug:
         pprint(rc)
         pprint(result)
     if 'matches' not in result:
         result = result_first
+    observe_cascade(debug_result)
     return rc, result
 
 
+def observe_cascade(debug_result):
+    """Metrics of the cascade depth and the modifier of the final result."""
+    METRICS.observe('websearch_cascade_depth', (), debug_result.get('steps', 0))
+    modify = debug_result.get('modify')
+    METRICS.inc('websearch_result_modifier_total',
+                (('modifier', modify[-1] if modify else 'none'), ))
+
+
 # ---------------------------------------------------------
 def has_modified_header(headers):
     """
@@ -807,21 +2189,10 @@ def has_modified_header(headers):
 
     Return True if content wasn't modified (According to the timestamp)
     """
-    global DATA_LAST_MODIFIED
-
     modified = headers.get('if-modified-since')
     if modified:
-        oldLastModified = DATA_LAST_MODIFIED
-        try:
-            mtime = path.getmtime(TMPFILE_DATA_TIMESTAMP)
-        except OSError:
-            with open(TMPFILE_DATA_TIMESTAMP, 'a'):
-                utime(TMPFILE_DATA_TIMESTAMP, None)
-            mtime = time()
-        DATA_LAST_MODIFIED = email.utils.formatdate(mtime, usegmt=True)
-        if DATA_LAST_MODIFIED != oldLastModified:
-            # reload attributes if index changed
-            get_attributes_values('ind_name_exact', CHECK_ATTR_FILTER)
+        # Data version is the modification time of the timestamp
+        mtime = get_data_version()
         # pprint([headers, modified, DATA_LAST_MODIFIED, mtime])
         # pprint([mtime, rfc822.parsedate(modified), mktime(rfc822.parsedate(modified))])
         modified_file = datetime.fromtimestamp(mtime)
@@ -872,13 +2243,21 @@ def search_url(country_code, query):
             except:
                 pass
 
-        # Common search for query with filters
-        rc, result = search(query.encode('utf-8'), query_filter, autocomplete, start, count)
+        count = min(SEARCH_MAX_COUNT, count)
+
+        # Common search for query with filters, or the page of the cursor
+        if request.args.get('cursor'):
+            rc, result, cursor = search_cursor(request.args.get('cursor'))
+        else:
+            rc, result, cursor = search_page(query.encode('utf-8'), query_filter,
+                                             autocomplete, start, count)
         if rc and len(result['matches']) > 0:
             code = 200
 
         data['query'] = query
         data['result'] = prepareResultJson(result)
+        if cursor:
+            data['result']['nextToken'] = cursor
     except:
         traceback.print_exc()
         data['result'] = {'message': 'Unexpected failure to handle this request. Please, contact sysadmin.'}
@@ -897,6 +2276,115 @@ def search_url_public(country_code, query):
     return search_url(country_code, query)
 
 
+# ---------------------------------------------------------
+BULK_LIST_FILTERS = ('type', 'class', 'city', 'county', 'country_code', 'sortBy')
+BULK_FILTERS = BULK_LIST_FILTERS + ('street', 'state', 'country', 'viewbox')
+
+
+def parse_bulk_query(row):
+    """
+    Parse one query of the bulk search, row is dict from JSON or CSV line.
+
+    Return (query, query_filter, autocomplete, start, count) or message
+    """
+    if not isinstance(row, dict):
+        return 'Query must be object with "q".'
+    q = row.get('q', row.get('query'))
+    if isinstance(q, (int, float)):
+        q = str(q)
+    if not q and not any(row.get(f) for f in BULK_FILTERS):
+        return 'Missing query.'
+
+    query_filter = {}
+    for f in BULK_FILTERS:
+        v = row.get(f)
+        if not v:
+            continue
+        if f in BULK_LIST_FILTERS:
+            if not isinstance(v, list):
+                # This argument can be list separated by comma
+                v = unicode(v).split(',')
+            v = [unicode(x).encode('utf-8') for x in v]
+        else:
+            v = unicode(v).encode('utf-8')
+        query_filter[f] = v
+
+    autocomplete = row.get('autocomplete') not in (None, '', False, 0, '0', 'false')
+    try:
+        start = int(row.get('startIndex') or 0)
+        count = int(row.get('count') or 0)
+    except (TypeError, ValueError):
+        return 'startIndex and count must be numeric.'
+    return unicode(q or '').encode('utf-8'), query_filter, autocomplete, start, count
+
+
+def bulk_search(parsed):
+    """Search one parsed query of the bulk search, return JSON result."""
+    if not isinstance(parsed, tuple):
+        return {'message': parsed}
+    query, query_filter, autocomplete, start, count = parsed
+    try:
+        rc, result = search(query, query_filter, autocomplete, start,
+                            min(SEARCH_MAX_COUNT, count), False, {}, {})
+        response = prepareResultJson(result)
+    except Exception:
+        traceback.print_exc()
+        response = {'message': 'Unexpected failure to handle this query.'}
+    response['query'] = query.decode('utf-8')
+    return response
+
+
+def bulk_results(rows):
+    """
+    Search rows on the bulk thread pool, yield results in the input order.
+
+    Only a bounded window of rows is read ahead, so memory does not grow
+    with the size of the input.
+    """
+    pool = get_thread_pool('bulk', WEBSEARCH_BULK_THREADS)
+    window = deque()
+    for row in rows:
+        window.append(pool.apply_async(bulk_search, (parse_bulk_query(row),)))
+        if len(window) >= 2 * WEBSEARCH_BULK_THREADS:
+            yield window.popleft().get()
+    while window:
+        yield window.popleft().get()
+
+
+def bulk_input_rows(stream, csv_input):
+    """Iterate rows of JSONL or CSV (with header) input stream."""
+    if csv_input:
+        for row in csv.DictReader(stream):
+            yield dict((k, v.decode('utf-8')) for k, v in row.items() if k and v)
+        return
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield loads(line)
+        except ValueError:
+            yield None
+
+
+@app.route('/q/batch', methods=['POST'])
+@app.route('/q/batch.js', methods=['POST'])
+def search_bulk_url():
+    """
+    Bulk searching of queries uploaded in POST body.
+
+    Body is JSON lines ({"q": "...", "country_code": "..."} per line),
+    or CSV with header (text/csv or input=csv). Results are streamed
+    as NDJSON in the same order.
+    """
+    csv_input = request.mimetype == 'text/csv' or request.args.get('input') == 'csv'
+    rows = bulk_input_rows(request.stream, csv_input)
+    lines = (dumps(result) + '\n' for result in bulk_results(rows))
+    resp = Response(stream_with_context(lines), mimetype='application/x-ndjson')
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
+
+
 # ---------------------------------------------------------
 @app.route('/')
 def search_query():
@@ -952,12 +2440,13 @@ def search_query():
             query_filter[f] = v
             filter = True
 
-    if not q and not filter:
+    cursor = request.args.get('cursor')
+    if not q and not filter and not cursor:
         # data['result'] = {'error': 'Missing query!'}
         return render_template('home.html', route='/')
 
     data['url'] = request.url
-    data['query'] = q.encode('utf-8')
+    data['query'] = (q or u'').encode('utf-8')
     orig_query = data['query']
 
     start = 0
@@ -973,11 +2462,20 @@ def search_query():
         except:
             pass
 
+    count = min(SEARCH_MAX_COUNT, count)
+
     if debug:
         times['prepare'] = time() - times['start']
 
-    # Common search for query with filters
-    rc, result = search(orig_query, query_filter, autocomplete, start, count, debug, times, debug_result)
+    # Common search for query with filters, or the page of the cursor
+    if cursor:
+        decoded = decode_cursor(cursor)
+        if decoded is not None:
+            orig_query = decoded[0]
+        rc, result, cursor = search_cursor(cursor)
+    else:
+        rc, result, cursor = search_page(orig_query, query_filter, autocomplete, start, count,
+                                         debug, times, debug_result)
     if rc and len(result['matches']) > 0:
         code = 200
 
@@ -985,7 +2483,10 @@ def search_query():
     if debug:
         times['process'] = time() - times['start']
         debug_result['times'] = times
+        debug_result['cache'] = RESULT_CACHE.stats()
     data['result'] = prepareResultJson(result)
+    if cursor:
+        data['result']['nextToken'] = cursor
     data['debug_result'] = debug_result
     data['autocomplete'] = autocomplete
     data['debug'] = debug
@@ -1043,6 +2544,22 @@ Date:   11.07.2017
 # debug   - boolean - if true, include diagnostics in the result
 # returns - result, distance tuple
 def reverse_search(lon, lat, classes, debug):
+    if debug or WEBSEARCH_CACHE_SIZE <= 0:
+        return process_reverse_search(lon, lat, classes, debug)
+
+    key = ('reverse', lon, lat, tuple(classes or []))
+    version = get_data_version()
+    cached = RESULT_CACHE.get(key, version)
+    if cached is not None:
+        return cached
+
+    result, distance = process_reverse_search(lon, lat, classes, debug)
+    if result.get('status'):
+        RESULT_CACHE.set(key, (result, distance), 2, version)
+    return result, distance
+
+
+def process_reverse_search(lon, lat, classes, debug):
     result = {
         'total_found': 0,
         'count': 0,
@@ -1057,6 +2574,15 @@ def reverse_search(lon, lat, classes, debug):
             'results': [],
         }
 
+    if WEBSEARCH_REVERSE_ENGINE == 'grid':
+        grid = get_reverse_index()
+        if grid is not None:
+            return reverse_search_grid(grid, lon, lat, classes, result, debug)
+    return reverse_search_searchd(lon, lat, classes, result, debug)
+
+
+def reverse_search_searchd(lon, lat, classes, result, debug):
+    """Find the closest place with growing bounding box queries of searchd."""
     try:
         db, cursor = get_db_cursor()
     except Exception as ex:
@@ -1072,74 +2598,99 @@ def reverse_search(lon, lat, classes, debug):
 
     delta = 0.0004
     count = 0
+    broken = False
+    myresult = {'matches': []}
 
-    while count == 0:
+    while count == 0 and delta < 360.0:
         delta *= 2
-        lon_min = lon - delta
-        lon_max = lon + delta
-        lat_min = lat - delta
-        lat_max = lat + delta
-
-        # Bound the latitude
-        lat_min = max(min(lat_min, 90.0), -90.0)
-        lat_max = max(min(lat_max, 90.0), -90.0)
-        # we use the built-in GEODIST function to calculate distance
-        select = ("SELECT *, GEODIST(" + str(lat) + ", " + str(lon) +
-                  ", lat, lon, {in=degrees, out=meters}) as distance"
-                  " FROM ind_name_exact WHERE ")
-
-        """
-        SphinxQL does not support the OR operator or the NOT BETWEEN syntax so the only
-        viable approach is to use 2 queries with different longitude conditions for
-        180 meridan spanning cases
-        """
-        wherelon = []
-        if (lon_min < -180.0):
-            wherelon.append("lon BETWEEN {} AND 180.0".format(360.0 + lon_min))
-            wherelon.append("lon BETWEEN -180.0 AND {}".format(lon_max))
-        elif (lon_max > 180.0):
-            wherelon.append("lon BETWEEN {} AND 180.0".format(lon_min))
-            wherelon.append("lon BETWEEN -180.0 AND {}".format(-360.0 + lon_max))
-        else:
-            wherelon.append("lon BETWEEN {} AND {}".format(lon_min, lon_max))
-        # latitude condition is the same for all cases
-        wherelat = "lat BETWEEN {} AND {}".format(lat_min, lat_max)
-        # limit the result set to the single closest match
-        limit = " ORDER BY distance ASC LIMIT 1"
-
         myresult = {}
-        if not classes:
-            classes = [""]
         # form the final queries and execute
-        for where in wherelon:
-            for cl in classes:
-                sql = select + " AND ".join([where, wherelat])
-                if cl:
-                    sql += " AND class='{}' ".format(cl)
-                sql += limit
-                # Boolean, {'matches': [{'weight': 0, 'id', 'attrs': {}}], 'total_found': 0}
-                status, result_new = get_query_result(cursor, sql, ())
-                if debug:
-                    result['debug']['queries'].append(sql)
-                    result['debug']['results'].append(result_new)
-                if 'matches' in myresult and len(myresult['matches']) > 0:
-                    myresult = mergeResultObject(myresult, result_new)
-                else:
-                    myresult = result_new.copy()
+        for sql, args in reverse_search_queries(lon, lat, delta, classes):
+            # Boolean, {'matches': [Match], 'total_found': 0}
+            status, result_new = get_query_result(cursor, sql, args)
+            broken = result_new.pop('connection_error', broken)
+            if debug:
+                result['debug']['queries'].append(sql)
+                result['debug']['results'].append(result_new)
+            if 'matches' in myresult and len(myresult['matches']) > 0:
+                myresult = mergeResultObject(myresult, result_new)
+            else:
+                myresult = result_new.copy()
 
         count = len(myresult['matches'])
-    db.close()
+        if broken:
+            break
+    release_db_cursor(db, cursor, broken)
+
+    if broken:
+        result['message'] = myresult.get('message')
+        result['status'] = False
+        return result, 0
 
     if debug:
         result['debug']['matches'] = myresult['matches']
 
+    return reverse_search_closest(result, myresult)
+
+
+def reverse_search_queries(lon, lat, delta, classes):
+    """SphinxQL queries for the closest place in the box around the point."""
+    lon_min = lon - delta
+    lon_max = lon + delta
+    lat_min = lat - delta
+    lat_max = lat + delta
+
+    # Bound the latitude
+    lat_min = max(min(lat_min, 90.0), -90.0)
+    lat_max = max(min(lat_max, 90.0), -90.0)
+    # we use the built-in GEODIST function to calculate distance
+    select = ("SELECT *, GEODIST(" + str(lat) + ", " + str(lon) +
+              ", lat, lon, {in=degrees, out=meters}) as distance"
+              " FROM ind_name_exact WHERE ")
+
+    """
+    SphinxQL does not support the OR operator or the NOT BETWEEN syntax so the only
+    viable approach is to use 2 queries with different longitude conditions for
+    180 meridan spanning cases
+    """
+    wherelon = []
+    if (lon_min < -180.0):
+        wherelon.append("lon BETWEEN {} AND 180.0".format(360.0 + lon_min))
+        wherelon.append("lon BETWEEN -180.0 AND {}".format(lon_max))
+    elif (lon_max > 180.0):
+        wherelon.append("lon BETWEEN {} AND 180.0".format(lon_min))
+        wherelon.append("lon BETWEEN -180.0 AND {}".format(-360.0 + lon_max))
+    else:
+        wherelon.append("lon BETWEEN {} AND {}".format(lon_min, lon_max))
+    # latitude condition is the same for all cases
+    wherelat = "lat BETWEEN {} AND {}".format(lat_min, lat_max)
+    # limit the result set to the single closest match
+    limit = " ORDER BY distance ASC LIMIT 1"
+
+    if not classes:
+        classes = [""]
+    queries = []
+    for where in wherelon:
+        for cl in classes:
+            sql = select + " AND ".join([where, wherelat])
+            args = []
+            if cl:
+                sql += " AND class=%s "
+                args.append(cl)
+            sql += limit
+            queries.append((sql, args))
+    return queries
+
+
+def reverse_search_closest(result, myresult):
+    """Fill result with the closest of found matches, return result, distance."""
     smallest_row = None
     smallest_distance = None
 
     # For the rows returned, find the smallest calculated distance
     # (the 180 meridian case may result in 2 rows to check)
     for match in myresult['matches']:
-        distance = match['attrs']['distance']
+        distance = match.attr('distance')
 
         if smallest_row is None or distance < smallest_distance:
             smallest_row = match
@@ -1147,13 +2698,224 @@ def reverse_search(lon, lat, classes, debug):
 
     result = mergeResultObject(result, myresult)
     result['count'] = 1
-    result['matches'] = [smallest_row]
+    result['matches'] = [smallest_row] if smallest_row is not None else []
     result['start_index'] = 1
     result['status'] = True
-    result['total_found'] = 1
+    result['total_found'] = len(result['matches'])
     return result, smallest_distance
 
 
+def get_reverse_index(version=None):
+    """Spatial grid index of the reverse engine, reopened with new data."""
+    global REVERSE_INDEX, REVERSE_INDEX_VERSION
+
+    if version is None:
+        version = get_data_version()
+    if version == REVERSE_INDEX_VERSION:
+        return REVERSE_INDEX
+    with REVERSE_INDEX_LOCK:
+        if version != REVERSE_INDEX_VERSION:
+            try:
+                REVERSE_INDEX = GridIndex(WEBSEARCH_REVERSE_INDEX)
+            except (IOError, OSError, ValueError) as ex:
+                print >> sys.stderr, 'Spatial index not available: ' + str(ex)
+                REVERSE_INDEX = None
+            REVERSE_INDEX_VERSION = version
+    return REVERSE_INDEX
+
+
+def reverse_search_grid(grid, lon, lat, classes, result, debug):
+    """Find the closest place with the spatial grid index, load its row from searchd."""
+    nearest = grid_nearest(grid, lon, lat, classes)
+    if debug:
+        result['debug']['nearest'] = nearest
+    if nearest is None:
+        result['status'] = True
+        return result, None
+
+    sql = ("SELECT *, GEODIST(" + str(lat) + ", " + str(lon) +
+           ", lat, lon, {in=degrees, out=meters}) as distance"
+           " FROM ind_name_exact WHERE id = %s")
+    status, myresult = execute_query(sql, (nearest[0],))
+    if debug:
+        result['debug']['queries'].append(sql)
+        result['debug']['results'].append(myresult)
+        result['debug']['matches'] = myresult['matches']
+    if not status:
+        result['message'] = myresult.get('message')
+        result['status'] = False
+        return result, 0
+    if len(myresult['matches']) == 0:
+        # Grid out of date with the indexes, e.g. place removed by a delta
+        return reverse_search_searchd(lon, lat, classes, result, debug)
+
+    row = myresult['matches'][0]
+    result['count'] = 1
+    result['matches'] = [row]
+    result['start_index'] = 1
+    result['status'] = True
+    result['total_found'] = 1
+    return result, row.attr('distance')
+
+
+def grid_nearest(grid, lon, lat, classes):
+    """
+    Closest place of the grid index, as (document id, distance) or None.
+
+    Documents killed by the deltas are skipped, rows of the delta documents
+    (not in the grid built from the input data) are compared one by one.
+    """
+    rows, killed = get_deltas()
+    nearest = grid.nearest(lon, lat, classes, killed or None)
+    for doc_id, row in rows.iteritems():
+        if classes and row[COLUMN_INDEX['class']].encode('utf-8') not in classes:
+            continue
+        try:
+            distance = geodist(lat, lon, float(row[COLUMN_INDEX['lat']]),
+                               float(row[COLUMN_INDEX['lon']]))
+        except ValueError:
+            continue
+        if nearest is None or distance < nearest[1]:
+            nearest = (doc_id, distance)
+    return nearest
+
+
+def reverse_search_batch(points):
+    """
+    Reverse geo-coding of more points at once.
+
+    Points are (lon, lat, classes). Identical points are processed once,
+    nearby points are grouped into the same multi-statement batches.
+    Return list of (result, distance) in the order of points
+    """
+    version = get_data_version()
+    unique = {}
+    for lon, lat, classes in points:
+        key = (lon, lat, tuple(classes or []))
+        if key not in unique and WEBSEARCH_CACHE_SIZE > 0:
+            unique[key] = RESULT_CACHE.get(('reverse',) + key, version)
+        else:
+            unique.setdefault(key, None)
+
+    # Group nearby points
+    pending = sorted([key for key in unique if unique[key] is None],
+                     key=lambda key: (round(key[1]), round(key[0]), key))
+    grid = None
+    if WEBSEARCH_REVERSE_ENGINE == 'grid':
+        grid = get_reverse_index()
+    if grid is not None:
+        found = reverse_search_batch_grid(grid, pending)
+    else:
+        found = reverse_search_batch_searchd(pending)
+
+    for key in pending:
+        unique[key] = found[key]
+        if found[key][0].get('status') and WEBSEARCH_CACHE_SIZE > 0:
+            RESULT_CACHE.set(('reverse',) + key, found[key], 2, version)
+
+    return [unique[(lon, lat, tuple(classes or []))] for lon, lat, classes in points]
+
+
+def reverse_search_batch_searchd(keys):
+    """Reverse search of (lon, lat, classes) keys, one growing box round at a time."""
+    found = {}
+    delta = dict((key, 0.0004) for key in keys)
+    pending = list(keys)
+    while pending:
+        queries = []
+        for key in pending:
+            delta[key] *= 2
+            for sql, args in reverse_search_queries(key[0], key[1], delta[key], key[2]):
+                queries.append((key, sql, args))
+
+        matches = dict((key, []) for key in pending)
+        for chunk_start in range(0, len(queries), WEBSEARCH_BATCH_QUERIES):
+            chunk = queries[chunk_start:chunk_start + WEBSEARCH_BATCH_QUERIES]
+            batch_results = []
+            message = None
+            try:
+                db, cursor = get_db_cursor()
+            except Exception as ex:
+                message = str(ex)
+            else:
+                batch_results, ex = get_batch_query_result(
+                    cursor, [(sql, args) for key, sql, args in chunk], meta=False)
+                release_db_cursor(db, cursor, isinstance(ex, MySQLdb.OperationalError))
+                if ex is not None:
+                    message = str(ex)
+            for i, (key, sql, args) in enumerate(chunk):
+                if i < len(batch_results):
+                    matches[key].extend(batch_results[i][1]['matches'])
+                elif key not in found:
+                    found[key] = ({
+                        'total_found': 0,
+                        'count': 0,
+                        'matches': [],
+                        'message': message,
+                        'status': False,
+                    }, 0)
+
+        next_pending = []
+        for key in pending:
+            if key in found:
+                continue
+            if len(matches[key]) > 0 or delta[key] >= 360.0:
+                result = {'total_found': 0, 'count': 0, 'matches': []}
+                found[key] = reverse_search_closest(result, {
+                    'matches': matches[key],
+                    'total_found': len(matches[key]),
+                })
+            else:
+                next_pending.append(key)
+        pending = next_pending
+    return found
+
+
+def reverse_search_batch_grid(grid, keys):
+    """Reverse search of (lon, lat, classes) keys with the spatial grid index."""
+    found = {}
+    nearest = {}
+    for key in keys:
+        nearest[key] = grid_nearest(grid, key[0], key[1], key[2])
+
+    # Load all found rows from searchd at once, distance is computed here
+    rows = {}
+    message = None
+    ids = sorted(set(n[0] for n in nearest.values() if n is not None))
+    for chunk_start in range(0, len(ids), 1000):
+        chunk = ids[chunk_start:chunk_start + 1000]
+        sql = "SELECT * FROM ind_name_exact WHERE id IN ({}) LIMIT {} OPTION max_matches = {}".format(
+            ', '.join(['%s'] * len(chunk)), len(chunk), len(chunk))
+        status, myresult = execute_query(sql, chunk)
+        if not status:
+            message = myresult.get('message')
+        for row in myresult['matches']:
+            rows[row.id] = row
+
+    missing = []
+    for key in keys:
+        result = {'total_found': 0, 'count': 0, 'matches': []}
+        if nearest[key] is not None and nearest[key][0] not in rows:
+            if message is None:
+                # Grid out of date with the indexes, e.g. place removed by a delta
+                missing.append(key)
+                continue
+            result['message'] = message
+            result['status'] = False
+            found[key] = (result, 0)
+            continue
+        matches = []
+        if nearest[key] is not None:
+            matches.append(rows[nearest[key][0]].with_attr('distance', nearest[key][1]))
+        found[key] = reverse_search_closest(result, {
+            'matches': matches,
+            'total_found': len(matches),
+        })
+    if missing:
+        found.update(reverse_search_batch_searchd(missing))
+    return found
+
+
 # ---------------------------------------------------------
 @app.route('/r/<lon>/<lat>.js', defaults={'classes': None})
 @app.route('/r/<classes>/<lon>/<lat>.js')
@@ -1214,18 +2976,117 @@ def reverse_search_url_public(lon, lat, classes):
 
     return reverse_search_url(lon, lat, classes)
 
+
+# ---------------------------------------------------------
+def parse_reverse_point(point):
+    """
+    Parse point of the batch reverse search.
+
+    [lon, lat], [lon, lat, "class,class"] or {"lon": , "lat": , "class": }
+    Return (lon, lat, classes), or message of invalid point
+    """
+    classes = None
+    if isinstance(point, dict):
+        lon = point.get('lon')
+        lat = point.get('lat')
+        classes = point.get('class')
+    elif isinstance(point, list) and len(point) in (2, 3):
+        lon = point[0]
+        lat = point[1]
+        if len(point) == 3:
+            classes = point[2]
+    else:
+        return 'Point must be [lon, lat, [class]] or object.'
+
+    try:
+        lon = float(lon)
+        lat = float(lat)
+    except (TypeError, ValueError):
+        return 'Longitude and latitude must be numeric.'
+    if lon < -180.0 or lon > 180.0:
+        return 'Invalid longitude.'
+    if lat < -90.0 or lat > 90.0:
+        return 'Invalid latitude.'
+
+    filter_classes = []
+    if classes:
+        if not isinstance(classes, list):
+            # This argument can be list separated by comma
+            classes = unicode(classes).split(',')
+        filter_classes = [unicode(cl).encode('utf-8') for cl in classes]
+    return lon, lat, filter_classes
+
+
+@app.route('/r/batch', methods=['POST'])
+@app.route('/r/batch.js', methods=['POST'])
+def reverse_search_batch_url():
+    """
+    REST API for reverse_search of many points.
+
+    POST body is JSON list of points (or object with "points" list),
+    results are returned in the same order as JSON, or streamed as NDJSON
+    with format=ndjson.
+    """
+    data = {'format': 'json'}
+    body = request.get_json(force=True, silent=True)
+    if isinstance(body, dict):
+        body = body.get('points')
+    if not isinstance(body, list):
+        data['result'] = {'message': 'Body must be JSON list of points.'}
+        return formatResponse(data, 400)
+    if len(body) > WEBSEARCH_BATCH_MAX_POINTS:
+        data['result'] = {'message': 'Too many points, maximum is {}.'.format(
+            WEBSEARCH_BATCH_MAX_POINTS)}
+        return formatResponse(data, 413)
+
+    points = [parse_reverse_point(point) for point in body]
+
+    def generate_results():
+        chunk_size = max(1, WEBSEARCH_BATCH_CHUNK)
+        for chunk_start in range(0, len(points), chunk_size):
+            chunk = points[chunk_start:chunk_start + chunk_size]
+            valid = [point for point in chunk if isinstance(point, tuple)]
+            try:
+                found = iter(reverse_search_batch(valid))
+            except Exception:
+                traceback.print_exc()
+                found = None
+            for point in chunk:
+                if not isinstance(point, tuple):
+                    yield {'message': point}
+                elif found is None:
+                    yield {'message': 'Unexpected failure to handle this request. Please, contact sysadmin.'}
+                else:
+                    yield prepareResultJson(next(found)[0])
+
+    if request.args.get('format') == 'ndjson':
+        lines = (dumps(result) + '\n' for result in generate_results())
+        resp = Response(lines, mimetype='application/x-ndjson')
+        resp.headers['Access-Control-Allow-Origin'] = '*'
+        return resp
+
+    data['result'] = {'results': list(generate_results())}
+    return formatResponse(data, 200)
+
 # =============================================================================
 # End Reverse geo-coding support
 # =============================================================================
 
 
-# Load attributes at runtime
-get_attributes_values('ind_name_exact', CHECK_ATTR_FILTER)
-pprint(ATTR_VALUES)
+# Load attributes before fork, shared by uwsgi workers
+pprint(get_attr_values())
+# Workers forked by uwsgi master inherit the cached results
+warmup_result_cache()
+# Connections opened by uwsgi master must not be shared with forked workers
+DB_POOL.clear()
+# Metrics of the warmup are not counted, snapshots of the previous run removed
+METRICS.reset()
+METRICS.clear_directory()
+RESULT_CACHE.reset_stats()
 
 
 """
 Main launcher
 """
 if __name__ == '__main__':
-    app.run(threaded=False, host='0.0.0.0', port=8000)
+    app.run(threaded=WEBSEARCH_THREADS > 1, host='0.0.0.0', port=8000)